@@ -0,0 +1,325 @@
+"""Benchmark suite of the packaged drivers, over synthetic inputs
+
+Each {py:class}`BenchCase` generates the files of a repo, sized by a `scale`
+factor, and the config of the (registered) driver to run over them. The
+driver is timed over fresh copies of the repo, then run once more in a fresh
+process for its memory use. Results are plain dicts, saved as JSON to compare
+releases.
+
+Memory is reported twice, as neither figure tells the whole story:
+`tracemalloc`'s peak only counts Python's own allocations, missing those of C
+extensions (tree-sitter trees, ruamel or orjson buffers...), while the peak
+resident set size counts everything, but includes the interpreter and imported
+modules too.
+"""
+
+import contextlib
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Any, Callable, NamedTuple
+
+from mass_driver.models.patchdriver import PatchDriver, PatchResult
+from mass_driver.models.repository import ClonedRepo
+
+from mass_driver_plugins.dryrun import get_driver
+
+
+class Scenario(NamedTuple):
+    """A repo's content, and what to run over it"""
+
+    files: dict[str, bytes]
+    """The repo's files, by path relative to repo root"""
+    driver_config: dict[str, Any]
+    """The config of the driver to run"""
+    patch_data: dict[str, Any] = {}
+    """The repo's patch data"""
+    size: str = ""
+    """How big the generated input is, as described to humans"""
+
+
+class BenchCase(NamedTuple):
+    """A benchmark of a driver, over inputs of configurable size"""
+
+    driver_name: str
+    """The driver's entry point name"""
+    description: str
+    """What the input is like, regardless of its size"""
+    generate: Callable[[float], Scenario]
+    """Create the scenario, given a scale factor (1 for the default size)"""
+
+
+def scaled(count: int, scale: float) -> int:
+    """Scale an item count, keeping at least one item"""
+    return max(1, int(count * scale))
+
+
+def large_workflow(scale: float) -> Scenario:
+    """Generate a GitHub Actions workflow of thousands of steps, a third to edit"""
+    actions = ["actions-rs/toolchain@v1", "actions/checkout@v2", "other/action@v1"]
+    steps = [
+        f"      - name: Step {i}\n"
+        f"        uses: {actions[i % 3]}\n"
+        "        with:\n"
+        "          profile: minimal\n"
+        "          toolchain: stable\n"
+        for i in range(scaled(3000, scale))
+    ]
+    workflow = "on: push\njobs:\n  build:\n    steps:\n" + "".join(steps)
+    return Scenario(
+        files={".github/workflows/ci.yml": workflow.encode()},
+        driver_config={"target_file": ".github/workflows/ci.yml"},
+        size=f"{len(steps)} steps",
+    )
+
+
+def many_tables_pyproject(scale: float) -> Scenario:
+    """Generate a pyproject.toml of many dependency groups, bumping one in each"""
+    groups = scaled(200, scale)
+    tables = ['[tool.poetry]\nname = "bench"\n\n[tool.poetry.dependencies]\n']
+    tables += [f'pkg{i} = "^1.0"\n' for i in range(20)]
+    for group in range(groups):
+        tables.append(f"\n[tool.poetry.group.g{group}.dependencies]\n")
+        tables += [f'g{group}-pkg{i} = "^1.{i}"\n' for i in range(10)]
+    return Scenario(
+        files={"pyproject.toml": "".join(tables).encode()},
+        driver_config={
+            "packages": {f"pkg{i}": "^2.0" for i in range(0, 20, 2)},
+            "group_packages": {
+                f"g{group}": {f"g{group}-pkg0": "^2.0"} for group in range(groups)
+            },
+        },
+        size=f"{groups} dependency groups",
+    )
+
+
+def large_document(scale: float) -> dict[str, Any]:
+    """Generate a nested document, about 3MB as indented JSON at scale 1"""
+    return {
+        "name": "bench",
+        "items": {
+            f"item{i}": {"id": i, "name": f"Item {i}", "tags": ["a", "b"], "on": True}
+            for i in range(scaled(20_000, scale))
+        },
+    }
+
+
+BENCH_PATCH = [
+    {"op": "replace", "path": "/name", "value": "patched"},
+    {"op": "add", "path": "/items/item0/tags/-", "value": "c"},
+]
+"""The JSON patch applied to the large documents"""
+
+
+def large_json(scale: float) -> Scenario:
+    """Generate a multi-MB indented JSON file, patching a couple of values"""
+    document = large_document(scale)
+    content = json.dumps(document, indent=2) + "\n"
+    return Scenario(
+        files={"data.json": content.encode()},
+        driver_config={"target_file": "data.json", "patch": BENCH_PATCH},
+        size=f"{len(document['items'])} items",
+    )
+
+
+def large_yaml(scale: float, items: int = 40_000, surgical: bool = True) -> Scenario:
+    """Generate a multi-MB YAML file, patching a value in surgical mode"""
+    count = scaled(items, scale)
+    lines = ["name: bench\nitems:\n"]
+    for i in range(count):
+        lines.append(f"  item{i}:\n    id: {i}\n    name: Item {i}\n")
+        lines.append("    tags:\n      - a\n      - b\n")
+    return Scenario(
+        files={"data.yaml": "".join(lines).encode()},
+        driver_config={
+            "target_file": "data.yaml",
+            "patch": BENCH_PATCH[:1],
+            "surgical": surgical,
+        },
+        size=f"{count} items",
+    )
+
+
+def small_yaml_full(scale: float) -> Scenario:
+    """Generate a YAML file, patching it by loading and dumping it whole
+
+    Kept small: ruamel's round-trip runs at well under 1MB/s.
+    """
+    return large_yaml(scale, items=2000, surgical=False)
+
+
+def many_variables_template(scale: float) -> Scenario:
+    """Generate a template reading hundreds of variables, among many more"""
+    variables = scaled(500, scale)
+    template = "\n".join(
+        f"{{% if var{i} %}}var{i} = {{{{ var{i} | upper }}}}{{% endif %}}"
+        for i in range(variables)
+    )
+    patch_data = {f"var{i}": f"value {i}" for i in range(variables * 4)}
+    return Scenario(
+        files={},
+        driver_config={"target_file": "generated.txt", "template": template},
+        patch_data=patch_data,
+        size=f"{variables} variables",
+    )
+
+
+CASES: dict[str, BenchCase] = {
+    "workflow": BenchCase(
+        "surgical-ghactionparamswitch", "GitHub workflow", large_workflow
+    ),
+    "pyproject": BenchCase("poetry-surgical", "pyproject.toml", many_tables_pyproject),
+    "json": BenchCase("jsonpatch", "JSON file", large_json),
+    "yaml": BenchCase("yamlpatch", "YAML file, surgical", large_yaml),
+    "yaml-full": BenchCase("yamlpatch", "YAML file, full round-trip", small_yaml_full),
+    "template": BenchCase("templater", "Template", many_variables_template),
+}
+"""All benchmarks, by name"""
+
+
+def write_repo(path: Path, scenario: Scenario) -> ClonedRepo:
+    """Create the scenario's repo files in given folder"""
+    path.mkdir(parents=True)
+    for name, content in scenario.files.items():
+        target = path / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(content)
+    return ClonedRepo(
+        clone_url=str(path),
+        repo_id=path.name,
+        cloned_path=path,
+        current_branch="main",
+        patch_data=scenario.patch_data,
+    )
+
+
+def build_driver(case: BenchCase, scenario: Scenario, repo_path: Path) -> PatchDriver:
+    """Build the case's driver, from within the repo, like mass-driver does"""
+    with contextlib.chdir(repo_path):  # Some drivers check file paths exist
+        driver = get_driver(case.driver_name).parse_obj(scenario.driver_config)
+    driver._logger = logging.getLogger(f"bench.driver.{case.driver_name}")
+    return driver
+
+
+def measure_memory(case: BenchCase, scale: float) -> tuple[int, int]:
+    """Run the case's driver once, in this process, getting its memory peaks
+
+    Meant for a fresh process: gives the peak of Python allocations while the
+    driver runs, and the peak resident set size of the whole process, in bytes.
+    """
+    scenario = case.generate(scale)
+    with tempfile.TemporaryDirectory(prefix="mass-driver-bench-") as tmp:
+        setup = write_repo(Path(tmp) / "setup", scenario)
+        driver = build_driver(case, scenario, setup.cloned_path)
+        repo = write_repo(Path(tmp) / "traced", scenario)
+        tracemalloc.start()
+        try:
+            driver.run(repo)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts kilobytes, macOS bytes
+    return peak, max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run_case(
+    name: str, case: BenchCase, scale: float = 1, repeat: int = 3
+) -> dict[str, Any]:
+    """Time a driver over fresh copies of the case's repo, then measure its memory
+
+    Throughput is of the input files' size, or of the output files' size for
+    drivers generating more than they read, like templates. Memory is measured
+    over a single run in a freshly spawned process, not to count the memory
+    used by previous cases.
+    """
+    scenario = case.generate(scale)
+    input_bytes = sum(len(content) for content in scenario.files.values())
+    timings = []
+    result: PatchResult | None = None
+    with tempfile.TemporaryDirectory(prefix="mass-driver-bench-") as tmp:
+        setup = write_repo(Path(tmp) / "setup", scenario)
+        driver = build_driver(case, scenario, setup.cloned_path)
+        for run in range(repeat):
+            repo = write_repo(Path(tmp) / f"run{run}", scenario)
+            start = time.perf_counter()
+            result = driver.run(repo)
+            timings.append(time.perf_counter() - start)
+        output_bytes = sum(
+            path.stat().st_size
+            for path in Path(tmp, "run0").rglob("*")
+            if path.is_file()
+        )
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+        peak, max_rss = pool.submit(measure_memory, case, scale).result()
+    # Generating drivers have little input: count what they wrote instead
+    processed_bytes = max(input_bytes, output_bytes)
+    assert result is not None, "At least one timed run"
+    best = min(timings)
+    return {
+        "case": name,
+        "driver": case.driver_name,
+        "description": f"{case.description}, {scenario.size}",
+        "outcome": result.outcome.value,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "best_seconds": round(best, 6),
+        "mean_seconds": round(statistics.mean(timings), 6),
+        "throughput_mb_s": round(processed_bytes / best / 1e6, 3),
+        "peak_memory_mb": round(peak / 1e6, 3),
+        "max_rss_mb": round(max_rss / 1e6, 3),
+    }
+
+
+def run_suite(
+    names: list[str] | None = None, scale: float = 1, repeat: int = 3
+) -> dict[str, Any]:
+    """Run the given benchmarks (default: all), describing the environment too"""
+    try:
+        package_version = version("mass_driver_plugins")
+    except PackageNotFoundError:  # pragma: no cover
+        package_version = None
+    results = [
+        run_case(name, CASES[name], scale=scale, repeat=repeat)
+        for name in (names or list(CASES))
+    ]
+    return {
+        "version": package_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "scale": scale,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def format_results(report: dict[str, Any]) -> str:
+    """Summarize results as a text table
+
+    Peak MB is of Python allocations only, RSS MB of the whole process.
+    """
+    header = (
+        f"{'case':<10} {'driver':<29} {'best (s)':>9} {'MB/s':>8} "
+        f"{'peak MB':>8} {'RSS MB':>8}"
+    )
+    lines = [header]
+    for r in report["results"]:
+        lines.append(
+            f"{r['case']:<10} {r['driver']:<29} {r['best_seconds']:>9.4f} "
+            f"{r['throughput_mb_s']:>8.2f} {r['peak_memory_mb']:>8.2f} "
+            f"{r['max_rss_mb']:>8.2f}"
+        )
+    return "\n".join(lines)
@@ -1,9 +1,20 @@
-"""Command line entrypoint for mass-driver-plugins"""
+"""Command line entrypoint for mass-driver-plugins
+
+Kept fast to start: listing drivers only reads entry point metadata, and
+describing or validating one imports just its module, whose heavy parsing and
+templating libraries wait for its first run. Commands import what they need.
+"""
 import argparse
+import json
 import sys
+import time
+from collections import Counter
+from importlib.metadata import entry_points
+from pathlib import Path
 from typing import Optional
 
-from mass_driver.discovery import discover_drivers
+DRIVER_ENTRYPOINT = "massdriver.drivers"
+"""The entry point group of drivers, as per mass_driver.discovery"""
 
 
 def parse_arguments(arguments: list[str]) -> argparse.Namespace:
@@ -12,17 +23,234 @@ def parse_arguments(arguments: list[str]) -> argparse.Namespace:
         "mass-driver-plugins",
         description="Experimental plugin ecosystem for Mass Driver",
     )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("drivers", help="List the available drivers (default)")
+    describe_parser = subparsers.add_parser(
+        "describe", help="Show a driver's config schema, as JSON Schema"
+    )
+    describe_parser.add_argument("driver", help="The driver's name, as in 'drivers'")
+    validate_parser = subparsers.add_parser(
+        "validate", help="Check a driver config, without running the driver"
+    )
+    validate_parser.add_argument("driver", help="The driver's name, as in 'drivers'")
+    validate_parser.add_argument(
+        "config",
+        type=Path,
+        help="TOML file of the driver config, or activity file with a migration",
+    )
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Dry-run a driver over local clones of repos, in parallel",
+        description=(
+            "Run a driver over each sub-folder of a directory of cloned repos, "
+            "printing each repo's result as a JSON line"
+        ),
+    )
+    run_parser.add_argument("driver", help="The driver's name, as in 'drivers'")
+    run_parser.add_argument(
+        "config",
+        type=Path,
+        help="TOML file of the driver config, or activity file with a migration",
+    )
+    run_parser.add_argument(
+        "repos_dir", type=Path, help="Directory of already-cloned repos"
+    )
+    run_parser.add_argument(
+        "-j",
+        "--workers",
+        type=positive_int,
+        default=None,
+        help="Number of worker processes (default: CPU count)",
+    )
+    run_parser.add_argument(
+        "--patch-data",
+        type=Path,
+        help="JSON file of patch data per repo, keyed by repo folder name",
+    )
+    run_parser.add_argument(
+        "--in-place",
+        action="store_true",
+        help="Patch the repos themselves, rather than temporary copies",
+    )
+    scan_parser = subparsers.add_parser(
+        "scan",
+        help="Inventory local clones of repos, in parallel, without patching",
+        description=(
+            "Run a scanner over each sub-folder of a directory of cloned repos, "
+            "printing each repo's findings as a JSON line"
+        ),
+    )
+    scan_parser.add_argument(
+        "scanner", help="The scanner: poetry-dependencies or github-actions"
+    )
+    scan_parser.add_argument(
+        "repos_dir", type=Path, help="Directory of already-cloned repos"
+    )
+    scan_parser.add_argument(
+        "-j",
+        "--workers",
+        type=positive_int,
+        default=None,
+        help="Number of worker processes (default: CPU count)",
+    )
+    scan_parser.add_argument(
+        "--index",
+        type=Path,
+        help="SQLite file to record findings in, replacing previous scans' ones",
+    )
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Benchmark the packaged drivers over synthetic inputs",
+        description="Time each driver over generated inputs, saving results as JSON",
+    )
+    bench_parser.add_argument(
+        "--case",
+        dest="cases",
+        action="append",
+        help="Benchmark to run, repeatable (default: all)",
+    )
+    bench_parser.add_argument(
+        "--scale",
+        type=float,
+        default=1,
+        help="Input size factor, 1 being the default size (default: 1)",
+    )
+    bench_parser.add_argument(
+        "--repeat",
+        type=positive_int,
+        default=3,
+        help="Timed runs per driver (default: 3)",
+    )
+    bench_parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path("bench.json"),
+        help="JSON file to save results to (default: bench.json)",
+    )
     return parser.parse_args(arguments)
 
 
+def positive_int(value: str) -> int:
+    """Parse a strictly positive integer argument"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
 def cli(arguments: Optional[list[str]] = None):
     """Run the mass_driver_plugins cli"""
     if arguments is None:
         arguments = sys.argv[1:]
-    parse_arguments(arguments)
+    args = parse_arguments(arguments)
+    if args.command == "describe":
+        return describe(args)
+    if args.command == "validate":
+        return validate(args)
+    if args.command == "run":
+        return run(args)
+    if args.command == "scan":
+        return scan(args)
+    if args.command == "bench":
+        return run_bench(args)
     main()
 
 
 def main():
     """Run the program's main command"""
-    print("\n".join(discover_drivers()))
+    print("\n".join(sorted(entry_points(group=DRIVER_ENTRYPOINT).names)))
+
+
+def describe(args: argparse.Namespace):
+    """Print a driver's config schema"""
+    from mass_driver_plugins import dryrun
+
+    print(dryrun.get_driver(args.driver).schema_json(indent=2))
+
+
+def validate(args: argparse.Namespace):
+    """Check a driver config file, exiting in error if invalid"""
+    from pydantic import ValidationError
+
+    from mass_driver_plugins import dryrun
+
+    driver_class = dryrun.get_driver(args.driver)
+    try:
+        driver_class.parse_obj(dryrun.load_driver_config(args.config))
+    except ValidationError as e:
+        sys.exit(f"Invalid config for {args.driver}: {e}")
+    print(f"Valid config for {args.driver}")
+
+
+def run(args: argparse.Namespace):
+    """Run a driver over a directory of repos, streaming results as JSON lines"""
+    from pydantic import ValidationError
+
+    from mass_driver_plugins import dryrun
+
+    driver_config = dryrun.load_driver_config(args.config)
+    patch_data = json.loads(args.patch_data.read_text()) if args.patch_data else {}
+    repos = dryrun.list_repos(args.repos_dir)
+    outcomes: Counter[str] = Counter()
+    start = time.perf_counter()
+    results = dryrun.run_all(
+        args.driver,
+        driver_config,
+        repos,
+        workers=args.workers,
+        patch_data=patch_data,
+        in_place=args.in_place,
+    )
+    try:
+        for result in results:
+            outcomes[result["outcome"]] += 1
+            print(dryrun.dump_line(result), flush=True)
+    except ValidationError as e:
+        sys.exit(f"Invalid config for {args.driver}: {e}")
+    elapsed = time.perf_counter() - start
+    summary = ", ".join(f"{outcome}: {count}" for outcome, count in outcomes.items())
+    print(
+        f"Ran {args.driver} over {len(repos)} repos in {elapsed:.2f}s ({summary})",
+        file=sys.stderr,
+    )
+
+
+def scan(args: argparse.Namespace):
+    """Scan a directory of repos, streaming findings as JSON lines"""
+    from mass_driver_plugins import dryrun, scanners
+
+    if args.scanner not in scanners.SCANNERS:
+        sys.exit(f"Unknown scanner: {args.scanner}")
+    key = scanners.SCANNERS[args.scanner].key
+    repos = dryrun.list_repos(args.repos_dir)
+    index = scanners.InventoryIndex(args.index) if args.index else None
+    start = time.perf_counter()
+    try:
+        for repo, findings in scanners.scan_repos(
+            args.scanner, repos, workers=args.workers
+        ):
+            print(dryrun.dump_line({"repo": repo.name, key: findings}), flush=True)
+            if index is not None:
+                index.record(args.scanner, repo.name, findings)
+    finally:
+        if index is not None:
+            index.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"Scanned {len(repos)} repos with {args.scanner} in {elapsed:.2f}s",
+        file=sys.stderr,
+    )
+
+
+def run_bench(args: argparse.Namespace):
+    """Run the benchmark suite, saving its results"""
+    from mass_driver_plugins import bench
+
+    unknown = set(args.cases or []) - set(bench.CASES)
+    if unknown:
+        sys.exit(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+    report = bench.run_suite(args.cases, scale=args.scale, repeat=args.repeat)
+    args.output.write_text(json.dumps(report, indent=2) + "\n")
+    print(bench.format_results(report))
+    print(f"Saved results to {args.output}", file=sys.stderr)
@@ -0,0 +1,236 @@
+"""Run a driver over local clones of many repos, in parallel, without a forge
+
+Each repo is a sub-folder of a mirror directory, already cloned. Drivers are
+built once per worker process, then run over repo after repo, so that their
+caches (compiled templates, tree-sitter queries...) are reused. Results are
+streamed as JSON lines, one per repo, in completion order.
+
+Drivers are validated from within a repo, like mass-driver does, as some of
+their fields are file paths relative to the repo's root.
+
+By default, each repo is copied to a temporary folder before patching, leaving
+the mirror untouched: pass `in_place` to patch the mirror itself. Driver state
+kept across runs (see {py:data}`STATE_FIELDS`) is then redirected to a
+temporary folder too, so that patching copies leaves no trace.
+"""
+
+import contextlib
+import json
+import logging
+import shutil
+import tempfile
+import time
+import tomllib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from importlib.metadata import entry_points
+from pathlib import Path
+from typing import Any, Iterator
+
+from mass_driver.models.patchdriver import PatchDriver, PatchOutcome, PatchResult
+from mass_driver.models.repository import ClonedRepo
+from pydantic import ValidationError
+
+DRIVER_ENTRYPOINT = "massdriver.drivers"
+"""The entry point group of drivers, as per mass_driver.discovery"""
+
+
+STATE_FIELDS = {"fingerprint_index", "memo_dir"}
+"""Driver config fields of files kept across runs, redirected unless in place"""
+
+
+def get_driver(driver_name: str) -> type[PatchDriver]:
+    """Load a driver class by entry point name, importing only its own module
+
+    Unlike `mass_driver.discovery.get_driver`, this doesn't import the modules
+    of forges, sources and scanners.
+    """
+    found = entry_points(group=DRIVER_ENTRYPOINT, name=driver_name)
+    if not found:
+        raise ImportError(f"driver '{driver_name}' not found in '{DRIVER_ENTRYPOINT}'")
+    (entry_point,) = found
+    return entry_point.load()
+
+
+def build_driver(
+    driver_name: str, driver_config: dict[str, Any], repo_path: Path
+) -> PatchDriver:
+    """Build a driver from within a repo, as file path fields are repo-relative"""
+    with contextlib.chdir(repo_path):
+        return get_driver(driver_name).parse_obj(driver_config)
+
+
+def validation_repo(
+    driver_name: str, driver_config: dict[str, Any], repos: list[Path]
+) -> Path | None:
+    """Find the first repo from within which the driver config is valid
+
+    Raises the first repo's ValidationError if none is, None without repos.
+    """
+    error = None
+    for repo_path in repos:
+        try:
+            build_driver(driver_name, driver_config, repo_path)
+        except ValidationError as e:
+            error = error or e
+        else:
+            return repo_path
+    if error is not None:
+        raise error
+    return None
+
+
+def load_driver_config(config_path: Path) -> dict[str, Any]:
+    """Read a driver's config from TOML file
+
+    Either a whole activity file, using its migration's `driver_config`, or a
+    file of just the driver config.
+    """
+    config = tomllib.loads(config_path.read_text())
+    migration = config.get("mass-driver", {}).get("migration")
+    if migration is not None:
+        return migration.get("driver_config", {})
+    return config
+
+
+def scratch_config(config: Any, scratch: Path, paths: dict[str, str]) -> Any:
+    """Redirect the config's state files to a scratch folder, in nested configs too
+
+    The same original path maps to the same scratch path, given `paths` shared
+    across calls, so that pipeline steps sharing state still do.
+    """
+    if isinstance(config, list):
+        return [scratch_config(item, scratch, paths) for item in config]
+    if not isinstance(config, dict):
+        return config
+    redirected = {}
+    for key, value in config.items():
+        if key in STATE_FIELDS and isinstance(value, str):
+            if value not in paths:
+                paths[value] = str(scratch / f"{len(paths)}-{Path(value).name}")
+            redirected[key] = paths[value]
+        else:
+            redirected[key] = scratch_config(value, scratch, paths)
+    return redirected
+
+
+def list_repos(mirror: Path) -> list[Path]:
+    """List the repos of a mirror directory: its non-hidden sub-folders"""
+    return sorted(
+        path
+        for path in mirror.iterdir()
+        if path.is_dir() and not path.name.startswith(".")
+    )
+
+
+def current_branch(repo_path: Path) -> str:
+    """Read the checked out branch of a git repo, without running git"""
+    try:
+        head = (repo_path / ".git" / "HEAD").read_text().strip()
+    except OSError:
+        return "HEAD"
+    return head.removeprefix("ref: refs/heads/")
+
+
+_driver: PatchDriver | None = None
+"""The driver of this worker process, built once by init_worker"""
+
+
+def init_worker(driver_name: str, driver_config: dict[str, Any], repo_path: Path):
+    """Build the driver for this worker process, from within given repo"""
+    global _driver
+    _driver = build_driver(driver_name, driver_config, repo_path)
+    _driver._logger = logging.getLogger(f"dryrun.driver.{driver_name}")
+
+
+def run_repo(repo_path: Path, patch_data: dict, in_place: bool) -> dict[str, Any]:
+    """Run this worker's driver over a repo, describing the result as a dict"""
+    if in_place:
+        return patch_repo(repo_path, repo_path, patch_data)
+    with tempfile.TemporaryDirectory(prefix="mass-driver-") as tmp:
+        work_path = Path(tmp) / repo_path.name
+        shutil.copytree(
+            repo_path, work_path, symlinks=True, ignore=shutil.ignore_patterns(".git")
+        )
+        return patch_repo(repo_path, work_path, patch_data)
+
+
+def patch_repo(repo_path: Path, work_path: Path, patch_data: dict) -> dict[str, Any]:
+    """Patch the repo's working copy, timing just the driver"""
+    repo = ClonedRepo(
+        clone_url=str(repo_path),
+        repo_id=repo_path.name,
+        cloned_path=work_path,
+        current_branch=current_branch(repo_path),
+        patch_data=patch_data,
+    )
+    assert _driver is not None, "Built by init_worker"
+    start = time.perf_counter()
+    try:
+        result = _driver.run(repo)
+    except Exception as e:
+        result = PatchResult(
+            outcome=PatchOutcome.PATCH_ERROR,
+            details=f"Unhandled exception caught during patching. Error was: {e}",
+        )
+    return {
+        "repo": repo_path.name,
+        "outcome": result.outcome.value,
+        "details": result.details,
+        "seconds": round(time.perf_counter() - start, 6),
+    }
+
+
+def run_all(
+    driver_name: str,
+    driver_config: dict[str, Any],
+    repos: list[Path],
+    workers: int | None = None,
+    patch_data: dict[str, dict] | None = None,
+    in_place: bool = False,
+) -> Iterator[dict[str, Any]]:
+    """Run a driver over all repos in a process pool, yielding results as done
+
+    Patch data is given per repo name. Workers default to the CPU count.
+    The driver config is validated upfront, raising ValidationError here rather
+    than in each worker process. Unless in place, the driver's state files are
+    redirected to a temporary folder, removed once done.
+    """
+    if in_place:
+        yield from run_pool(
+            driver_name, driver_config, repos, workers, patch_data, True
+        )
+        return
+    with tempfile.TemporaryDirectory(prefix="mass-driver-state-") as tmp:
+        scratch = scratch_config(driver_config, Path(tmp), {})
+        yield from run_pool(driver_name, scratch, repos, workers, patch_data, False)
+
+
+def run_pool(
+    driver_name: str,
+    driver_config: dict[str, Any],
+    repos: list[Path],
+    workers: int | None,
+    patch_data: dict[str, dict] | None,
+    in_place: bool,
+) -> Iterator[dict[str, Any]]:
+    """Run a driver over all repos in a process pool, as per run_all"""
+    valid_repo = validation_repo(driver_name, driver_config, repos)
+    if valid_repo is None:
+        return
+    patch_data = patch_data or {}
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(driver_name, driver_config, valid_repo),
+    ) as pool:
+        futures = [
+            pool.submit(run_repo, repo, patch_data.get(repo.name, {}), in_place)
+            for repo in repos
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def dump_line(result: dict[str, Any]) -> str:
+    """Serialize a repo's result as a JSON line"""
+    return json.dumps(result, ensure_ascii=False)
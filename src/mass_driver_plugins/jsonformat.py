@@ -0,0 +1,158 @@
+r"""Format-preserving JSON reading and writing, with an optional fast backend
+
+Files are written back in the style they were read in: indentation, newline
+style, trailing newline, separators and non-ASCII characters. Key order is
+kept as loaded. A patched file's diff then only shows the values that changed.
+Indented files are written one item per line, like `json.dump` would do: an
+array written inline in an indented file is expanded.
+
+When [orjson](https://github.com/ijl/orjson) is installed, it is used to write
+the styles it can produce (two-space indent, or compact without spaces), over
+ten times faster than `json.dumps` with indent. Other styles, and data orjson
+can't encode (like integers beyond 64 bits, NaN or Infinity) fall back to the
+standard library.
+
+>>> raw = b'{\r\n\t"name": "caf\xc3\xa9",\r\n\t"n": 2\r\n}'
+>>> data, style = load(raw)
+>>> style
+JsonStyle(indent='\t', newline='\r\n', trailing_newline=False, item_separator=',', key_separator=': ', ensure_ascii=False)
+>>> dump(data, style) == raw
+True
+"""
+
+import json
+import math
+import re
+from typing import Any, NamedTuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]  # Optional extra "fast"
+
+
+class JsonStyle(NamedTuple):
+    """The formatting of a JSON file, as needed to write it back alike"""
+
+    indent: str | None = None
+    """The whitespace of one level of indentation, or None for single-line"""
+    newline: str = "\n"
+    """The newline sequence between lines"""
+    trailing_newline: bool = True
+    """Whether the file ends with a newline"""
+    item_separator: str = ", "
+    """The separator between items, excluding any newline"""
+    key_separator: str = ": "
+    """The separator between a key and its value"""
+    ensure_ascii: bool = False
+    """Whether non-ASCII characters are escaped as \\uXXXX"""
+
+
+INDENT = re.compile(rb"[\[{][ \t]*\r?\n([ \t]+)[^ \t\r\n]")
+"""First indentation after an opening bracket"""
+SEPARATOR_OR_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"|[,:][ \t]?')
+"""Strings, to skip over them, or a separator and what follows it"""
+NON_ASCII_ESCAPE = re.compile(rb"\\u(?:00[89a-fA-F]|0[1-9a-fA-F]|[1-9a-fA-F])")
+r"""An escaped character above \u007F"""
+
+
+def detect_style(raw: bytes) -> JsonStyle:
+    r"""Guess the formatting of given JSON content
+
+    >>> detect_style(b'{"a":1,"b":[2]}')
+    JsonStyle(indent=None, newline='\n', trailing_newline=False, item_separator=',', key_separator=':', ensure_ascii=False)
+    >>> detect_style(b'{\n    "a": "\\u00e9"\n}\n').indent
+    '    '
+    """
+    indent_match = INDENT.search(raw)
+    indent = indent_match.group(1).decode() if indent_match else None
+    item_separator, key_separator = ", ", ": "
+    seen = set()
+    for token_match in SEPARATOR_OR_STRING.finditer(raw):
+        token = token_match.group()
+        kind = token[:1]
+        if kind == b'"' or kind in seen:
+            continue
+        seen.add(kind)
+        if kind == b",":
+            # Indented files end items with a newline: no trailing space
+            item_separator = "," if indent or token == b"," else ", "
+        else:
+            key_separator = token.decode()
+        if len(seen) == 2:
+            break
+    return JsonStyle(
+        indent=indent,
+        newline="\r\n" if b"\r\n" in raw else "\n",
+        trailing_newline=raw.endswith(b"\n"),
+        item_separator=item_separator,
+        key_separator=key_separator,
+        ensure_ascii=raw.isascii() and NON_ASCII_ESCAPE.search(raw) is not None,
+    )
+
+
+def load(raw: bytes) -> tuple[Any, JsonStyle]:
+    """Parse JSON content, along with its formatting
+
+    Parsing stays with stdlib `json`: it is as fast as orjson's on typical
+    files, and keeps integers beyond 64 bits exact, which orjson turns to float.
+    """
+    return json.loads(raw), detect_style(raw)
+
+
+def orjson_options(style: JsonStyle) -> int | None:
+    """Get the orjson options writing in given style, or None if it can't"""
+    if orjson is None or style.ensure_ascii:
+        return None
+    if style.indent == "  " and style.key_separator == ": ":
+        return orjson.OPT_INDENT_2
+    compact = style.item_separator + style.key_separator == ",:"
+    if style.indent is None and compact:
+        return 0
+    return None
+
+
+def dump(data: Any, style: JsonStyle) -> bytes:
+    """Serialize data as JSON, in given formatting"""
+    options = orjson_options(style)
+    content = None
+    # orjson writes NaN and Infinity as null: leave those to stdlib, as read
+    if options is not None and all_finite(data):
+        try:
+            content = orjson.dumps(data, option=options)
+        except orjson.JSONEncodeError:
+            # Beyond orjson's support (like huge ints): let stdlib do it
+            pass
+    if content is None:
+        content = json.dumps(
+            data,
+            indent=style.indent,
+            separators=(style.item_separator, style.key_separator),
+            ensure_ascii=style.ensure_ascii,
+        ).encode()
+    if style.newline != "\n" and style.indent is not None:
+        content = content.replace(b"\n", style.newline.encode())
+    if style.trailing_newline:
+        content += style.newline.encode()
+    return content
+
+
+def all_finite(data: Any) -> bool:
+    """Check that no float in the data-tree is NaN or infinite
+
+    >>> all_finite({"a": [1.5, {"b": None}]})
+    True
+    >>> all_finite({"a": [1.5, {"b": float("nan")}]})
+    False
+    """
+    pending = [data]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, float):
+            if not math.isfinite(item):
+                return False
+        elif isinstance(item, dict):
+            pending.extend(item.values())
+        elif isinstance(item, list):
+            pending.extend(item)
+    return True
@@ -1,55 +1,196 @@
 """A JSON Patch (RFC6902) PatchDriver"""
 
+from __future__ import annotations
+
 import json
+from io import BytesIO, StringIO
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, ClassVar
 
-import jsonpatch
-from mass_driver.models.patchdriver import PatchDriver, PatchOutcome, PatchResult
+from mass_driver.models.patchdriver import PatchOutcome, PatchResult
 from mass_driver.models.repository import ClonedRepo
 from pydantic import FilePath
-from ruamel import yaml
 
+from mass_driver_plugins import jsonformat, metrics, overlay
+from mass_driver_plugins.jsonformat import JsonStyle
+from mass_driver_plugins.memo import Memoized, MemoizingDriver
+from mass_driver_plugins.metrics import instrumented
+from mass_driver_plugins.pointer import (
+    JSON,
+    YAML,
+    Dialect,
+    NotSurgical,
+    same_document,
+    splice_operation,
+)
+from mass_driver_plugins.treesitter import REGISTRY
+from mass_driver_plugins.yamlpool import ROUND_TRIP
+
+if TYPE_CHECKING:
+    import jsonpatch
+    from ruamel import yaml
+
+
+class JsonPatchBase(MemoizingDriver):
+    """Base class for dict-based editing, regardless of type of file
 
-class JsonPatchBase(PatchDriver):
-    """Base class for dict-based editing, regardless of type of file"""
+    The patch is compiled once per driver instance, then reused for every repo.
+    Files the patch leaves unchanged are not rewritten, returning
+    ALREADY_PATCHED instead.
+
+    With `instrument = true`, the time spent reading, parsing, patching,
+    serializing and writing is recorded, see {py:mod}`mass_driver_plugins.metrics`.
+    With `memoize = true`, files identical to one already patched get the same
+    content and outcome without parsing, see {py:mod}`mass_driver_plugins.memo`.
+    """
 
     target_file: FilePath
     """File on which to apply Json Patch"""
     patch: list[dict] | str
     """JSON Patch, from RFC 6902"""
+    in_place: bool = False
+    """Apply the patch directly on the loaded tree, instead of a deep copy of it
+
+    Halves peak memory on large documents. A rollback journal still guarantees
+    that a failing operation (like a `test`) leaves the document as loaded.
+    """
+    surgical: bool = False
+    """Splice the patched values into the file, instead of rewriting it all
+
+    Each operation's path is resolved on the file's tree-sitter tree, and only
+    the targeted byte ranges are rewritten, leaving the rest untouched. Patches
+    with operations that can't be done this way (see
+    {py:mod}`mass_driver_plugins.pointer`) fall back to a full load and dump.
+    """
+
+    dialect: ClassVar[Dialect | None] = None
+    """How to find values in the tree-sitter tree of the file, for surgical mode"""
+
+    _compiled_patch: jsonpatch.JsonPatch | None = None
+    """The patch, compiled on first use"""
+
+    @property
+    def compiled_patch(self) -> jsonpatch.JsonPatch:
+        """Get the compiled JSON Patch, compiling it on first use"""
+        if self._compiled_patch is None:
+            import jsonpatch
+
+            if isinstance(self.patch, str):
+                self._compiled_patch = jsonpatch.JsonPatch.from_string(self.patch)
+            else:
+                self._compiled_patch = jsonpatch.JsonPatch(self.patch)
+        return self._compiled_patch
 
     def deserialize(self, fd) -> dict:
         """Load a data-tree particular file language of the day"""
-        raise NotImplementedError("No serialize function implemented")
+        raise NotImplementedError("No deserialize function implemented")
 
     def serialize(self, file_dict: dict, fd):
         """Dump a data-tree back to string in the particular file language of the day"""
-        raise NotImplementedError("No deserialize function implemented")
+        raise NotImplementedError("No serialize function implemented")
+
+    def load(self, raw: bytes) -> tuple[Any, Any]:
+        """Load a data-tree from file content, along with its formatting
+
+        The formatting is any object needed to write the file back alike, as
+        given back to {py:meth}`dump`. Defaults to {py:meth}`deserialize`,
+        without formatting: override both to preserve the file's style.
+        """
+        return self.deserialize(BytesIO(raw)), None
 
+    def dump(self, data: Any, formatting: Any) -> bytes:
+        """Dump a data-tree back to file content, in the original formatting
+
+        Defaults to {py:meth}`serialize`, ignoring formatting.
+        """
+        stream = StringIO()
+        self.serialize(data, stream)
+        return stream.getvalue().encode("utf-8")
+
+    def splice_patch(self, raw: bytes) -> bytes | None:
+        """Apply the patch by splicing the file content, None if not possible"""
+        if self.dialect is None:
+            return None
+        document = REGISTRY.document(self.dialect.language, raw)
+        try:
+            for operation in self.compiled_patch.patch:
+                splice_operation(document, operation, self.dialect)
+        except NotSurgical as e:
+            self.logger.debug(f"Falling back to full patching: {e}")
+            return None
+        REGISTRY.remember(document)
+        return document.content
+
+    @instrumented
     def run(self, repo: ClonedRepo) -> PatchResult:
         """Patch the given file"""
-        patch = self.patch
-        if isinstance(self.patch, list):
-            patch = jsonpatch.JsonPatch(self.patch)
         json_filepath_abs = Path(repo.cloned_path) / self.target_file
-        if not json_filepath_abs.is_file():
+        if not overlay.is_file(json_filepath_abs):
             return PatchResult(
                 outcome=PatchOutcome.PATCH_DOES_NOT_APPLY,
                 details="No such file to patch",
             )
+        raw = metrics.read_bytes(json_filepath_abs)
+        patched, (outcome_value, details) = self.memoized(raw, self.patch_memo)
+        outcome = PatchOutcome(outcome_value)
+        if outcome == PatchOutcome.PATCHED_OK:
+            metrics.write_bytes(json_filepath_abs, patched)
+        return PatchResult(outcome=outcome, details=details)
+
+    def patch_memo(self, raw: bytes) -> Memoized:
+        """Patch file content, noting the outcome and details, for memoizing"""
+        patched, result = self.patch_bytes(raw)
+        return Memoized(patched, (result.outcome.value, result.details))
+
+    def patch_bytes(self, raw: bytes) -> tuple[bytes, PatchResult]:
+        """Patch file content, returning the new content and the result"""
+        if self.surgical:
+            spliced = self.splice_patch(raw)
+            if spliced == raw:
+                return raw, PatchResult(outcome=PatchOutcome.ALREADY_PATCHED)
+            if spliced is not None:
+                return spliced, PatchResult(outcome=PatchOutcome.PATCHED_OK)
+        layer = overlay.CURRENT.get()
+        # Reuse the tree of a previous step that dumped this content, if any
+        kept = layer.take_document(type(self).load, raw) if layer else None
         try:
-            with open(json_filepath_abs, "rb") as json_file:
-                json_dict = self.deserialize(json_file)
+            with metrics.phase("parse"):
+                json_dict, formatting = kept or self.load(raw)
         except Exception as e:
-            return PatchResult(outcome=PatchOutcome.PATCH_ERROR, details=str(e))
-        patched_json = jsonpatch.apply_patch(json_dict, patch)
-        with open(json_filepath_abs, "w") as json_outfile:
-            self.serialize(patched_json, json_outfile)
-        return PatchResult(outcome=PatchOutcome.PATCHED_OK)
+            return raw, PatchResult(outcome=PatchOutcome.PATCH_ERROR, details=str(e))
+        try:
+            with metrics.phase("patch"):
+                if self.in_place:
+                    patched_json, changed = apply_in_place(
+                        json_dict, self.compiled_patch
+                    )
+                else:
+                    patched_json = self.compiled_patch.apply(json_dict)
+                    changed = not same_document(patched_json, json_dict)
+        except Exception as e:
+            return raw, PatchResult(
+                outcome=PatchOutcome.PATCH_ERROR,
+                details=f"Patch failed to apply: {e}",
+            )
+        if not changed:
+            if layer is not None:
+                layer.keep_document(type(self).load, raw, patched_json, formatting)
+            return raw, PatchResult(outcome=PatchOutcome.ALREADY_PATCHED)
+        with metrics.phase("serialize"):
+            dumped = self.dump(patched_json, formatting)
+        if layer is not None:
+            layer.keep_document(type(self).load, dumped, patched_json, formatting)
+        return dumped, PatchResult(outcome=PatchOutcome.PATCHED_OK)
 
 
 class JsonPatch(JsonPatchBase):
-    """Apply a JSON patch (RFC6902) on given JSON file"""
+    """Apply a JSON patch (RFC6902) on given JSON file
+
+    The file is written back in its original indentation, newlines and key
+    order. Uses orjson if installed, see {py:mod}`mass_driver_plugins.jsonformat`.
+    """
+
+    dialect = JSON
 
     def deserialize(self, fd) -> dict:
         """Load a data-tree particular file language of the day"""
@@ -59,16 +200,148 @@ class JsonPatch(JsonPatchBase):
         """Dump a data-tree back to string in the particular file language of the day"""
         json.dump(file_dict, fd)
 
+    def load(self, raw: bytes) -> tuple[Any, JsonStyle]:
+        """Load a data-tree from JSON, detecting its formatting"""
+        return jsonformat.load(raw)
+
+    def dump(self, data: Any, formatting: JsonStyle) -> bytes:
+        """Dump a data-tree back to JSON, in the detected formatting"""
+        return jsonformat.dump(data, formatting)
+
 
 class YamlPatch(JsonPatchBase):
-    """Apply a JSON patch (RFC6902) on given YAML file"""
+    """Apply a JSON patch (RFC6902) on given YAML file
+
+    Each thread reuses its own round-trip YAML instance, from
+    {py:data}`mass_driver_plugins.yamlpool.ROUND_TRIP`. The instance that loaded
+    a file is passed along explicitly to dump it, so the driver itself holds no
+    per-file state, and is safe to share across concurrent repo workers.
+    """
+
+    dialect = YAML
 
     def deserialize(self, fd):
         """Load a data-tree particular file language of the day"""
-        self._yaml = yaml.YAML(typ="rt")
-        self._yaml.indent(mapping=2, sequence=4, offset=2)
-        return self._yaml.load(fd)
+        return self.load(fd.read())[0]
 
     def serialize(self, file_dict: dict, fd):
         """Dump a data-tree back to string in the particular file language of the day"""
-        self._yaml.dump(file_dict, fd)
+        fd.write(self.dump(file_dict, ROUND_TRIP.get()).decode("utf-8"))
+
+    def load(self, raw: bytes) -> tuple[Any, yaml.YAML]:
+        """Load a data-tree from YAML, round-trip mode keeping comments"""
+        loader = ROUND_TRIP.get()
+        try:
+            return loader.load(raw), loader
+        except Exception:
+            ROUND_TRIP.discard()  # Don't reuse an instance left mid-parse
+            raise
+
+    def dump(self, data: Any, formatting: yaml.YAML) -> bytes:
+        """Dump a data-tree back to YAML, with the instance that loaded it"""
+        stream = BytesIO()
+        try:
+            formatting.dump(data, stream)
+        except Exception:
+            ROUND_TRIP.discard()
+            raise
+        return stream.getvalue()
+
+
+class PatchJournal:
+    """Undo log for JSON Patch operations applied in place
+
+    Before each operation, the containers it touches are snapshotted shallowly
+    (one level deep, not the whole document). Rolling back restores them in
+    reverse order. Comparing snapshots after each operation also tells whether
+    the patch changed anything at all.
+    """
+
+    def __init__(self):
+        """Start with an empty journal"""
+        self.entries: list[tuple[list | dict, list | dict]] = []
+        """The (container, snapshot of container before the operation) pairs"""
+        self.changed = False
+        """Whether any operation modified the document"""
+
+    def snapshot(self, container: Any) -> list[tuple[Any, Any]]:
+        """Record the current state of a container, before an operation"""
+        entry: tuple[list | dict, list | dict]
+        if isinstance(container, list):
+            entry = (container, list(container))
+        elif isinstance(container, dict):
+            entry = (container, dict(container))
+        else:
+            return []  # Scalars can't be modified in place
+        self.entries.append(entry)
+        return [entry]
+
+    def check_changed(self, entries: list[tuple[Any, Any]]):
+        """Compare containers to their snapshots, after an operation"""
+        for container, saved in entries:
+            self.changed = self.changed or not same_document(container, saved)
+
+    def rollback(self):
+        """Restore all snapshotted containers, latest first"""
+        for container, saved in reversed(self.entries):
+            if isinstance(container, list):
+                container[:] = saved
+            else:
+                container.clear()
+                container.update(saved)
+        self.entries.clear()
+
+
+def patch_operations(
+    patch: jsonpatch.JsonPatch,
+) -> list[tuple[dict, jsonpatch.PatchOperation]]:
+    """List a patch's operations, each with the jsonpatch object applying it
+
+    Built from the patch's public `patch` list and `operations` registry, the
+    same way {py:class}`jsonpatch.JsonPatch` does internally, so that each
+    operation can be applied (and journaled) one at a time.
+    """
+    import jsonpatch
+
+    steps = []
+    for operation in patch.patch:
+        operation_class = patch.operations.get(operation.get("op"))
+        if operation_class is None:
+            raise jsonpatch.InvalidJsonPatch(
+                f"Unknown operation {operation.get('op')!r}"
+            )
+        step = operation_class(operation, pointer_cls=patch.pointer_cls)
+        steps.append((operation, step))
+    return steps
+
+
+def apply_in_place(document: Any, patch: jsonpatch.JsonPatch) -> tuple[Any, bool]:
+    """Apply a JSON Patch directly on document, without deep copying it first
+
+    Returns the patched document (a new object only if the root was replaced)
+    and whether anything changed. On failure, the document is rolled back to
+    its original state before re-raising.
+    """
+    journal = PatchJournal()
+    original_root = document
+    try:
+        for operation, step in patch_operations(patch):
+            paths = [operation["path"]]
+            if operation["op"] == "move":
+                paths.append(operation["from"])
+            entries = []
+            if operation["op"] != "test":
+                for path in paths:
+                    pointer = patch.pointer_cls(path)
+                    if pointer.parts:
+                        parent, _last = pointer.to_last(document)
+                        entries.extend(journal.snapshot(parent))
+            document = step.apply(document)
+            journal.check_changed(entries)
+    except Exception:
+        journal.rollback()
+        raise
+    root_changed = document is not original_root and not same_document(
+        document, original_root
+    )
+    return document, journal.changed or root_changed
@@ -0,0 +1,211 @@
+"""Content-addressed memoization of drivers' results, across repos
+
+Many repos hold byte-identical copies of the same file, from the same
+cookiecutter template. A driver with `memoize = true` fixes each distinct
+content once: its result is stored under the hash of the driver's config and of
+the input content, and any later repo with identical content reuses it by hash
+lookup, without parsing or editing anything.
+
+Results are kept in a bounded, thread-safe LRU, optionally backed by an on-disk
+store (`memo_dir`) to be shared across processes and runs. Each result is the
+file's new content along with a JSON-able note of the driver's choosing (say
+the outcome of each package bump), see {py:class}`MemoizingDriver.memoized`.
+
+Only successful computations are stored: exceptions propagate as usual.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Any, Callable, NamedTuple
+
+from mass_driver_plugins import metrics
+from mass_driver_plugins.metrics import InstrumentedDriver
+
+
+class Memoized(NamedTuple):
+    """A driver's result over a file's content"""
+
+    content: bytes
+    """The file's content after the driver, identical to input if unchanged"""
+    note: Any
+    """JSON-able details of the driver's choosing, like the outcome"""
+
+
+class DiskStore:
+    """A folder of memoized results, one file per key, shared across processes
+
+    Each file holds the note as a JSON line, followed by the content. Files are
+    written atomically, so concurrent writers of the same key are harmless.
+    """
+
+    def __init__(self, path: Path):
+        """Store in given folder, created on first write"""
+        self.path = path
+
+    def _entry(self, key: str) -> Path:
+        """Get the file of a key, fanned out in sub-folders by prefix"""
+        return self.path / key[:2] / key
+
+    def get(self, key: str) -> Memoized | None:
+        """Read a key's result, None if absent"""
+        try:
+            raw = self._entry(key).read_bytes()
+        except FileNotFoundError:
+            return None
+        header, _newline, content = raw.partition(b"\n")
+        return Memoized(content, json.loads(header))
+
+    def put(self, key: str, result: Memoized):
+        """Write a key's result"""
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        header = json.dumps(result.note, ensure_ascii=True).encode("ascii")
+        with tempfile.NamedTemporaryFile(dir=entry.parent, delete=False) as out:
+            out.write(header + b"\n" + result.content)
+        os.replace(out.name, entry)
+
+
+class ResultMemo:
+    """Bounded LRU of results by key, optionally backed by a {py:class}`DiskStore`
+
+    Safe to share across threads. Results found on disk are kept in memory too.
+    Hits and misses are counted in the current repo's metrics, if instrumented.
+
+    >>> memo = ResultMemo(max_entries=1)
+    >>> memo.put("a", Memoized(b"A", None))
+    >>> memo.put("b", Memoized(b"B", None))
+    >>> memo.get("a") is None, memo.get("b")
+    (True, Memoized(content=b'B', note=None))
+    """
+
+    def __init__(self, max_entries: int = 1024, store: DiskStore | None = None):
+        """Start with an empty memory"""
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Memoized] = OrderedDict()
+        self._max_entries = max_entries
+        self.store = store
+        """The on-disk store, if any"""
+
+    def get(self, key: str) -> Memoized | None:
+        """Get a key's result, from memory or else disk, None if unknown"""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+        if result is None and self.store is not None:
+            result = self.store.get(key)
+            if result is not None:
+                self._remember(key, result)
+        metrics.count("memo_hits" if result is not None else "memo_misses")
+        return result
+
+    def put(self, key: str, result: Memoized):
+        """Store a key's result, in memory and on disk"""
+        self._remember(key, result)
+        if self.store is not None:
+            self.store.put(key, result)
+
+    def _remember(self, key: str, result: Memoized):
+        """Keep a result in memory, evicting the least recently used"""
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+MEMO_IGNORED_FIELDS = {"memoize", "memo_size", "memo_dir", "instrument", "metrics_file"}
+"""Config fields that don't change a driver's results, left out of its hash"""
+
+
+class MemoizingDriver(InstrumentedDriver):
+    """A driver whose results can be memoized by input content, across repos
+
+    Also instrumented: pydantic keeps private attributes in `__slots__`, so
+    driver mixins with private attributes can't be combined as sibling bases,
+    only chained.
+    """
+
+    memoize: bool = False
+    """Reuse the result of identical file content, across repos"""
+    memo_size: int = 1024
+    """How many results to keep in memory, when memoizing"""
+    memo_dir: str | None = None
+    """Also store results in this folder, to share across runs. Implies memoize"""
+
+    _memo: ResultMemo | None = None
+    """The results memo, created on first use"""
+    _config_digest: str | None = None
+    """The hash of the driver's class and config, computed on first use"""
+
+    @property
+    def memoizes(self) -> bool:
+        """Whether this driver memoizes its results"""
+        return self.memoize or self.memo_dir is not None
+
+    @property
+    def memo(self) -> ResultMemo:
+        """Get the results memo, creating it once"""
+        with MEMO_CREATION:
+            if self._memo is None:
+                store = DiskStore(Path(self.memo_dir)) if self.memo_dir else None
+                self._memo = ResultMemo(self.memo_size, store)
+        return self._memo
+
+    @property
+    def config_digest(self) -> str:
+        """Hash the driver's class and the config fields affecting results"""
+        if self._config_digest is None:
+            config = self.json(exclude=MEMO_IGNORED_FIELDS, sort_keys=True)
+            driver_class = f"{type(self).__module__}.{type(self).__qualname__}"
+            identity = "\n".join([driver_class, package_version(), config])
+            self._config_digest = hashlib.sha256(identity.encode()).hexdigest()
+        return self._config_digest
+
+    def memoized(
+        self, content: bytes, compute: Callable[[bytes], Memoized]
+    ) -> Memoized:
+        """Compute the result over content, unless memoized already
+
+        Without memoization, just computes it.
+        """
+        if not self.memoizes:
+            return compute(content)
+        key = memo_key(self.config_digest, content)
+        result = self.memo.get(key)
+        if result is None:
+            result = compute(content)
+            self.memo.put(key, result)
+        return result
+
+
+MEMO_CREATION = threading.Lock()
+"""Guard creating a driver's memo only once, across threads"""
+
+
+def memo_key(config_digest: str, content: bytes) -> str:
+    """Get the key of a content's result, for a driver's config
+
+    >>> memo_key("abc", b"x") == memo_key("abc", b"x") != memo_key("abd", b"x")
+    True
+    """
+    content_digest = hashlib.sha256(content).hexdigest()
+    return hashlib.sha256(f"{config_digest}:{content_digest}".encode()).hexdigest()
+
+
+@functools.cache
+def package_version() -> str:
+    """Get this package's version, for results to expire on upgrade"""
+    try:
+        return version("mass_driver_plugins")
+    except PackageNotFoundError:  # pragma: no cover
+        return "unknown"
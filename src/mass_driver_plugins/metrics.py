@@ -0,0 +1,328 @@
+"""Opt-in instrumentation of drivers: per-phase timings and counters, per repo
+
+A driver run with `instrument = true` records, for each repo, the wall time
+spent in each phase (`read`, `parse`, `query`, `refine`, `edit`, `serialize`,
+`render`, `write`...) and counters like bytes read and written, query captures
+and cache hits. The repo's {py:class}`RepoMetrics` are attached to its
+`PatchResult` details as a JSON line, and handed to the process-wide
+{py:data}`METRICS` collector, which keeps histograms of each value across the
+whole activity, and forwards each repo's report to its sinks.
+
+The current repo's metrics are held in a context variable, so that shared code
+(like the tree-sitter registry) records into whichever repo is being patched,
+without passing it around. Without instrumentation, recording does nothing.
+
+Phases don't nest: each records its own wall time, so their sum is at most the
+repo's total `seconds`, the remainder being untracked driver work.
+
+>>> metrics = RepoMetrics("Driver", "repo")
+>>> token = CURRENT.set(metrics)
+>>> with phase("parse"):
+...     count("captures", 3)
+>>> CURRENT.reset(token)
+>>> metrics.counters
+Counter({'captures': 3})
+>>> list(metrics.phases)
+['parse']
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from mass_driver.models.patchdriver import PatchDriver, PatchResult
+from mass_driver.models.repository import ClonedRepo
+
+from mass_driver_plugins import overlay
+
+Report = dict[str, Any]
+"""A repo's metrics, as JSON-able dict, see {py:meth}`RepoMetrics.report`"""
+Sink = Callable[[Report], None]
+"""A function receiving each repo's report"""
+
+
+class RepoMetrics:
+    """The timings and counters of one driver's run over one repo
+
+    Thread-safe: drivers editing several files at once record concurrently.
+    """
+
+    def __init__(self, driver: str, repo_id: str):
+        """Start with nothing recorded"""
+        self.driver = driver
+        """The name of the driver class"""
+        self.repo_id = repo_id
+        """The repo being patched"""
+        self.seconds = 0.0
+        """The wall time of the whole run"""
+        self.phases: dict[str, float] = {}
+        """Wall time spent in each phase, in seconds, in order of first use"""
+        self.counters: Counter[str] = Counter()
+        """Counts of bytes, captures, cache hits..."""
+        self._lock = threading.Lock()
+
+    def add_time(self, name: str, seconds: float):
+        """Add wall time to a phase"""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name: str, amount: int = 1):
+        """Increment a counter"""
+        with self._lock:
+            self.counters[name] += amount
+
+    def report(self) -> Report:
+        """Describe the metrics as a JSON-able dict"""
+        with self._lock:
+            return {
+                "driver": self.driver,
+                "repo": self.repo_id,
+                "seconds": round(self.seconds, 6),
+                "phases": {name: round(s, 6) for name, s in self.phases.items()},
+                "counters": dict(self.counters),
+            }
+
+
+CURRENT: ContextVar[RepoMetrics | None] = ContextVar("metrics", default=None)
+"""The metrics of the repo being patched, if instrumented"""
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time the wrapped code as given phase of the current repo, if any"""
+    metrics = CURRENT.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - start)
+
+
+def count(name: str, amount: int = 1):
+    """Increment a counter of the current repo, if any"""
+    metrics = CURRENT.get()
+    if metrics is not None:
+        metrics.count(name, amount)
+
+
+def read_bytes(path: Path) -> bytes:
+    """Read a file, as the `read` phase, counting bytes read
+
+    Goes through the current file overlay, see {py:mod}`mass_driver_plugins.overlay`.
+    """
+    with phase("read"):
+        content = overlay.read_bytes(path)
+    count("bytes_read", len(content))
+    return content
+
+
+def write_bytes(path: Path, content: bytes):
+    """Write a file, as the `write` phase, counting bytes written
+
+    Goes through the current file overlay, see {py:mod}`mass_driver_plugins.overlay`.
+    """
+    with phase("write"):
+        overlay.write_bytes(path, content)
+    count("bytes_written", len(content))
+
+
+class Histogram:
+    """Distribution of a value across repos, in power-of-two buckets
+
+    >>> histogram = Histogram()
+    >>> for value in [0.3, 0.5, 3, 0]:
+    ...     histogram.add(value)
+    >>> histogram.summary()["buckets"]
+    {'0': 1, '0.5': 2, '4': 1}
+    """
+
+    def __init__(self):
+        """Start empty"""
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets: Counter[float] = Counter()
+        """Number of values by bucket upper bound"""
+
+    def add(self, value: float):
+        """Record a value"""
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.buckets[bucket_bound(value)] += 1
+
+    def summary(self) -> dict[str, Any]:
+        """Describe the distribution as a JSON-able dict"""
+        return {
+            "count": self.count,
+            "total": round(self.total, 6),
+            "min": round(self.min, 6),
+            "max": round(self.max, 6),
+            "mean": round(self.total / self.count, 6),
+            "buckets": {
+                f"{bound:g}": self.buckets[bound] for bound in sorted(self.buckets)
+            },
+        }
+
+
+def bucket_bound(value: float) -> float:
+    """Get the upper bound of a value's bucket: the next power of two
+
+    >>> bucket_bound(3), bucket_bound(4), bucket_bound(0.3), bucket_bound(0)
+    (4, 4, 0.5, 0)
+    """
+    if value <= 0:
+        return 0
+    return 2 ** math.ceil(math.log2(value))
+
+
+class MetricsCollector:
+    """Aggregate the metrics of all instrumented repos of this process
+
+    Each repo's report is added to per-driver histograms (of total `seconds`,
+    of each `phase.NAME` and of each counter) then given to every sink.
+    """
+
+    def __init__(self):
+        """Start with no histograms and no sinks"""
+        self._lock = threading.Lock()
+        self._histograms: dict[str, dict[str, Histogram]] = {}
+        self.sinks: list[Sink] = []
+        """Functions receiving each repo's report, in order"""
+
+    def add_sink(self, sink: Sink):
+        """Send each subsequent repo's report to sink"""
+        with self._lock:
+            self.sinks.append(sink)
+
+    def remove_sink(self, sink: Sink):
+        """Stop sending reports to sink"""
+        with self._lock:
+            self.sinks.remove(sink)
+
+    def record(self, report: Report):
+        """Aggregate a repo's report, and hand it to the sinks"""
+        values = {"seconds": report["seconds"]}
+        values.update(
+            {f"phase.{name}": seconds for name, seconds in report["phases"].items()}
+        )
+        values.update(report["counters"])
+        with self._lock:
+            histograms = self._histograms.setdefault(report["driver"], {})
+            for name, value in values.items():
+                histograms.setdefault(name, Histogram()).add(value)
+            sinks = list(self.sinks)
+        for sink in sinks:
+            sink(report)
+
+    def histograms(self) -> dict[str, dict[str, dict[str, Any]]]:
+        """Summarize the histograms so far, by driver then metric name"""
+        with self._lock:
+            return {
+                driver: {
+                    name: histogram.summary()
+                    for name, histogram in sorted(histograms.items())
+                }
+                for driver, histograms in self._histograms.items()
+            }
+
+    def clear(self):
+        """Forget all histograms, keeping the sinks"""
+        with self._lock:
+            self._histograms.clear()
+
+
+METRICS = MetricsCollector()
+"""The collector shared by all drivers of this process"""
+
+
+class JsonLinesSink:
+    """Append each report as a JSON line to a file, safely across threads"""
+
+    def __init__(self, path: Path):
+        """Write to given file, created on first report"""
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, report: Report):
+        """Append the report to the file"""
+        line = json.dumps(report, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as out:
+                out.write(line)
+
+
+class InstrumentedDriver(PatchDriver):
+    """A driver whose runs can be instrumented, see {py:func}`instrumented`"""
+
+    instrument: bool = False
+    """Record per-phase timings and counters, in each repo's PatchResult details"""
+    metrics_file: str | None = None
+    """Also append each repo's metrics to this JSON lines file
+
+    Implies instrument.
+    """
+
+    _metrics_sink: JsonLinesSink | None = None
+    """The sink writing to metrics_file, created on first use"""
+
+    @property
+    def records_metrics(self) -> bool:
+        """Whether runs of this driver record metrics"""
+        return self.instrument or self.metrics_file is not None
+
+    def publish_metrics(self, metrics: RepoMetrics, result: PatchResult) -> PatchResult:
+        """Send a repo's metrics to collector and sinks, and attach to result"""
+        report = metrics.report()
+        METRICS.record(report)
+        if self.metrics_file is not None:
+            with SINK_CREATION:
+                if self._metrics_sink is None:
+                    self._metrics_sink = JsonLinesSink(Path(self.metrics_file))
+            self._metrics_sink(report)
+        line = f"metrics: {json.dumps(report, ensure_ascii=False)}"
+        details = f"{result.details}\n{line}" if result.details else line
+        return PatchResult(outcome=result.outcome, details=details)
+
+
+SINK_CREATION = threading.Lock()
+"""Guard creating a driver's metrics_file sink only once, across threads"""
+
+
+def instrumented(run: Callable[[Any, ClonedRepo], PatchResult]):
+    """Decorate an {py:class}`InstrumentedDriver`'s run, to record its metrics
+
+    Runs nested in an instrumented run (a subclass calling its parent's run,
+    or a driver calling another) record into the outer run's metrics.
+    """
+
+    @functools.wraps(run)
+    def run_instrumented(self: InstrumentedDriver, repo: ClonedRepo) -> PatchResult:
+        if not self.records_metrics or CURRENT.get() is not None:
+            return run(self, repo)
+        metrics = RepoMetrics(type(self).__name__, repo.repo_id)
+        token = CURRENT.set(metrics)
+        start = time.perf_counter()
+        try:
+            result = run(self, repo)
+        finally:
+            metrics.seconds = time.perf_counter() - start
+            CURRENT.reset(token)
+        return self.publish_metrics(metrics, result)
+
+    return run_instrumented
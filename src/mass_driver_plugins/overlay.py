@@ -0,0 +1,218 @@
+"""In-memory layer of file contents over a repo, shared by chained drivers
+
+When several drivers run one after the other over the same repo (see
+{py:mod}`mass_driver_plugins.pipeline`), each driver's writes land in a
+{py:class}`FileOverlay` rather than on disk, and the next driver reads them
+back from memory. Once all drivers ran, the overlay is flushed to disk in one
+pass, writing only the files whose final content differs from disk.
+
+Drivers go through the module's {py:func}`is_file`, {py:func}`glob`,
+{py:func}`read_bytes` and {py:func}`write_bytes`, which use the current overlay
+if any, or else the disk. Side effects that only make sense once the files are
+on disk, like recording what was rendered, go through {py:func}`after_flush`.
+Data-trees loaded by a driver can be kept along with the content they were
+dumped to, so that the next driver over that content skips loading it.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+import shutil
+import threading
+from contextvars import ContextVar
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Callable, Hashable
+
+ABSENT = None
+"""The original content of files that don't exist on disk"""
+
+
+class FileOverlay:
+    """Contents of the files read and written by drivers, over the disk
+
+    Safe to share across threads, like drivers editing many files at once.
+    """
+
+    def __init__(self):
+        """Start with no file in memory"""
+        self._lock = threading.Lock()
+        self._files: dict[Path, bytes] = {}
+        self._originals: dict[Path, bytes | None] = {}
+        self._modes: dict[Path, Path] = {}
+        self._documents: dict[tuple[Hashable, bytes], tuple[Any, Any]] = {}
+        self._after_flush: list[Callable[[], None]] = []
+
+    def _original(self, path: Path) -> bytes | None:
+        """Get the disk content of a file, reading it once"""
+        if path not in self._originals:
+            self._originals[path] = path.read_bytes() if path.is_file() else ABSENT
+        return self._originals[path]
+
+    def is_file(self, path: Path) -> bool:
+        """Check a file exists, in memory or on disk"""
+        path = normalized(path)
+        with self._lock:
+            return path in self._files or path.is_file()
+
+    def glob(self, root: Path, pattern: str) -> list[Path]:
+        """List the files in memory under root matching a glob pattern, sorted"""
+        root = normalized(root)
+        pattern_parts = Path(pattern).parts
+        with self._lock:
+            paths = list(self._files)
+        under_root = [path for path in paths if path.is_relative_to(root)]
+        return sorted(
+            path
+            for path in under_root
+            if glob_match(path.relative_to(root).parts, pattern_parts)
+        )
+
+    def read_bytes(self, path: Path) -> bytes:
+        """Read a file's current content, from memory or else disk"""
+        path = normalized(path)
+        with self._lock:
+            content = self._files.get(path)
+            if content is None:
+                content = self._original(path)
+                if content is ABSENT:
+                    raise FileNotFoundError(path)
+                self._files[path] = content
+            return content
+
+    def write_bytes(self, path: Path, content: bytes, mode_from: Path | None = None):
+        """Set a file's content in memory, given the file to copy its mode from"""
+        path = normalized(path)
+        with self._lock:
+            self._original(path)  # To tell later whether the file changed
+            self._files[path] = content
+            if mode_from is not None:
+                self._modes[path] = mode_from
+
+    def changed(self) -> list[Path]:
+        """List the files whose content in memory differs from disk, sorted"""
+        with self._lock:
+            return sorted(
+                path
+                for path, content in self._files.items()
+                if content != self._originals[path]
+            )
+
+    def after_flush(self, callback: Callable[[], None]):
+        """Call a function once the files are flushed to disk, never if not"""
+        with self._lock:
+            self._after_flush.append(callback)
+
+    def flush(self) -> list[Path]:
+        """Write the changed files to disk, returning their paths
+
+        Then calls the functions given to {py:meth}`after_flush`, in order.
+        """
+        changed = self.changed()
+        for path in changed:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(self._files[path])
+            if path in self._modes:
+                shutil.copymode(self._modes[path], path)
+        with self._lock:
+            for path in changed:
+                self._originals[path] = self._files[path]
+            callbacks, self._after_flush = self._after_flush, []
+        for callback in callbacks:
+            callback()
+        return changed
+
+    def keep_document(self, kind: Hashable, content: bytes, data: Any, formatting: Any):
+        """Keep a data-tree loaded by given kind of loader, for the next load
+
+        The content is what the data-tree dumps to. The data-tree must not be
+        edited further after this.
+        """
+        with self._lock:
+            self._documents[(kind, sha256(content).digest())] = (data, formatting)
+
+    def take_document(self, kind: Hashable, content: bytes) -> tuple[Any, Any] | None:
+        """Get the data-tree kept for given kind of loader and content, if any
+
+        The data-tree is handed over, not shared: it can be edited in place.
+        """
+        with self._lock:
+            return self._documents.pop((kind, sha256(content).digest()), None)
+
+
+CURRENT: ContextVar[FileOverlay | None] = ContextVar("overlay", default=None)
+"""The overlay of the drivers being chained, if any"""
+
+
+def normalized(path: Path) -> Path:
+    """Make a path absolute and resolved, to key files whatever the way to them"""
+    return path.resolve()
+
+
+def is_file(path: Path) -> bool:
+    """Check a file exists, in the current overlay if any, or else on disk"""
+    overlay = CURRENT.get()
+    if overlay is None:
+        return path.is_file()
+    return overlay.is_file(path)
+
+
+def glob(root: Path, pattern: str) -> list[Path]:
+    """List the files under root matching a glob pattern, sorted
+
+    Includes the files of the current overlay if any, like ones created by
+    earlier drivers, given under root as on disk.
+    """
+    on_disk = {path for path in root.glob(pattern) if path.is_file()}
+    overlay = CURRENT.get()
+    if overlay is None:
+        return sorted(on_disk)
+    resolved_root = normalized(root)
+    in_memory = {
+        root / path.relative_to(resolved_root) for path in overlay.glob(root, pattern)
+    }
+    return sorted(on_disk | in_memory)
+
+
+def glob_match(parts: tuple[str, ...], pattern_parts: tuple[str, ...]) -> bool:
+    """Check a relative path's parts match a glob pattern's, as by Path.glob
+
+    >>> glob_match(("a", "b", "c.yml"), ("**", "*.yml"))
+    True
+    >>> glob_match(("c.yml",), ("a", "*.yml"))
+    False
+    """
+    if not pattern_parts:
+        return not parts
+    head, rest = pattern_parts[0], pattern_parts[1:]
+    if head == "**":
+        return any(glob_match(parts[i:], rest) for i in range(len(parts) + 1))
+    if not parts or not fnmatch.fnmatchcase(parts[0], head):
+        return False
+    return glob_match(parts[1:], rest)
+
+
+def after_flush(callback: Callable[[], None]):
+    """Call a function once files are on disk: now, or after the overlay's flush"""
+    overlay = CURRENT.get()
+    if overlay is None:
+        callback()
+    else:
+        overlay.after_flush(callback)
+
+
+def read_bytes(path: Path) -> bytes:
+    """Read a file, from the current overlay if any, or else from disk"""
+    overlay = CURRENT.get()
+    if overlay is None:
+        return path.read_bytes()
+    return overlay.read_bytes(path)
+
+
+def write_bytes(path: Path, content: bytes):
+    """Write a file, to the current overlay if any, or else to disk"""
+    overlay = CURRENT.get()
+    if overlay is None:
+        path.write_bytes(content)
+    else:
+        overlay.write_bytes(path, content)
@@ -0,0 +1,171 @@
+"""Chain several drivers over a repo, as a single migration"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any
+
+from mass_driver.models.patchdriver import PatchDriver, PatchOutcome, PatchResult
+from mass_driver.models.repository import ClonedRepo
+from pydantic import BaseModel, validator
+
+from mass_driver_plugins import overlay
+from mass_driver_plugins.dryrun import get_driver
+from mass_driver_plugins.jsonpatch import JsonPatchBase
+from mass_driver_plugins.metrics import InstrumentedDriver, instrumented
+from mass_driver_plugins.poetry_surgical import PoetrySurgical
+from mass_driver_plugins.surgical import SurgicalFileEditor
+from mass_driver_plugins.template import TemplatedFile
+
+OVERLAY_DRIVERS = (JsonPatchBase, PoetrySurgical, SurgicalFileEditor, TemplatedFile)
+"""The drivers reading and writing files through the overlay, allowed as steps
+
+Other drivers would write straight to disk, to be overwritten by the flush.
+"""
+
+
+class PipelineStep(BaseModel):
+    """One driver of a pipeline, with its config"""
+
+    driver: str
+    """The driver's entry point name, as listed by mass-driver-plugins"""
+    driver_config: dict[str, Any] = {}
+    """The driver's config, as it would be given to the driver alone"""
+
+    _patch_driver: PatchDriver | None = None
+    """The driver built from config, on validation"""
+
+    class Config:
+        """Pydantic config of the PipelineStep class"""
+
+        underscore_attrs_are_private = True
+        """Keep the built driver out of the fields"""
+
+    def build(self) -> PatchDriver:
+        """Get the step's driver, building it from config once"""
+        if self._patch_driver is None:
+            self._patch_driver = step_driver(self)
+        return self._patch_driver
+
+
+class Pipeline(InstrumentedDriver):
+    """Run many drivers one after the other, as a single migration
+
+    Each of the {py:attr}`steps` runs over the repo in order, over an in-memory
+    {py:class}`mass_driver_plugins.overlay.FileOverlay`: a step reads what the
+    previous steps wrote, without touching the disk. The tree-sitter trees and
+    loaded JSON/YAML documents of a step's output are handed to the next step
+    over that same content, skipping their parsing. Only drivers going through
+    the overlay can be steps, see {py:data}`OVERLAY_DRIVERS`.
+
+    Once all steps ran, the files whose content changed are written to disk in
+    one pass. The combined outcome is ALREADY_PATCHED when no file changed in
+    the end, even if steps changed files back and forth. On the first step
+    failing with PATCH_ERROR, the pipeline stops, and nothing is written: steps
+    also hold off side effects like recording fingerprints until the files are
+    written, see {py:func}`mass_driver_plugins.overlay.after_flush`.
+
+    Here's bumping pytest, then templating a file:
+
+    .. code-block:: toml
+
+        [[steps]]
+        driver = "poetry-surgical"
+        driver_config = {package = "pytest", target = "8.*", package_group = "test"}
+
+        [[steps]]
+        driver = "templater"
+        driver_config = {target_file = "VERSION", template = "{{ version }}"}
+    """
+
+    steps: list[PipelineStep]
+    """The drivers to run, in order"""
+
+    _drivers: list[PatchDriver] | None = None
+    """The drivers of each step, built on first run"""
+
+    @validator("steps")
+    def check_steps(cls, steps: list[PipelineStep]) -> list[PipelineStep]:
+        """Ensure there are steps, and each step's config is valid for its driver"""
+        if not steps:
+            raise ValueError("At least one step is needed")
+        for step in steps:
+            step.build()  # Raises on bad config
+        return steps
+
+    @property
+    def drivers(self) -> list[PatchDriver]:
+        """Get the driver of each step, building them once"""
+        if self._drivers is None:
+            drivers = []
+            for index, step in enumerate(self.steps, start=1):
+                driver = step.build()
+                driver._logger = self.logger.getChild(f"{index}.{step.driver}")
+                drivers.append(driver)
+            self._drivers = drivers
+        return self._drivers
+
+    @instrumented
+    def run(self, repo: ClonedRepo) -> PatchResult:
+        """Run each step over the repo's files in memory, then write the changes"""
+        layer = overlay.FileOverlay()
+        results = []
+        token = overlay.CURRENT.set(layer)
+        try:
+            for index, (step, driver) in enumerate(zip(self.steps, self.drivers)):
+                label = f"{index + 1}. {step.driver}"
+                try:
+                    result = driver.run(repo)
+                except Exception as e:
+                    self.logger.exception(e)
+                    result = PatchResult(
+                        outcome=PatchOutcome.PATCH_ERROR,
+                        details=f"Unhandled exception in step. Error was: {e}",
+                    )
+                results.append((label, result))
+                if result.outcome == PatchOutcome.PATCH_ERROR:
+                    details = step_details(results)
+                    return PatchResult(
+                        outcome=PatchOutcome.PATCH_ERROR,
+                        details=f"Step {label} failed, no change written\n{details}",
+                    )
+        finally:
+            overlay.CURRENT.reset(token)
+        changed = layer.flush()
+        repo_path = overlay.normalized(Path(repo.cloned_path))
+        details = step_details(results)
+        if changed:
+            self.logger.info(f"Wrote {len(changed)} changed files")
+            files = "\n".join(str(path.relative_to(repo_path)) for path in changed)
+            return PatchResult(
+                outcome=PatchOutcome.PATCHED_OK,
+                details=f"{details}\nChanged files:\n{files}",
+            )
+        outcome = PatchOutcome.ALREADY_PATCHED
+        if all(r.outcome == PatchOutcome.PATCH_DOES_NOT_APPLY for _, r in results):
+            outcome = PatchOutcome.PATCH_DOES_NOT_APPLY
+        return PatchResult(outcome=outcome, details=details)
+
+
+def step_driver(step: PipelineStep) -> PatchDriver:
+    """Build a step's driver from its config"""
+    try:
+        driver_class = get_driver(step.driver)
+    except ImportError as e:
+        raise ValueError(str(e)) from e
+    if not issubclass(driver_class, OVERLAY_DRIVERS):
+        raise ValueError(
+            f"Driver {step.driver} can't be a pipeline step: "
+            "it doesn't write files through the overlay"
+        )
+    return driver_class.parse_obj(step.driver_config)
+
+
+def step_details(results: list[tuple[str, PatchResult]]) -> str:
+    """Describe each step's outcome, with its details indented"""
+    lines = []
+    for label, result in results:
+        lines.append(f"{label}: {result.outcome.value}")
+        if result.details:
+            lines.extend(f"    {line}" for line in result.details.splitlines())
+    return "\n".join(lines)
@@ -1,14 +1,38 @@
 """Poetry package version bump"""
 
-from copy import deepcopy
+from __future__ import annotations
+
+import json
+import re
+import tomllib
+from enum import Enum
+from hashlib import sha256
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
 
 from mass_driver.drivers.bricks import SingleFileEditor
 from mass_driver.models.patchdriver import PatchOutcome, PatchResult
-from tree_sitter import Node, Parser
-from tree_sitter_languages import get_language
+from mass_driver.models.repository import ClonedRepo
+from pydantic import root_validator
+
+from mass_driver_plugins import metrics, overlay
+from mass_driver_plugins.memo import Memoized, MemoizingDriver
+from mass_driver_plugins.metrics import instrumented
+from mass_driver_plugins.splice import Edit, apply_edits
+from mass_driver_plugins.treesitter import REGISTRY
+
+if TYPE_CHECKING:
+    from tree_sitter import Node
+
+
+TABLES_QUERY = """
+    (table [(bare_key) (quoted_key) (dotted_key)] @k
+        (pair) @p) @t
+    """
+"""Query of each pair of each TOML table, for {py:func}`table_index`"""
 
 
-class PoetrySurgical(SingleFileEditor):
+class PoetrySurgical(SingleFileEditor, MemoizingDriver):
     """Bump a package's major version in the pyproject.toml via Surgical editing
 
     Using the following:
@@ -23,120 +47,551 @@ class PoetrySurgical(SingleFileEditor):
         -pytest = "7.*"
         +pytest = "8.*"
     ```
+
+    Many packages can be bumped at once, from a single parse of the file, via
+    `packages` (in `package_group`) or `group_packages` (per group):
+
+    ```python
+        Poetry(
+            packages={"mass-driver": "^0.20", "jsonpatch": "^1.33"},
+            group_packages={"test": {"pytest": "8.*", "pytest-cov": "5.*"}},
+        )
+    ```
+
+    Besides Poetry's `pkg = "1.2"` pairs, `pkg = {version = "1.2", ...}` tables
+    and PEP 621 `dependencies = ["pkg>=1.2"]` arrays are edited too, see
+    {py:class}`DependencyIndex`. For the latter, targets are converted from
+    Poetry syntax to PEP 440 (`^1.2` becomes `>=1.2,<2.0`). Groups map to
+    `project.optional-dependencies` and `dependency-groups` keys.
+
+    With `instrument = true`, the time spent on each phase (including `lock`
+    refreshing) is recorded, see {py:mod}`mass_driver_plugins.metrics`. With
+    `memoize = true`, a pyproject.toml identical to one already bumped gets the
+    same edits without parsing, see {py:mod}`mass_driver_plugins.memo`. The
+    lock file is still checked per repo.
     """
 
     language: str = "toml"
 
     target_file: str = "pyproject.toml"
     # DEBUG via website: https://tree-sitter.github.io/tree-sitter/playground
-    query: str = """
-    (table (dotted_key (dotted_key)) @k
-        (pair) @p) @t
-    """
+    query: str = TABLES_QUERY
 
-    package: str
+    package: str | None = None
     """The target package to update major version for"""
-    target: str
+    target: str | None = None
     """Major version to which to upgrade the package if possible"""
     package_group: str | None = None
     """Package group if any(as defined in poetry>1.2) where to find package"""
+    packages: dict[str, str] = {}
+    """Many packages to bump at once, in package_group: package name -> target"""
+    group_packages: dict[str, dict[str, str]] = {}
+    """Many packages to bump at once, per group: group -> package name -> target"""
+    update_lock: bool = False
+    """Also refresh the lock file's content-hash, offline, if locked versions fit"""
+    lock_file: str = "poetry.lock"
+    """The Poetry lock file to refresh, when update_lock is set"""
+
+    @root_validator(skip_on_failure=True)
+    def check_some_package(cls, values):
+        """Ensure at least one package is given, and package comes with target"""
+        if (values.get("package") is None) != (values.get("target") is None):
+            raise ValueError("package and target must be given together")
+        package_fields = ["package", "packages", "group_packages"]
+        if not any(values.get(field) for field in package_fields):
+            raise ValueError("One of package, packages or group_packages is needed")
+        return values
 
     @property
     def dependency_key(self) -> str:
         """Get the the dependencies key"""
-        pkg_group = f".group.{self.package_group}" if self.package_group else ""
-        return f"tool.poetry{pkg_group}.dependencies"
+        return dependency_key(self.package_group)
 
-    def process_file(self, content_str: str) -> str | PatchResult:
-        """Process the file"""
-        language = get_language(self.language)
-        query = language.query(self.query)
-        parser = Parser()
-        parser.set_language(language)
-        tree = parser.parse(to_bytes(content_str))
-        captures = query.captures(tree.root_node)
-        dep_pairs = self.treesitter_query(captures, query, tree)
-        if not dep_pairs:
-            self.logger.error("No target found for replacement")
+    @property
+    def bumps(self) -> list["PackageBump"]:
+        """List all the requested bumps, across groups"""
+        bumps = []
+        if self.package is not None and self.target is not None:
+            bumps.append(PackageBump(self.package_group, self.package, self.target))
+        for package, target in self.packages.items():
+            bumps.append(PackageBump(self.package_group, package, target))
+        for group, group_packages in self.group_packages.items():
+            for package, target in group_packages.items():
+                bumps.append(PackageBump(group, package, target))
+        return bumps
+
+    @instrumented
+    def run(self, repo: ClonedRepo) -> PatchResult:
+        """Edit the target file, as raw bytes to keep line endings intact"""
+        target_fullpath = Path(repo.cloned_path) / self.target_file
+        if not overlay.is_file(target_fullpath):
             return PatchResult(
                 outcome=PatchOutcome.PATCH_DOES_NOT_APPLY,
-                details=f"Did not find the TOML section '{self.dependency_key}'",
+                details="Target file does not exist",
             )
-        to_replace_node = self.find_package(dep_pairs)
-        if to_replace_node is None:
+        content_before = metrics.read_bytes(target_fullpath)
+        try:
+            content_after, bump_outcomes = self.bump_memoized(content_before)
+        except Exception as e:
+            self.logger.exception(e)
             return PatchResult(
-                outcome=PatchOutcome.PATCH_DOES_NOT_APPLY,
-                details=f"Did not find package '{self.package}' in '{self.dependency_key}'",
-            )
-        edited_content = surgical_edit(content_str, self.target, to_replace_node)
-        return edited_content
-
-    def treesitter_query(self, captures, query, tree) -> list[Node]:
-        """Search the tree for compatible node = pairs"""
-        self.logger.info(f"Got {len(captures)} raw captures")
-        # First grab all the surrounding table offsets
-        table_ranges_set = set(
-            [(n.start_point, n.end_point) for n, name in captures if name == "t"]
-        )
-        # And then query in depth for each of the tables one by one, scoped
-        # Look for the k where it matches
-        dep_pairs = []
-        for tbl_start, tbl_end in sorted(list(table_ranges_set)):
-            scoped_captures = query.captures(
-                tree.root_node,
-                start_point=tbl_start,
-                end_point=tbl_end,
-            )
-            k_set = set([n.text for n, v in scoped_captures if v == "k"])
-            k = k_set.pop()
-            if k != to_bytes(self.dependency_key):
-                continue  # Not the proper key
-            dep_pairs = [n for n, v in scoped_captures if v == "p"]
-            self.logger.info(
-                f"Found key for table at range [{tbl_start[0]},{tbl_end[0]}], key='{k}', pairs: {[i.text for i in dep_pairs]}"
+                outcome=PatchOutcome.PATCH_ERROR,
+                details=f"Error processing single file, error was {e}",
             )
-            break  # This is the right pair, stop looking
-        return dep_pairs
-
-    def find_package(self, deps: list[Node]) -> Node | None:
-        """Find the target package node, given all dep pairs"""
-        target = None
-        for node in deps:
-            # In simple cases, we have the toml of:
-            # package_name = '1.2.3'     equivalent to:
-            # n.children[0] = n.children[2]
-            pkg_node = node.children[0]
-            if pkg_node.text != to_bytes(self.package):
+        result = bump_result(bump_outcomes)
+        if content_after != content_before:
+            metrics.write_bytes(target_fullpath, content_after)
+        if self.update_lock and result.outcome != PatchOutcome.PATCH_DOES_NOT_APPLY:
+            lock_fullpath = Path(repo.cloned_path) / self.lock_file
+            try:
+                return self.refresh_lock(
+                    lock_fullpath, content_after, bump_outcomes, result
+                )
+            except Exception as e:
+                # pyproject.toml is already bumped: flag the lock, don't fail
+                self.logger.exception(e)
+                return add_details(
+                    result, f"{self.lock_file}: re-lock needed: failed to refresh: {e}"
+                )
+        return result
+
+    def refresh_lock(
+        self,
+        lock_fullpath: Path,
+        pyproject: bytes,
+        bump_outcomes: dict[str, "BumpOutcome"],
+        result: PatchResult,
+    ) -> PatchResult:
+        """Update the lock's content-hash, unless a re-lock is really needed
+
+        Runs no solver: if each bumped package's locked version still satisfies
+        its new constraint, the lock stays valid, only its hash of pyproject's
+        relevant content is stale, and is recomputed in-process. Otherwise, the
+        repo is flagged as needing a re-lock in the details.
+        """
+        if not overlay.is_file(lock_fullpath):
+            return add_details(result, f"{self.lock_file}: not found, skipped")
+        lock_content = metrics.read_bytes(lock_fullpath)
+        with metrics.phase("lock"):
+            lock_data = tomllib.loads(lock_content.decode("utf-8"))
+            locked_versions = {
+                normalize_name(package["name"]): package["version"]
+                for package in lock_data.get("package", [])
+            }
+        stale = []
+        from poetry.core.constraints.version import Version, parse_constraint
+
+        for bump in self.bumps:
+            if bump_outcomes[bump.label] == BumpOutcome.NOT_FOUND:
                 continue
-            target = node.children[2]
-            self.logger.info(f"Found dep {self.package}, with value {target.text}")
-        return target
+            locked = locked_versions.get(normalize_name(bump.package))
+            if locked is None:
+                stale.append(f"{bump.package} not locked")
+            elif not parse_constraint(bump.target).allows(Version.parse(locked)):
+                stale.append(
+                    f"{bump.package} locked at {locked}, outside {bump.target}"
+                )
+        if stale:
+            self.logger.warning(f"Lock needs re-locking: {stale}")
+            return add_details(
+                result, f"{self.lock_file}: re-lock needed: {', '.join(stale)}"
+            )
+        with metrics.phase("lock"):
+            pyproject_data = tomllib.loads(pyproject.decode("utf-8"))
+            new_lock = set_content_hash(lock_content, content_hash(pyproject_data))
+        if new_lock == lock_content:
+            return result
+        metrics.write_bytes(lock_fullpath, new_lock)
+        return add_details(
+            PatchResult(outcome=PatchOutcome.PATCHED_OK, details=result.details),
+            f"{self.lock_file}: content-hash updated",
+        )
+
+    def process_file(self, content_str: str) -> str | PatchResult:
+        """Process the file as text, see {py:meth}`process_bytes`"""
+        process_output = self.process_bytes(to_bytes(content_str))
+        if isinstance(process_output, PatchResult):
+            return process_output
+        return process_output.decode("utf-8")
+
+    def process_bytes(self, content: bytes) -> bytes | PatchResult:
+        """Process the file's raw bytes, returning a PatchResult if unchanged"""
+        content_after, bump_outcomes = self.bump_memoized(content)
+        if content_after == content:
+            return bump_result(bump_outcomes)
+        return content_after
+
+    def bump_memoized(self, content: bytes) -> tuple[bytes, dict[str, "BumpOutcome"]]:
+        """Bump all packages, reusing the result of identical content if memoizing"""
+
+        def bump(raw: bytes) -> Memoized:
+            content_after, outcomes = self.bump_packages(raw)
+            note = {label: outcome.value for label, outcome in outcomes.items()}
+            return Memoized(content_after, note)
+
+        result = self.memoized(content, bump)
+        outcomes = {label: BumpOutcome(value) for label, value in result.note.items()}
+        return result.content, outcomes
+
+    def bump_packages(self, content: bytes) -> tuple[bytes, dict[str, "BumpOutcome"]]:
+        """Bump all packages from a single parse, applying all edits at once
+
+        Returns the new content and each package's outcome, labelled by name
+        (prefixed with group if any).
+        """
+        document = REGISTRY.document(self.language, content)
+        matches = document.matches(self.query)
+        with metrics.phase("refine"):
+            index = DependencyIndex.from_tables(table_index(matches))
+            edits: list[Edit] = []
+            outcomes = {}
+            for bump in self.bumps:
+                label = bump.label
+                pins = index.lookup(bump.group, bump.package)
+                if not pins:
+                    self.logger.error(f"No target found for '{label}'")
+                    outcomes[label] = BumpOutcome.NOT_FOUND
+                    continue
+                found = [pin.node.text for pin in pins]
+                self.logger.info(f"Found dep {label}, with {found}")
+                pin_edits = [pin_edit(pin, bump.target) for pin in pins]
+                if not any(pin_edits):
+                    outcomes[label] = BumpOutcome.ALREADY_AT_TARGET
+                    continue
+                edits.extend(edit for edit in pin_edits if edit is not None)
+                outcomes[label] = BumpOutcome.PATCHED
+        document.apply(edits)
+        REGISTRY.remember(document)
+        return document.content, outcomes
+
+
+class PackageBump(NamedTuple):
+    """A single package to bump, within its dependency group"""
+
+    group: str | None
+    """Package group (as defined in poetry>1.2), None for main dependencies"""
+    package: str
+    """The package name"""
+    target: str
+    """The version spec to set"""
+
+    @property
+    def label(self) -> str:
+        """Name the bump by package, prefixed with group if any"""
+        return f"{self.group}:{self.package}" if self.group else self.package
+
+
+class BumpOutcome(str, Enum):
+    """The result of bumping a single package"""
+
+    PATCHED = "patched"
+    """The package's spec was changed to target"""
+    ALREADY_AT_TARGET = "already at target"
+    """The package's spec already was the target"""
+    NOT_FOUND = "not found"
+    """The package (or its group) is absent from the file"""
+
+
+def bump_result(outcomes: dict[str, BumpOutcome]) -> PatchResult:
+    """Summarize per-package outcomes as a single PatchResult"""
+    details = "\n".join(
+        f"{label}: {outcome.value}" for label, outcome in outcomes.items()
+    )
+    if BumpOutcome.PATCHED in outcomes.values():
+        return PatchResult(outcome=PatchOutcome.PATCHED_OK, details=details)
+    if BumpOutcome.ALREADY_AT_TARGET in outcomes.values():
+        return PatchResult(outcome=PatchOutcome.ALREADY_PATCHED, details=details)
+    return PatchResult(outcome=PatchOutcome.PATCH_DOES_NOT_APPLY, details=details)
+
+
+def add_details(result: PatchResult, line: str) -> PatchResult:
+    """Append a line to a PatchResult's details"""
+    details = f"{result.details}\n{line}" if result.details else line
+    return PatchResult(outcome=result.outcome, details=details)
+
 
+LOCK_CONTENT_HASH = re.compile(rb'^content-hash\s*=\s*"(?P<hash>[0-9a-fA-F]*)"', re.M)
+"""The content-hash line in poetry.lock's [metadata] table"""
 
-def surgical_edit(text, replacement, bad_node: Node) -> str:
+POETRY_HASHED_KEYS = ["dependencies", "source", "extras", "dev-dependencies"]
+"""Keys of [tool.poetry] hashed by Poetry, even when absent (as null)"""
+POETRY_HASHED_OPTIONAL_KEYS = ["group"]
+"""Keys of [tool.poetry] hashed by Poetry, only when present"""
+PROJECT_HASHED_KEYS = ["requires-python", "dependencies", "optional-dependencies"]
+"""Keys of PEP 621 [project] hashed by Poetry, when present"""
+
+
+def content_hash(pyproject_data: dict) -> str:
+    """Compute poetry.lock's content-hash of a parsed pyproject.toml
+
+    Mirrors Poetry's own Locker: a sha256 of the sorted JSON of the relevant
+    parts of the pyproject. For pyprojects without PEP 621 content, the
+    `[tool.poetry]` keys are hashed at top level, for backwards compatibility.
+    """
+    project = pyproject_data.get("project", {})
+    groups = pyproject_data.get("dependency-groups", {})
+    tool_poetry = pyproject_data.get("tool", {}).get("poetry", {})
+    relevant_project = {
+        key: project[key] for key in PROJECT_HASHED_KEYS if project.get(key) is not None
+    }
+    relevant_poetry = {}
+    for key in POETRY_HASHED_KEYS + POETRY_HASHED_OPTIONAL_KEYS:
+        data = tool_poetry.get(key)
+        if data is None and (
+            key in POETRY_HASHED_OPTIONAL_KEYS or relevant_project or groups
+        ):
+            continue
+        relevant_poetry[key] = data
+    relevant: dict = {}
+    if relevant_project:
+        relevant["project"] = relevant_project
+    if groups:
+        relevant["dependency-groups"] = groups
+    if relevant:
+        relevant["tool"] = {"poetry": relevant_poetry}
+    else:
+        relevant = relevant_poetry
+    return sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def set_content_hash(lock_content: bytes, new_hash: str) -> bytes:
+    """Splice a new content-hash into poetry.lock's content"""
+    match = LOCK_CONTENT_HASH.search(lock_content)
+    if match is None:
+        raise ValueError("No content-hash found in lock file")
+    start, end = match.span("hash")
+    return apply_edits(lock_content, [Edit(start, end, to_bytes(new_hash))])
+
+
+def dependency_key(package_group: str | None) -> str:
+    """Get the dependencies table key of given package group
+
+    >>> dependency_key("test")
+    'tool.poetry.group.test.dependencies'
+    """
+    pkg_group = f".group.{package_group}" if package_group else ""
+    return f"tool.poetry{pkg_group}.dependencies"
+
+
+def unquote(value: bytes) -> bytes:
+    """Strip the quotes around a TOML string value"""
+    return value.strip(b"\"'")
+
+
+class DependencyForm(str, Enum):
+    """The ways a dependency's version can be written in pyproject.toml"""
+
+    VERSION_STRING = "version string"
+    """Poetry's `pkg = "1.2.3"`"""
+    VERSION_TABLE = "version table"
+    """Poetry's `pkg = {version = "1.2.3", ...}` or `[...dependencies.pkg]` table"""
+    PEP508 = "PEP 508 string"
+    """PEP 621's `dependencies = ["pkg>=1.2.3"]`"""
+
+
+class DependencyPin(NamedTuple):
+    """A single dependency's version, as found in pyproject.toml"""
+
+    name: str
+    """Package name as written in the file"""
+    form: DependencyForm
+    """Which way the version is written"""
+    node: Node
+    """The TOML string node holding the version (or whole requirement)"""
+
+
+class DependencyIndex:
+    """All dependency pins of a pyproject.toml, by (group, normalized name)
+
+    Covers Poetry's `tool.poetry[.group.X].dependencies` in both version string
+    and version table forms, as well as PEP 621's `project.dependencies` and
+    `project.optional-dependencies.X` and PEP 735's `dependency-groups.X`.
+    Names are normalized per PEP 503, so lookups are a single dict access.
+    """
+
+    def __init__(self):
+        """Start with no dependencies"""
+        self.pins: dict[tuple[str | None, str], list[DependencyPin]] = {}
+        """Each (group, normalized name)'s pins, possibly in several forms"""
+
+    def lookup(self, group: str | None, package: str) -> list[DependencyPin]:
+        """Find all pins of given package in given group (None for main)"""
+        return self.pins.get((group, normalize_name(package)), [])
+
+    def add(self, group: str | None, name: str, form: DependencyForm, node: Node):
+        """Record a package's pin"""
+        pin = DependencyPin(name, form, node)
+        self.pins.setdefault((group, normalize_name(name)), []).append(pin)
+
+    @classmethod
+    def from_tables(cls, tables: dict[str, list[Node]]) -> "DependencyIndex":
+        """Build the index from a table index, in a single pass over tables"""
+        index = cls()
+        for table_key, pairs in tables.items():
+            if match := POETRY_DEPS_TABLE.fullmatch(table_key):
+                group = match["group"]
+                if match["package"] is None:
+                    for pair in pairs:
+                        index.add_poetry_pair(group, pair)
+                    continue
+                # Sub-table [tool.poetry.dependencies.pkg], with a version key
+                version = find_pair(pairs, "version")
+                if version is not None and version.type == "string":
+                    package = unquote(to_bytes(match["package"])).decode("utf-8")
+                    index.add(group, package, DependencyForm.VERSION_TABLE, version)
+            elif table_key == "project":
+                dependencies = find_pair(pairs, "dependencies")
+                if dependencies is not None:
+                    index.add_pep508_array(None, dependencies)
+            elif table_key in ("project.optional-dependencies", "dependency-groups"):
+                for pair in pairs:
+                    group = unquote(pair.children[0].text).decode("utf-8")
+                    index.add_pep508_array(group, pair.children[2])
+        return index
+
+    def add_poetry_pair(self, group: str | None, pair: Node):
+        """Record a Poetry `pkg = ...` pair, if it pins a version"""
+        name = unquote(pair.children[0].text).decode("utf-8")
+        value = pair.children[2]
+        if value.type == "string":
+            self.add(group, name, DependencyForm.VERSION_STRING, value)
+        elif value.type == "inline_table":
+            inline_pairs = [n for n in value.children if n.type == "pair"]
+            version = find_pair(inline_pairs, "version")
+            if version is not None and version.type == "string":
+                self.add(group, name, DependencyForm.VERSION_TABLE, version)
+
+    def add_pep508_array(self, group: str | None, array: Node):
+        """Record each versionable requirement string of a PEP 621 array"""
+        if array.type != "array":
+            return
+        for element in array.children:
+            if element.type != "string":
+                continue  # Punctuation, or PEP 735 include-group tables
+            requirement = PEP508_REQUIREMENT.fullmatch(toml_string_content(element))
+            if requirement is None or (requirement["rest"] or "").lstrip().startswith(
+                "@"
+            ):
+                continue  # Unparseable, or direct URL reference: no version
+            self.add(group, requirement["name"], DependencyForm.PEP508, element)
+
+
+POETRY_DEPS_TABLE = re.compile(
+    r"tool\.poetry(\.group\.(?P<group>[^.]+))?\.dependencies(\.(?P<package>.+))?"
+)
+"""Poetry dependency table keys, capturing group and sub-table package name"""
+
+PEP508_REQUIREMENT = re.compile(
+    r"\s*(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)"
+    r"(?P<extras>\s*\[[^\]]*\])?"
+    r"(?P<specifier>[^;@]*?)"
+    r"(?P<rest>\s*[;@].*)?",
+    re.DOTALL,
+)
+"""A PEP 508 requirement, split around its version specifier"""
+
+
+def normalize_name(name: str) -> str:
+    """Normalize a package name as per PEP 503
+
+    >>> normalize_name("Ruamel_.YAML")
+    'ruamel-yaml'
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def pep440_specifier(target: str) -> str:
+    """Convert a Poetry version constraint into a PEP 440 specifier set
+
+    >>> pep440_specifier("^0.18")
+    '>=0.18,<0.19'
+    >>> pep440_specifier(">=8")
+    '>=8'
+    """
+    from poetry.core.packages.dependency import Dependency
+
+    pep508 = Dependency("placeholder", target).base_pep_508_name
+    _name, _sep, specifier = pep508.partition(" ")
+    return specifier.strip("()")
+
+
+def pin_edit(pin: DependencyPin, target: str) -> Edit | None:
+    """Build the edit setting pin to target, None if already there"""
+    if pin.form != DependencyForm.PEP508:
+        if unquote(pin.node.text) == to_bytes(target):
+            return None
+        return version_edit(target, pin.node)
+    # PEP 508: Swap only the specifier, keeping name, extras and markers
+    content = toml_string_content(pin.node)
+    requirement = PEP508_REQUIREMENT.fullmatch(content)
+    assert requirement is not None, "Indexed requirements are parseable"
+    specifier = pep440_specifier(target)
+    if requirement["specifier"].replace(" ", "") == specifier:
+        return None
+    spec_start, spec_end = requirement.span("specifier")
+    # Keep any whitespace between name and specifier as-is
+    spec_start += len(requirement["specifier"]) - len(requirement["specifier"].lstrip())
+    replaced = "".join([content[:spec_start], specifier, content[spec_end:]])
+    quote_length = (len(pin.node.text) - len(to_bytes(content))) // 2
+    quotes = pin.node.text[:quote_length]
+    new_string = quotes + to_bytes(replaced) + quotes
+    return Edit(pin.node.start_byte, pin.node.end_byte, new_string)
+
+
+def find_pair(pairs: list[Node], key: str) -> Node | None:
+    """Find the value of the pair with given key, among TOML pairs"""
+    for pair in pairs:
+        if unquote(pair.children[0].text) == to_bytes(key):
+            return pair.children[2]
+    return None
+
+
+def toml_string_content(node: Node) -> str:
+    """Get the inner text of a TOML string node, without its quotes"""
+    text = node.text.decode("utf-8")
+    quotes = 3 if text[:3] in ('"""', "'''") else 1
+    return text[quotes:-quotes]
+
+
+def table_index(matches: list[tuple[int, dict[str, Node]]]) -> dict[str, list[Node]]:
+    """Index the pairs of each TOML table by dotted table key, in a single pass
+
+    Each query match is one (table key, pair) combination, so walking matches
+    once builds the whole index, rather than re-querying each table's range.
+    """
+    tables: dict[str, list[Node]] = {}
+    for _pattern, captures in matches:
+        if "k" not in captures or "p" not in captures:
+            continue  # Partial match, filtered out by predicates
+        key = captures["k"].text.decode("utf-8")
+        tables.setdefault(key, []).append(captures["p"])
+    return tables
+
+
+def surgical_edit(text: str, replacement: str, bad_node: Node) -> str:
     """Surgically edit the file to fix the badness
 
-    In this case, we build a mutated line by using just the value we want,
-    interpolated around the rest of the line.
+    In this case, we splice just the value's byte range with the value we
+    want, leaving the rest of the file byte-for-byte identical.
 
     Particular attention is given to both beginning and end of original
     line, which could be housing some comments, which we don't want to edit.
     """
-    mutated_lines = deepcopy(text).splitlines()
     # Visualisation of old content:
-    #      stuff: value
-    #             ^   ^
-    #             b0  b1   [b0, b1] is bad_node start/end line/column
-    b0_line, b0_col = bad_node.start_point
-    b1_line, b1_col = bad_node.end_point
-    bad_line = mutated_lines[b0_line]
+    #      stuff = "value"
+    #              ^      ^
+    #              b0     b1   [b0, b1) is bad_node's byte range
     # New value
-    #    key: REPLACEMENT
-    #         ^          ^
-    # up to b0[          [b1 onwards
-    replaced_line = bad_line[:b0_col] + f'"{replacement}"' + bad_line[b1_col:]
-    mutated_lines[b0_line] = replaced_line
-    return "\n".join(mutated_lines) + "\n"
+    #    key = "REPLACEMENT"
+    #          ^            ^
+    # up to b0[             [b1 onwards
+    content = text.encode("utf-8")
+    return apply_edits(content, [version_edit(replacement, bad_node)]).decode("utf-8")
+
+
+def version_edit(replacement: str, bad_node: Node) -> Edit:
+    """Build the edit replacing bad_node with the quoted replacement version"""
+    return Edit(bad_node.start_byte, bad_node.end_byte, to_bytes(f'"{replacement}"'))
 
 
 def to_bytes(content: str):
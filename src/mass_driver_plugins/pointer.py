@@ -0,0 +1,364 @@
+r"""Resolve JSON Pointers to byte ranges of JSON/YAML files, for surgical patching
+
+Rather than loading the whole data-tree and dumping it all back, each JSON
+Patch (RFC6902) operation is resolved against the file's tree-sitter tree, down
+to the byte range of the targeted value. Only that range is spliced, so the
+cost grows with the size of the patch, not the document. Everything outside
+of the edited ranges (quoting, comments, blank lines) is left as it was.
+
+Operations that can't be done this way raise {py:class}`NotSurgical`, so the
+caller can fall back to a full load/dump. These are `move` and `copy`, `add` in
+the middle of arrays, edits that would drop a YAML anchor or tag, block scalars,
+multi-document YAML streams, and failing `test` operations (so the error
+message comes from the full patch). Tests compare values with
+{py:func}`same_document`, stricter than the full patch: `1` doesn't pass for
+`true`, nor `1.0` for `1`, falling back instead.
+
+>>> from mass_driver_plugins.treesitter import REGISTRY
+>>> document = REGISTRY.document("yaml", b"a: 'x'  # keep\nb: [1, 2]\n")
+>>> splice_operation(document, {"op": "replace", "path": "/a", "value": "y"}, YAML)
+>>> splice_operation(document, {"op": "add", "path": "/c", "value": True}, YAML)
+>>> print(document.content.decode(), end="")
+a: 'y'  # keep
+b: [1, 2]
+c: true
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import re
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+from jsonpointer import JsonPointer
+
+from mass_driver_plugins.splice import Edit
+from mass_driver_plugins.treesitter import ParsedDocument
+from mass_driver_plugins.yamlpool import SAFE
+
+if TYPE_CHECKING:
+    from tree_sitter import Node
+
+
+class NotSurgical(Exception):
+    """The operation can't be spliced in: fall back to a full load and dump"""
+
+
+class Member(NamedTuple):
+    """An entry of a mapping or sequence node"""
+
+    entry: Node
+    """The whole entry (key-value pair, sequence item), for removal"""
+    value: Node | None
+    """The value of the entry, None for YAML keys without value"""
+
+
+class Dialect:
+    """How a tree-sitter grammar represents the data-tree of a file"""
+
+    language: str
+    """The tree-sitter grammar name"""
+    mapping_types: frozenset[str]
+    """Node types of mappings"""
+    sequence_types: frozenset[str]
+    """Node types of sequences"""
+
+    def root(self, root_node: Node) -> Node:
+        """Get the (wrapped) value node of the whole document"""
+        raise NotImplementedError("No root function implemented")
+
+    def unwrap(self, node: Node) -> Node:
+        """Get the mapping, sequence or scalar node under any wrapper node"""
+        return node
+
+    def entries(self, container: Node) -> list[Node]:
+        """Get the entries of a mapping or sequence, in order"""
+        return [child for child in container.named_children if child.type != "comment"]
+
+    def member(self, entry: Node, container: Node) -> Member:
+        """Get the entry of a container, with its value"""
+        if container.type in self.mapping_types:
+            return Member(entry, entry.child_by_field_name("value"))
+        return Member(entry, entry)
+
+    def key(self, entry: Node) -> str | None:
+        """Decode the key of a mapping entry"""
+        key = entry.child_by_field_name("key")
+        return None if key is None else json.loads(key.text)
+
+    def value(self, node: Node) -> Any:
+        """Decode the data of a (wrapped) value node"""
+        return json.loads(node.text)
+
+    def render(self, value: Any, old: Node | None) -> bytes:
+        """Encode a value, in the style of the node it replaces if any"""
+        if isinstance(value, float) and not math.isfinite(value):
+            raise NotSurgical("Non-finite float")
+        return json.dumps(value, ensure_ascii=False).encode()
+
+    def find(self, node: Node, token: str) -> Member | None:
+        """Get the member of a (wrapped) container node matching a pointer token"""
+        container = self.unwrap(node)
+        entries = self.entries(container)
+        if container.type in self.mapping_types:
+            for entry in entries:
+                if self.key(entry) == token:
+                    return self.member(entry, container)
+            return None
+        if container.type in self.sequence_types:
+            if not token.isdigit() or int(token) >= len(entries):
+                return None
+            return self.member(entries[int(token)], container)
+        raise NotSurgical(f"Cannot go through {container.type}")
+
+    def removal(self, content: bytes, container: Node, entry: Node) -> Edit:
+        """Get the edit removing an entry of a container, with its separator"""
+        entries = self.entries(container)
+        index = entries.index(entry)
+        if len(entries) == 1:
+            return Edit(entry.start_byte, entry.end_byte, b"")
+        if index + 1 < len(entries):
+            return Edit(entry.start_byte, entries[index + 1].start_byte, b"")
+        return Edit(entries[index - 1].end_byte, entry.end_byte, b"")
+
+    def addition(self, content: bytes, container: Node, key: str, value: Any) -> Edit:
+        """Get the edit adding a new key at the end of a mapping"""
+        entries = self.entries(container)
+        if not entries:
+            raise NotSurgical("Cannot infer the style of an empty mapping")
+        last = entries[-1]
+        last_key = last.child_by_field_name("key")
+        last_value = last.child_by_field_name("value")
+        if last_key is None or last_value is None:
+            raise NotSurgical("Cannot infer the style of a key without value")
+        key_end, value_start = last_key.end_byte, last_value.start_byte
+        key_separator = content[key_end:value_start]
+        last_start = last.start_byte
+        if container.start_point[0] != last.start_point[0]:
+            line_start = content.rfind(b"\n", 0, last_start) + 1
+            crlf = content.endswith(b"\r\n", 0, line_start)
+            newline = b"\r\n" if crlf else b"\n"
+            separator = b"," + newline + content[line_start:last_start]
+        elif len(entries) > 1:
+            previous_end = entries[-2].end_byte
+            separator = content[previous_end:last_start]
+        else:
+            separator = b", "
+        pair = self.render(key, None) + key_separator + self.render(value, None)
+        return Edit(last.end_byte, last.end_byte, separator + pair)
+
+
+class JsonDialect(Dialect):
+    """The tree-sitter JSON grammar"""
+
+    language = "json"
+    mapping_types = frozenset({"object"})
+    sequence_types = frozenset({"array"})
+
+    def root(self, root_node: Node) -> Node:
+        """Get the value node of the whole document"""
+        values = self.entries(root_node)
+        if len(values) != 1:
+            raise NotSurgical("Document without a single value")
+        return values[0]
+
+
+class YamlDialect(Dialect):
+    """The tree-sitter YAML grammar, with ruamel to decode scalars"""
+
+    language = "yaml"
+    mapping_types = frozenset({"block_mapping", "flow_mapping"})
+    sequence_types = frozenset({"block_sequence", "flow_sequence"})
+    block_types = frozenset({"block_mapping", "block_sequence"})
+
+    PLAIN_UNSAFE = re.compile(
+        r"^[-?:,\[\]{}#&*!|>'\"%@`\s]|[\s:]$|: | #|[\n\r\t]"
+        r"|^(y|n|yes|no|on|off|true|false|null|~)$",
+        re.IGNORECASE,
+    )
+    """Strings that can't be written as plain scalars, or would be misread"""
+
+    def load(self, text: bytes) -> Any:
+        """Decode a YAML snippet, with this thread's safe loader"""
+        try:
+            return SAFE.get().load(text)
+        except Exception as e:
+            SAFE.discard()
+            raise NotSurgical(f"Cannot decode {text!r}: {e}")
+
+    def root(self, root_node: Node) -> Node:
+        """Get the (wrapped) value node of the only document of the stream"""
+        documents = [c for c in root_node.named_children if c.type == "document"]
+        if len(documents) != 1:
+            raise NotSurgical("Stream without a single document")
+        values = self.entries(documents[0])
+        if len(values) != 1:
+            raise NotSurgical("Document without a single value")
+        return values[0]
+
+    def unwrap(self, node: Node) -> Node:
+        """Get the mapping, sequence or scalar node under flow/block nodes"""
+        inner = [c for c in self.entries(node) if c.type not in ("anchor", "tag")]
+        if node.type not in ("flow_node", "block_node") or len(inner) != 1:
+            return node
+        if inner[0].type == "alias":
+            raise NotSurgical("Cannot go through an alias")
+        return inner[0]
+
+    def decorated(self, node: Node) -> bool:
+        """Whether a flow/block node carries an anchor or a tag"""
+        return any(c.type in ("anchor", "tag") for c in node.named_children)
+
+    def member(self, entry: Node, container: Node) -> Member:
+        """Get the entry of a container, with its value"""
+        if entry.type == "block_sequence_item":
+            values = self.entries(entry)
+            return Member(entry, values[0] if values else None)
+        if container.type == "flow_mapping" and entry.type != "flow_pair":
+            raise NotSurgical("Cannot handle flow mapping keys without values")
+        return super().member(entry, container)
+
+    def key(self, entry: Node) -> str | None:
+        """Decode the key of a mapping entry"""
+        key = entry.child_by_field_name("key")
+        if key is None:
+            return None
+        scalar = self.unwrap(key)
+        if scalar.type == "plain_scalar":
+            return scalar.text.decode()
+        return self.value(key)
+
+    def value(self, node: Node) -> Any:
+        """Decode the data of a flow node"""
+        if node.type != "flow_node":
+            raise NotSurgical(f"Cannot decode {node.type} on its own")
+        return self.load(node.text)
+
+    def render(self, value: Any, old: Node | None) -> bytes:
+        """Encode a value, keeping the quoting style of the node it replaces"""
+        if old is not None and self.decorated(old):
+            raise NotSurgical("Cannot replace an anchored or tagged node")
+        scalar = None if old is None else self.unwrap(old)
+        if old is not None and old.type == "block_node":
+            # Block collections/scalars: only ruamel can write them back alike
+            raise NotSurgical(f"Cannot replace {self.unwrap(old).type} in place")
+        if not isinstance(value, str):
+            return super().render(value, old)
+        if scalar is not None and scalar.type == "single_quote_scalar":
+            if "\n" not in value:
+                return ("'" + value.replace("'", "''") + "'").encode()
+        elif scalar is None or scalar.type == "plain_scalar":
+            if value and not self.PLAIN_UNSAFE.search(value):
+                if self.load(value.encode()) == value:
+                    return value.encode()
+        return super().render(value, old)
+
+    def removal(self, content: bytes, container: Node, entry: Node) -> Edit:
+        """Get the edit removing an entry, whole lines for block collections"""
+        if container.type not in self.block_types:
+            return super().removal(content, container, entry)
+        if len(self.entries(container)) == 1:
+            raise NotSurgical("Cannot empty a block collection")
+        entry_start = entry.start_byte
+        line_start = content.rfind(b"\n", 0, entry_start) + 1
+        if content[line_start:entry_start].strip():
+            raise NotSurgical("Entry shares its line with another")
+        line_end = content.find(b"\n", entry.end_byte)
+        line_end = len(content) if line_end == -1 else line_end + 1
+        return Edit(line_start, line_end, b"")
+
+    def addition(self, content: bytes, container: Node, key: str, value: Any) -> Edit:
+        """Get the edit adding a new key, on its own line for block mappings"""
+        if container.type not in self.block_types:
+            return super().addition(content, container, key, value)
+        last = self.entries(container)[-1]
+        indent = b" " * container.start_point[1]
+        line_end = content.find(b"\n", last.end_byte)
+        if line_end == -1:
+            line_end, newline = len(content), b"\n"
+        elif content.endswith(b"\r", 0, line_end):
+            line_end, newline = line_end - 1, b"\r\n"
+        else:
+            newline = b"\n"
+        pair = self.render(key, None) + b": " + self.render(value, None)
+        return Edit(line_end, line_end, newline + indent + pair)
+
+
+JSON = JsonDialect()
+"""The dialect of JSON files"""
+YAML = YamlDialect()
+"""The dialect of YAML files"""
+
+
+def splice_operation(document: ParsedDocument, operation: dict, dialect: Dialect):
+    """Apply a single JSON Patch operation by splicing the document's content
+
+    Raises {py:class}`NotSurgical` without editing the document, if the
+    operation can't be done this way.
+    """
+    if document.root_node.has_error:
+        raise NotSurgical("File does not parse cleanly")
+    op = operation["op"]
+    parts = JsonPointer(operation["path"]).parts
+    node = dialect.root(document.root_node)
+    if not parts:
+        if op == "test" and same_document(dialect.value(node), operation["value"]):
+            return
+        raise NotSurgical(f"Cannot {op} the whole document")
+    for token in parts[:-1]:
+        member = dialect.find(node, token)
+        if member is None or member.value is None:
+            raise NotSurgical(f"No value at {token!r} along {operation['path']}")
+        node = member.value
+    container, token = dialect.unwrap(node), parts[-1]
+    member = dialect.find(node, token)
+    if op == "add" and member is None and container.type in dialect.mapping_types:
+        edit = dialect.addition(document.content, container, token, operation["value"])
+    elif op == "add" and container.type in dialect.sequence_types:
+        raise NotSurgical("Cannot insert into a sequence")
+    elif member is None or member.value is None:
+        raise NotSurgical(f"No value at {operation['path']}")
+    elif op in ("add", "replace"):
+        replacement = dialect.render(operation["value"], member.value)
+        if replacement == member.value.text:
+            return
+        edit = Edit(member.value.start_byte, member.value.end_byte, replacement)
+    elif op == "remove":
+        edit = dialect.removal(document.content, container, member.entry)
+    elif op == "test":
+        if not same_document(dialect.value(member.value), operation["value"]):
+            raise NotSurgical(f"Test failed at {operation['path']}")
+        return
+    else:
+        raise NotSurgical(f"Cannot {op} surgically")
+    document.apply([edit])
+
+
+def same_document(left: Any, right: Any) -> bool:
+    """Compare data-trees as they would be serialized, key order included
+
+    Unlike `==`, mappings with the same items in a different order differ, and
+    so do `true` and `1`, or `1` and `1.0`.
+
+    >>> same_document({"a": 1, "b": 2}, {"b": 2, "a": 1})
+    False
+    >>> same_document({"a": [1, True]}, {"a": [1, 1]})
+    False
+    >>> same_document({"a": [1, {"b": None}]}, {"a": [1, {"b": None}]})
+    True
+    """
+    if isinstance(left, dict) and isinstance(right, dict):
+        return list(left) == list(right) and all(
+            same_document(value, right[key]) for key, value in left.items()
+        )
+    if isinstance(left, list) and isinstance(right, list):
+        return len(left) == len(right) and all(
+            same_document(a, b) for a, b in zip(left, right)
+        )
+    if isinstance(left, (dict, list)) or isinstance(right, (dict, list)):
+        return False
+    same_kind = all(
+        isinstance(left, kind) == isinstance(right, kind) for kind in (bool, float)
+    )
+    return same_kind and left == right
@@ -0,0 +1,299 @@
+"""Read-only scanners inventorying dependencies and GitHub Actions of repos
+
+Deciding which repos a {py:class}`~mass_driver_plugins.poetry_surgical.PoetrySurgical`
+or {py:class}`~mass_driver_plugins.surgical.GithubActionParameterReplacer` run
+should target doesn't need running the patch everywhere: these scanners list
+what those drivers would look at, with the same tree-sitter queries, without
+editing anything.
+
+- `poetry-dependencies` lists each dependency pin of `pyproject.toml`, Poetry
+  or PEP 621 alike, as indexed by
+  {py:class}`~mass_driver_plugins.poetry_surgical.DependencyIndex`
+- `github-actions` lists each step's `uses:` action and `with:` parameters, in
+  `.github/workflows/` files
+
+Both are mass-driver scanners, given a repo's path. For a whole fleet of local
+clones, {py:func}`scan_repos` runs them over all repos' files in a process
+pool, and an {py:class}`InventoryIndex` stores the results in SQLite, to find
+the repos later migrations should target.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterator, NamedTuple
+
+from mass_driver_plugins.poetry_surgical import (
+    PEP508_REQUIREMENT,
+    TABLES_QUERY,
+    DependencyForm,
+    DependencyIndex,
+    normalize_name,
+    table_index,
+    toml_string_content,
+    unquote,
+)
+from mass_driver_plugins.surgical import uses_pair_pattern, with_pair_pattern
+from mass_driver_plugins.treesitter import REGISTRY, ParsedDocument
+
+ACTIONS_QUERY = (
+    f"(block_mapping{uses_pair_pattern()}) @step\n"
+    f"(block_mapping{with_pair_pattern()}) @step"
+)
+"""Query of each step's action, then of each of its parameters"""
+
+
+def parsed(language: str, content: bytes) -> ParsedDocument:
+    """Parse content, raising on syntax errors rather than skipping their nodes"""
+    document = REGISTRY.document(language, content)
+    if document.tree.root_node.has_error:
+        raise ValueError(f"Invalid {language} syntax, or not UTF-8")
+    return document
+
+
+def pyproject_pins(content: bytes) -> list[dict[str, Any]]:
+    """List the dependency pins of a pyproject.toml's content"""
+    document = parsed("toml", content)
+    index = DependencyIndex.from_tables(table_index(document.matches(TABLES_QUERY)))
+    pins = []
+    for (group, normalized), group_pins in index.pins.items():
+        for pin in group_pins:
+            if pin.form == DependencyForm.PEP508:
+                requirement = toml_string_content(pin.node)
+                match = PEP508_REQUIREMENT.fullmatch(requirement)
+                if match is None:
+                    raise ValueError(f"Invalid requirement {requirement!r}")
+                spec = match["specifier"].strip()
+            else:
+                spec = unquote(pin.node.text).decode("utf-8")
+            pins.append(
+                {
+                    "group": group,
+                    "package": pin.name,
+                    "normalized": normalized,
+                    "form": pin.form.value,
+                    "spec": spec,
+                    "line": pin.node.start_point[0] + 1,
+                }
+            )
+    return pins
+
+
+def workflow_actions(content: bytes) -> list[dict[str, Any]]:
+    """List the steps using an action in a GitHub workflow's content
+
+    Each step's parameters are given as a dict, empty for steps without `with:`.
+    """
+    document = parsed("yaml", content)
+    steps: dict[tuple[int, int], dict[str, Any]] = {}
+    parameters: dict[tuple[int, int], dict[str, str]] = {}
+    for _pattern, captures in document.matches(ACTIONS_QUERY):
+        if "step" not in captures:
+            continue  # Match filtered out by a predicate
+        step = captures["step"]
+        key = (step.start_byte, step.end_byte)
+        if "action" in captures:
+            steps[key] = {
+                "action": captures["action"].text.decode("utf-8").strip("\"'"),
+                "line": captures["action"].start_point[0] + 1,
+            }
+        elif "key" in captures:
+            parameter = captures["key"].text.decode("utf-8")
+            value = captures["value"].text.decode("utf-8")
+            parameters.setdefault(key, {})[parameter] = value
+    return [
+        {**step, "with": parameters.get(key, {})} for key, step in sorted(steps.items())
+    ]
+
+
+class FileScanner(NamedTuple):
+    """A scanner of some files of each repo"""
+
+    key: str
+    """The key of the scanner's results, in its returned dict"""
+    globs: list[str]
+    """The files to scan, relative to repo root"""
+    scan_file: Callable[[bytes], list[dict[str, Any]]]
+    """List the findings in a file's content"""
+
+
+SCANNERS: dict[str, FileScanner] = {
+    "poetry-dependencies": FileScanner(
+        "dependencies", ["pyproject.toml"], pyproject_pins
+    ),
+    "github-actions": FileScanner(
+        "github_actions",
+        [".github/workflows/*.yml", ".github/workflows/*.yaml"],
+        workflow_actions,
+    ),
+}
+"""The scanners, by entry point name"""
+
+
+def scanned_files(scanner: FileScanner, repo: Path) -> list[Path]:
+    """List the repo's files to scan, sorted"""
+    paths = (path for pattern in scanner.globs for path in repo.glob(pattern))
+    return sorted(path for path in paths if path.is_file())
+
+
+def scan_file(scanner_name: str, repo: Path, path: Path) -> list[dict[str, Any]]:
+    """Scan a single file of a repo, tagging each finding with the file's path"""
+    scanner = SCANNERS[scanner_name]
+    relative = str(path.relative_to(repo))
+    try:
+        findings = scanner.scan_file(path.read_bytes())
+    except Exception as e:
+        return [{"file": relative, "error": str(e)}]
+    return [{"file": relative, **finding} for finding in findings]
+
+
+def scan_repo(scanner_name: str, repo: Path) -> dict[str, Any]:
+    """Scan a repo's files in this process, as a mass-driver scanner"""
+    scanner = SCANNERS[scanner_name]
+    findings = [
+        finding
+        for path in scanned_files(scanner, repo)
+        for finding in scan_file(scanner_name, repo, path)
+    ]
+    return {scanner.key: findings}
+
+
+def poetry_dependencies(repo: Path) -> dict[str, Any]:
+    """List the dependency pins of the repo's pyproject.toml"""
+    return scan_repo("poetry-dependencies", repo)
+
+
+def github_actions(repo: Path) -> dict[str, Any]:
+    """List the actions and parameters of the repo's GitHub workflows"""
+    return scan_repo("github-actions", repo)
+
+
+def scan_repos(
+    scanner_name: str, repos: list[Path], workers: int | None = None
+) -> Iterator[tuple[Path, list[dict[str, Any]]]]:
+    """Scan the files of many repos in a process pool, yielding each repo's findings
+
+    Files of all repos are spread over the pool, rather than whole repos, so
+    that repos with many workflows don't hold back the others. Repos come back
+    in order, including those without any file to scan. Workers default to the
+    CPU count.
+    """
+    scanner = SCANNERS[scanner_name]
+    tasks = [(repo, path) for repo in repos for path in scanned_files(scanner, repo)]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            scan_file,
+            [scanner_name] * len(tasks),
+            [repo for repo, _ in tasks],
+            [path for _, path in tasks],
+            # Batches of files, a few per worker, to amortize inter-process calls
+            chunksize=max(1, len(tasks) // (4 * workers)),
+        )
+        by_repo: dict[Path, list[dict[str, Any]]] = {repo: [] for repo in repos}
+        for (repo, _path), findings in zip(tasks, results):
+            by_repo[repo].extend(findings)
+    yield from by_repo.items()
+
+
+class InventoryIndex:
+    """SQLite index of the scanners' findings, one table per scanner
+
+    Re-scanning a repo replaces its previous findings. Query the tables with
+    any SQLite client, or via {py:meth}`repos_with_package` and
+    {py:meth}`repos_with_action`.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS dependencies (
+        repo TEXT NOT NULL, file TEXT NOT NULL, line INTEGER,
+        dependency_group TEXT, package TEXT, normalized TEXT, form TEXT, spec TEXT
+    );
+    CREATE INDEX IF NOT EXISTS dependencies_package ON dependencies (normalized);
+    CREATE TABLE IF NOT EXISTS github_actions (
+        repo TEXT NOT NULL, file TEXT NOT NULL, line INTEGER,
+        action TEXT, parameter TEXT, value TEXT
+    );
+    CREATE INDEX IF NOT EXISTS github_actions_action ON github_actions (action);
+    CREATE TABLE IF NOT EXISTS scan_errors (
+        repo TEXT NOT NULL, scanner TEXT NOT NULL, file TEXT NOT NULL, error TEXT
+    );
+    """
+    """The tables of findings, steps without parameters having a NULL one"""
+
+    def __init__(self, path: Path):
+        """Open the index, creating its tables if needed"""
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.SCHEMA)
+
+    def record(self, scanner_name: str, repo: str, findings: list[dict[str, Any]]):
+        """Replace a repo's findings for given scanner"""
+        table = SCANNERS[scanner_name].key
+        errors = [f for f in findings if "error" in f]
+        rows = [f for f in findings if "error" not in f]
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM scan_errors WHERE repo = ? AND scanner = ?",
+                (repo, scanner_name),
+            )
+            self.connection.executemany(
+                "INSERT INTO scan_errors VALUES (?, ?, ?, ?)",
+                [(repo, scanner_name, f["file"], f["error"]) for f in errors],
+            )
+            if table == "dependencies":
+                self.connection.execute(
+                    "DELETE FROM dependencies WHERE repo = ?", (repo,)
+                )
+                self.connection.executemany(
+                    "INSERT INTO dependencies VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            repo,
+                            f["file"],
+                            f["line"],
+                            f["group"],
+                            f["package"],
+                            f["normalized"],
+                            f["form"],
+                            f["spec"],
+                        )
+                        for f in rows
+                    ],
+                )
+            else:
+                self.connection.execute(
+                    "DELETE FROM github_actions WHERE repo = ?", (repo,)
+                )
+                self.connection.executemany(
+                    "INSERT INTO github_actions VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (repo, f["file"], f["line"], f["action"], parameter, value)
+                        for f in rows
+                        for parameter, value in (f["with"].items() or [(None, None)])
+                    ],
+                )
+
+    def repos_with_package(self, package: str) -> list[str]:
+        """List the repos pinning given package, in any group"""
+        cursor = self.connection.execute(
+            "SELECT DISTINCT repo FROM dependencies WHERE normalized = ? ORDER BY repo",
+            (normalize_name(package),),
+        )
+        return [repo for (repo,) in cursor]
+
+    def repos_with_action(self, action: str, parameter: str | None = None) -> list[str]:
+        """List the repos using given action, optionally with given parameter"""
+        query = "SELECT DISTINCT repo FROM github_actions WHERE action = ?"
+        arguments: tuple[str, ...] = (action,)
+        if parameter is not None:
+            query += " AND parameter = ?"
+            arguments += (parameter,)
+        cursor = self.connection.execute(query + " ORDER BY repo", arguments)
+        return [repo for (repo,) in cursor]
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
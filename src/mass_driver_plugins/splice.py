@@ -0,0 +1,75 @@
+"""Byte-offset splicing of file contents, shared by surgical editors
+
+Tree-sitter reports node positions as byte offsets into the parsed buffer, so
+edits are expressed the same way, against the original bytes. This keeps line
+endings, trailing newlines and non-ASCII content exactly as they were, outside
+of the edited ranges.
+"""
+
+from typing import Iterable, NamedTuple
+
+
+class Edit(NamedTuple):
+    """A replacement of the byte range [start_byte, end_byte) of a buffer"""
+
+    start_byte: int
+    """Offset of the first byte to replace"""
+    end_byte: int
+    """Offset one past the last byte to replace (equal to start for insertion)"""
+    replacement: bytes
+    """The bytes to put in place of the range"""
+
+
+class OverlappingEditsError(ValueError):
+    """Two edits target overlapping byte ranges of the same buffer"""
+
+
+def sorted_edits(edits: Iterable[Edit], content_length: int) -> list[Edit]:
+    """Order edits by position, checking they are in bounds and don't overlap
+
+    >>> sorted_edits([Edit(4, 6, b"x"), Edit(0, 2, b"y")], 10)
+    [Edit(start_byte=0, end_byte=2, replacement=b'y'), Edit(start_byte=4, end_byte=6, replacement=b'x')]
+    >>> sorted_edits([Edit(0, 4, b""), Edit(2, 6, b"")], 10)
+    Traceback (most recent call last):
+    ...
+    mass_driver_plugins.splice.OverlappingEditsError: Edit [2, 6) overlaps edit [0, 4)
+    """
+    ordered = sorted(edits, key=lambda e: (e.start_byte, e.end_byte))
+    previous_end = 0
+    previous: Edit | None = None
+    for edit in ordered:
+        if not 0 <= edit.start_byte <= edit.end_byte <= content_length:
+            raise ValueError(
+                f"Edit [{edit.start_byte}, {edit.end_byte}) out of bounds "
+                f"for content of {content_length} bytes"
+            )
+        if previous is not None and edit.start_byte < previous_end:
+            raise OverlappingEditsError(
+                f"Edit [{edit.start_byte}, {edit.end_byte}) overlaps "
+                f"edit [{previous.start_byte}, {previous.end_byte})"
+            )
+        previous, previous_end = edit, edit.end_byte
+    return ordered
+
+
+def apply_edits(content: bytes, edits: Iterable[Edit]) -> bytes:
+    r"""Apply non-overlapping edits to content, in a single pass
+
+    Untouched ranges are referenced via memoryview rather than copied, so the
+    only allocation is the output buffer itself.
+
+    >>> apply_edits(b"key: minimal\r\nother: minimal\r\n", [Edit(5, 12, b"default")])
+    b'key: default\r\nother: minimal\r\n'
+    """
+    ordered = sorted_edits(edits, len(content))
+    if not ordered:
+        return content
+    view = memoryview(content)
+    chunks: list[bytes | memoryview] = []
+    position = 0
+    for start, end, replacement in ordered:
+        chunks.append(view[position:start])
+        chunks.append(replacement)
+        position = end
+    chunks.append(view[position:])
+    return b"".join(chunks)
@@ -1,15 +1,28 @@
 """Edit files via tree-sitter"""
-from copy import deepcopy
+from __future__ import annotations
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import Context, copy_context
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-from mass_driver.models.patchdriver import PatchDriver, PatchOutcome, PatchResult
+from mass_driver.drivers.bricks import process_outcomes
+from mass_driver.models.patchdriver import PatchOutcome, PatchResult
 from mass_driver.models.repository import ClonedRepo
-from tree_sitter import Node, Parser
-from tree_sitter_languages import get_language
+from pydantic import root_validator
+
+from mass_driver_plugins import metrics, overlay
+from mass_driver_plugins.memo import Memoized, MemoizingDriver
+from mass_driver_plugins.metrics import instrumented
+from mass_driver_plugins.splice import Edit
+from mass_driver_plugins.treesitter import REGISTRY, ParsedDocument
+
+if TYPE_CHECKING:
+    from tree_sitter import Node
 
 
-class SurgicalFileEditor(PatchDriver):
+class SurgicalFileEditor(MemoizingDriver):
     """
     Edit files surgically, parsing them with tree-sitter
 
@@ -21,16 +34,40 @@ class SurgicalFileEditor(PatchDriver):
     enough to customize the class for reusability without Python code changes.
     Thus this class is just the skeleton, with some functions intentionally not
     implemented, to be overriden by downstream.
+
+    Either a single {py:attr}`target_file` or a {py:attr}`target_glob` of files
+    is edited. In glob mode, each matching file is parsed and edited once, in a
+    bounded thread pool, and per-file outcomes are combined into one result.
+
+    With `instrument = true`, the time spent reading, parsing, querying,
+    refining, editing and writing is recorded, see
+    {py:mod}`mass_driver_plugins.metrics`.
+
+    With `memoize = true`, files with the same content as one already edited
+    get the same edits, without parsing, see {py:mod}`mass_driver_plugins.memo`.
     """
 
-    target_file: str
+    target_file: str | None = None
     """The file to read"""
+    target_glob: str | None = None
+    """Glob of files to edit, relative to repo root, instead of target_file"""
+    max_workers: int = 4
+    """Maximum number of files processed concurrently in target_glob mode"""
+    fail_on_any_error: bool = True
+    """In target_glob mode, declare failure on any file's PATCH_ERROR"""
     language: str
     """The tree-sitter grammar to use"""
     query: str
     """The tree-sitter query to process"""
 
-    def treesitter_query(self, captures) -> list[Node]:
+    @root_validator(skip_on_failure=True)
+    def check_single_target(cls, values):
+        """Ensure exactly one of target_file or target_glob is given"""
+        if (values.get("target_file") is None) == (values.get("target_glob") is None):
+            raise ValueError("Exactly one of target_file or target_glob must be set")
+        return values
+
+    def treesitter_query(self, captures) -> list[Any]:
         """Search the tree for compatible nodes"""
         raise NotImplementedError(
             "Base class doesn't know to process tree-sitter queries"
@@ -40,29 +77,108 @@ class SurgicalFileEditor(PatchDriver):
         """Refine keyword matches"""
         raise NotImplementedError("Base class doesn't know to refine node search")
 
-    def surgical_edit(self, text, bad_nodes: list[Any]) -> str:
-        """Surgically edit the file to fix the badness"""
+    def splice_edits(self, content: bytes, bad_nodes: list[Any]) -> list[Edit]:
+        """List the byte-range edits of content to make to fix the badness
+
+        Override this to get edits spliced in place, with incremental
+        re-parsing. Defaults to wrapping {py:meth}`surgical_edit`'s output as a
+        single edit of the whole file, for subclasses overriding that instead.
+        """
+        mutated = to_bytes(self.surgical_edit(content.decode("utf-8"), bad_nodes))
+        if mutated == content:
+            return []
+        return [Edit(0, len(content), mutated)]
+
+    def surgical_edit(self, text: str, bad_nodes: list[Any]) -> str:
+        """Surgically edit the file to fix the badness
+
+        Prefer overriding {py:meth}`splice_edits`, which edits in place.
+        """
         raise NotImplementedError("Base class doesn't know to surgically edit the file")
 
+    def edit_document(self, document: ParsedDocument):
+        """Run one round of query, refine and edit over the parsed document
+
+        Override to run several rounds: each {py:meth}`ParsedDocument.apply`
+        re-parses incrementally, so querying again after an edit is cheap.
+        """
+        captures = document.captures(self.query)
+        with metrics.phase("refine"):
+            prematching = self.treesitter_query(captures)
+            bad_nodes = self.refine_search(prematching)
+            edits = self.splice_edits(document.content, bad_nodes)
+        document.apply(edits)
+
+    def process_file(self, content: bytes) -> bytes:
+        """Parse, query, refine and edit a single file's content"""
+        document = REGISTRY.document(self.language, content)
+        self.edit_document(document)
+        # Next driver over this content can reuse the up-to-date tree
+        REGISTRY.remember(document)
+        return document.content
+
+    def edit_file(self, target_fullpath: Path) -> PatchResult:
+        """Edit a single file in place, if it needs changing"""
+        content = metrics.read_bytes(target_fullpath)
+        mutated_content = self.memoized(
+            content, lambda raw: Memoized(self.process_file(raw), None)
+        ).content
+        if mutated_content == content:
+            return PatchResult(outcome=PatchOutcome.ALREADY_PATCHED)
+        metrics.write_bytes(target_fullpath, mutated_content)
+        return PatchResult(outcome=PatchOutcome.PATCHED_OK)
+
+    @instrumented
     def run(self, repo: ClonedRepo) -> PatchResult:
-        """Process the template file"""
+        """Process the target file(s)"""
+        if self.target_glob is not None:
+            return self.run_glob(repo, self.target_glob)
+        assert self.target_file is not None, "Validated: one of target_file/glob"
         target_fullpath = Path(repo.cloned_path) / Path(self.target_file)
-        if not target_fullpath.is_file():
+        if not overlay.is_file(target_fullpath):
             return PatchResult(outcome=PatchOutcome.PATCH_DOES_NOT_APPLY)
-        content_str = target_fullpath.read_text()
-        language = get_language(self.language)
-        query = language.query(self.query)
-        parser = Parser()
-        parser.set_language(language)
-        tree = parser.parse(bytes(content_str, "utf8"))
-        captures = query.captures(tree.root_node)
-        prematching = self.treesitter_query(captures)
-        bad_nodes = self.refine_search(prematching)
-        mutated_content = self.surgical_edit(content_str, bad_nodes)
-        if mutated_content == content_str:
-            return PatchResult(outcome=PatchOutcome.ALREADY_PATCHED)
-        target_fullpath.write_text(mutated_content)
-        return PatchResult(outcome=PatchOutcome.PATCHED_OK)
+        return self.edit_file(target_fullpath)
+
+    def run_glob(self, repo: ClonedRepo, target_glob: str) -> PatchResult:
+        """Edit every file matching target_glob, combining outcomes"""
+        repo_path = Path(repo.cloned_path)
+        targets = overlay.glob(repo_path, target_glob)
+        self.logger.info(f"Found {len(targets)} files to edit")
+        if not targets:
+            return PatchResult(
+                outcome=PatchOutcome.PATCH_DOES_NOT_APPLY,
+                details=f"No files matching '{target_glob}'",
+            )
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            # Each file in a copy of this context, to record this repo's metrics
+            futures = [
+                pool.submit(self._edit_file_safe, target, copy_context())
+                for target in targets
+            ]
+            outcomes = {
+                str(target.relative_to(repo_path)): future.result()
+                for target, future in zip(targets, futures)
+            }
+        combined = process_outcomes(
+            outcomes, fail_on_any_error=self.fail_on_any_error, logger=self.logger
+        )
+        per_file = "\n".join(
+            f"{fname}: {r.outcome.value}" + (f" ({r.details})" if r.details else "")
+            for fname, r in outcomes.items()
+        )
+        summary = f"{combined.details}\n" if combined.details else ""
+        return PatchResult(outcome=combined.outcome, details=summary + per_file)
+
+    def _edit_file_safe(self, target_fullpath: Path, context: Context) -> PatchResult:
+        """Edit a single file in given context, turning any exception into a PATCH_ERROR"""
+        try:
+            return context.run(self.edit_file, target_fullpath)
+        except Exception as e:
+            self.logger.exception(e)
+            return PatchResult(
+                outcome=PatchOutcome.PATCH_ERROR,
+                details=f"Error processing file, error was {e}",
+            )
 
 
 class GithubActionParameterReplacer(SurgicalFileEditor):
@@ -85,23 +201,18 @@ class GithubActionParameterReplacer(SurgicalFileEditor):
         +      profile: default
                toolchain: ${{ matrix.rust }}
                override: true
+
+    The query is generated from the config: the "uses" and "with" keys, the
+    actions and the parameters to replace are all matched via predicates, in
+    tree-sitter's query engine. Steps are matched whatever the order of their
+    keys, and several actions and parameters are replaced in one pass, via
+    {py:attr}`action_selectors` and {py:attr}`replacements`.
     """
 
     # Inherited variables, customized here
     language: str = "yaml"
-
-    # DEBUG via website: https://ikatyang.github.io/tree-sitter-yaml/
-    query: str = """
-        (block_sequence_item
-         (block_node
-          (block_mapping
-           (block_mapping_pair
-            key: (flow_node (plain_scalar (string_scalar))))
-           .
-           (block_mapping_pair
-            key: (flow_node (plain_scalar (string_scalar))))
-           ))) @d
-    """
+    query: str = ""
+    """The tree-sitter query, generated from the selectors if left empty"""
 
     # Custom to this subclass:
     action_selector: str = "actions-rs/toolchain@v1"
@@ -112,100 +223,210 @@ class GithubActionParameterReplacer(SurgicalFileEditor):
     """The "bad" value for with_key_target, which to replace"""
     replacement_value: str = "default"
     """The replacement value for the selected parameter"""
+    action_selectors: list[str] = []
+    """Github actions to identify, instead of the single action_selector"""
+    replacements: dict[str, dict[str, str]] = {}
+    """Parameters to replace, instead of the with_* fields: key, to bad value, to
+    replacement value, like `{"profile": {"minimal": "default"}}`"""
 
-    def treesitter_query(self, captures) -> list[Node]:
-        """Search the tree for compatible nodes"""
-        self.logger.info(f"Got {len(captures)} raw captures")
-        matching_nodes = []
-        for node, _name in captures:
-            try:
-                node_block = node.children[1]  # Children[0] is the "-" node
-                kv_node = node_block.children[0]  # Down to block_mapping
-                useswith_nodes = kv_node.children
-                # Get the proper node, by keyword
-                uses_node = [n for n in useswith_nodes if n.children[0].text == b"uses"]
-                if not uses_node:
-                    continue
-                use_node = uses_node[0]
-                # Assert value of kv
-                if use_node.children[2].text != to_bytes(self.action_selector):
-                    continue
-                matching_nodes.append(useswith_nodes)
-            except KeyError:
-                continue  # Failing to grab the contents means bad keys = move on
-        return matching_nodes
+    @root_validator(skip_on_failure=True)
+    def generate_query(cls, values):
+        """Fill in the selectors and replacements, then the query matching them"""
+        if not values["action_selectors"]:
+            values["action_selectors"] = [values["action_selector"]]
+        if not values["replacements"]:
+            values["replacements"] = {
+                values["with_key_target"]: {
+                    values["with_value_target"]: values["replacement_value"]
+                }
+            }
+        if not values["query"]:
+            values["query"] = action_parameters_query(
+                values["action_selectors"], values["replacements"]
+            )
+        return values
 
-    def refine_search(self, matching_nodes) -> list[tuple[Node, Node]]:
-        """Refine keyword matches
+    def edit_document(self, document: ParsedDocument):
+        """Run the generated query over the document, and edit all its matches"""
+        matches = document.matches(self.query)
+        with metrics.phase("refine"):
+            prematching = self.treesitter_query(matches)
+            bad_nodes = self.refine_search(prematching)
+            edits = self.splice_edits(document.content, bad_nodes)
+        document.apply(edits)
 
-        Returns the nodes of key and value that should be edited.
+    def treesitter_query(self, matches) -> list[tuple[Node, Node]]:
+        """Keep the (key, value) nodes of the query's matches
 
-        These are the nodes of "profile" and "minimal", when the "uses" keyword
-        is set to "actions-rs/toolchain@v1".
+        Matches failing a predicate come back from tree-sitter without any
+        capture, and are dropped.
+        """
+        self.logger.info(f"Got {len(matches)} raw matches")
+        return [
+            (captures["key"], captures["value"])
+            for _pattern, captures in matches
+            if "value" in captures
+        ]
 
-        The exact "path" we wade through tree-sitter Nodes depends on parsed
-        tree-structure (obviously) but also on tree-sitter language. Debugging
-        is recommended via the Tree-Sitter Playground, in Query mode, exploring
-        matches.
+    def refine_search(self, matching_nodes) -> list[tuple[Node, Node]]:
+        """Refine keyword matches
+
+        Returns the nodes of key and value that should be edited: those whose
+        value is a bad value of their own key. The query's predicates accept
+        any key with any bad value, being one regex each.
         """
-        bad_k_v_nodes = []  # Bad as in worth editing
-        for useswith_nodes in matching_nodes:
-            try:
-                with_nodes = [
-                    n for n in useswith_nodes if n.children[0].text == b"with"
-                ]
-                if not with_nodes:
-                    continue
-                with_node = with_nodes[0]
-                # Value of "key: value", -> down 1 -> list[kv]
-                with_args = with_node.children[2].children[0].children
-                # We know it's right block type: now check "with" (action args) for "badness"
-                with_key_target_bytes = bytes(self.with_key_target, encoding="utf-8")
-                target_key_nodes = [
-                    n for n in with_args if n.children[0].text == with_key_target_bytes
-                ]
-                if not target_key_nodes:
-                    continue
-                target_key_node = target_key_nodes[0]
-                target_value_nodes = target_key_node.children[2]
-                if target_value_nodes.text != bytes(
-                    self.with_value_target, encoding="utf-8"
-                ):
-                    continue  # Only the targeted parameter value should be replaced
-                target_value_node = target_value_nodes.children[0]
-                bad_k_v_nodes.append((target_key_node, target_value_node))
-            except KeyError:
-                continue  # Failing to grab the contents means bad keys = move on
-        return bad_k_v_nodes
-
-    def surgical_edit(self, text, bad_nodes: list[tuple[Node, Node]]) -> str:
+        return [
+            (key_node, value_node)
+            for key_node, value_node in matching_nodes
+            if value_node.text.decode("utf-8")
+            in self.replacements.get(key_node.text.decode("utf-8"), {})
+        ]
+
+    def splice_edits(
+        self, content: bytes, bad_nodes: list[tuple[Node, Node]]
+    ) -> list[Edit]:
         """Surgically edit the file to fix the badness
 
-        In this case, we build a mutated line by using just the value we want,
-        interpolated around the rest of the line.
+        In this case, we splice just the value's byte range with the value we
+        want, leaving everything around it untouched.
 
         Particular attention is given to both beginning and end of original
         line, which could be housing some comments, which we don't want to edit.
         """
-        mutated_lines = deepcopy(text).splitlines()
-        for _k_node, v_node in bad_nodes:
-            # Visualisation of old content:
-            #      key: value
-            #      ^ ^  ^   ^
-            #      k0k1 v0  v1
-            # k0_line, k0_col = k_node.start_point
-            # k1_line, k1_col = k_node.end_point
-            v0_line, v0_col = v_node.start_point
-            _v1_line, v1_col = v_node.end_point
-            bad_line = mutated_lines[v0_line]
-            # New value
-            #    key: REPLACED
-            #         ^       ^
-            # up to v0[       [v1 onwards
-            replaced = self.replacement_value
-            replaced_line = bad_line[:v0_col] + replaced + bad_line[v1_col:]
-            mutated_lines[v0_line] = replaced_line
-        return "\n".join(mutated_lines) + "\n"
+        # Visualisation of old content:
+        #      key: value
+        #           ^    ^
+        #           v0   v1   [v0, v1) is the value node's byte range
+        edits = []
+        for k_node, v_node in bad_nodes:
+            bad_values = self.replacements[k_node.text.decode("utf-8")]
+            replacement = bad_values[v_node.text.decode("utf-8")]
+            edits.append(
+                Edit(v_node.start_byte, v_node.end_byte, to_bytes(replacement))
+            )
+        return edits
+
+
+def action_parameters_query(
+    action_selectors: list[str], replacements: dict[str, dict[str, str]]
+) -> str:
+    """Build a query matching the bad parameters of given actions' steps
+
+    Two patterns cover "uses" coming before or after "with". Action names may
+    be quoted in the YAML file.
+    """
+    actions = any_of(action_selectors, quotes="[\"']?")
+    keys = any_of(list(replacements))
+    bad_values = any_of([value for values in replacements.values() for value in values])
+    uses_pair = uses_pair_pattern(actions)
+    with_pair = with_pair_pattern(keys, bad_values)
+    return (
+        f"(block_mapping{uses_pair}{with_pair})\n(block_mapping{with_pair}{uses_pair})"
+    )
+
+
+def uses_pair_pattern(actions: str | None = None) -> str:
+    """Build the query pattern of a step's "uses" pair, capturing the @action
+
+    Given a query string literal of a regex, only matching actions are kept.
+    """
+    action_filter = f" (#match? @action {actions})" if actions else ""
+    return f"""
+     (block_mapping_pair
+      key: (flow_node) @uses_key (#eq? @uses_key "uses")
+      value: (flow_node) @action{action_filter})"""
+
+
+def with_pair_pattern(keys: str | None = None, values: str | None = None) -> str:
+    """Build the query pattern of a step's "with" pair, capturing @key and @value
+
+    Given query string literals of regexes, only matching parameters are kept.
+    """
+    key_filter = f" (#match? @key {keys})" if keys else ""
+    value_filter = f" (#match? @value {values})" if values else ""
+    return f"""
+     (block_mapping_pair
+      key: (flow_node) @with_key (#eq? @with_key "with")
+      value: (block_node
+       (block_mapping
+        (block_mapping_pair
+         key: (flow_node) @key{key_filter}
+         value: (flow_node) @value{value_filter}))))"""
+
+
+def any_of(texts: list[str], quotes: str = "") -> str:
+    r"""Build a query string literal, of a regex matching exactly any given text
+
+    >>> print(any_of(["a.b", "c"]))
+    "^(?:a\\.b|c)$"
+    """
+    alternatives = "|".join(re.escape(text) for text in texts)
+    regex = f"^{quotes}(?:{alternatives}){quotes}$"
+    escaped = regex.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+class QuerySurgicalEditor(SurgicalFileEditor):
+    """Replace the nodes captured by a tree-sitter query, configured without code
+
+    The {py:attr}`query` does all the matching, in tree-sitter's own engine:
+    use `#eq?` and `#match?` predicates to filter on node text, rather than
+    walking children in Python. In each match, the node captured as
+    {py:attr}`capture` is replaced by {py:attr}`replacement`.
+
+    The replacement is a Python format string, given the text of every capture
+    of the same match by name. Here's replacing the `profile` parameter of all
+    GitHub Action steps, keeping any comment on the line:
+
+    .. code-block:: toml
+
+        language = "yaml"
+        query = '''
+            (block_mapping_pair
+             key: (flow_node) @key (#eq? @key "profile")
+             value: (flow_node) @value (#eq? @value "minimal"))
+        '''
+        capture = "value"
+        replacement = "default"
+    """
+
+    capture: str
+    """The name of the query capture (without "@") whose node to replace"""
+    replacement: str
+    """The replacement text, formatted with the match's captures, like "{value}"
+
+    Literal braces are doubled, as per {py:meth}`str.format`.
+    """
+
+    @root_validator(skip_on_failure=True)
+    def check_capture_in_query(cls, values):
+        """Ensure the capture to replace is declared in the query"""
+        if not re.search(rf"@{re.escape(values['capture'])}\b", values["query"]):
+            raise ValueError(f"Capture '@{values['capture']}' not found in query")
+        return values
+
+    def edit_document(self, document: ParsedDocument):
+        """Replace the captured node of each match of the query, in one splice"""
+        matches = document.matches(self.query)
+        edits = {}
+        with metrics.phase("refine"):
+            for _pattern, captures in matches:
+                target = captures.get(self.capture)
+                if target is None:
+                    continue  # Match filtered out by a predicate
+                fields = {
+                    name: node.text.decode("utf-8")
+                    for name, node in captures.items()
+                    if not isinstance(node, list)  # Quantified captures are lists
+                }
+                replacement = to_bytes(self.replacement.format_map(fields))
+                nodes = target if isinstance(target, list) else [target]
+                for node in nodes:
+                    if node.text != replacement:
+                        # Overlapping patterns may match the same node: edit once
+                        edits[(node.start_byte, node.end_byte)] = replacement
+        self.logger.debug(f"Got {len(matches)} matches, making {len(edits)} edits")
+        document.apply(Edit(start, end, text) for (start, end), text in edits.items())
 
 
 def to_bytes(content: str):
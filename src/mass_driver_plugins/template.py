@@ -1,27 +1,390 @@
 """Create templated files via Jinja2"""
 
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 from pathlib import Path
+from typing import IO, TYPE_CHECKING, Any, Iterable
 
-from jinja2 import Environment
-from mass_driver.models.patchdriver import PatchDriver, PatchOutcome, PatchResult
+from mass_driver.models.patchdriver import PatchOutcome, PatchResult
 from mass_driver.models.repository import ClonedRepo
+from pydantic import root_validator
+
+from mass_driver_plugins import metrics, overlay
+from mass_driver_plugins.metrics import InstrumentedDriver, instrumented
+
+if TYPE_CHECKING:
+    from jinja2 import Environment, Template
+
+
+class TemplatedFile(InstrumentedDriver):
+    """Create a file via Jinja template filling
+
+    The Jinja environment and template are compiled once per driver instance,
+    then reused for every repo. Files already holding the rendered content are
+    not rewritten, returning ALREADY_PATCHED instead.
 
+    Either a single {py:attr}`template` string is rendered to
+    {py:attr}`target_file`, or a whole {py:attr}`template_dir` is rendered into
+    the repo. In directory mode, file paths are templates too (a path rendering
+    to empty is skipped), and each file is streamed to disk via
+    {py:meth}`jinja2.Template.generate`, never held fully in memory.
 
-class TemplatedFile(PatchDriver):
-    """Create a file via Jinja template filling"""
+    With a {py:attr}`fingerprint_index`, the inputs of the rendering are hashed
+    per repo: the template(s), jinja_args, and only the patch_data values the
+    templates read. Repos whose fingerprint is unchanged since the last
+    successful run are skipped, before touching their files. Within a
+    {py:class}`mass_driver_plugins.pipeline.Pipeline`, a repo's fingerprint is
+    only recorded once the pipeline wrote its files.
 
-    target_file: str
+    With `instrument = true`, the time spent fingerprinting, rendering and
+    writing is recorded, see {py:mod}`mass_driver_plugins.metrics`. In
+    directory mode, files are written as they render, both counted as `render`.
+    Within a {py:class}`mass_driver_plugins.pipeline.Pipeline`, files are
+    rendered in memory instead, see {py:mod}`mass_driver_plugins.overlay`.
+    """
+
+    target_file: str | None = None
     """The file to expand via template"""
-    template: str
+    template: str | None = None
     """A jinja2 template"""
-    jinja_args: dict
+    template_dir: str | None = None
+    """A folder of jinja2 templates, to render into the repo, instead of template"""
+    target_dir: str = "."
+    """In template_dir mode, where to render the files, relative to repo root"""
+    bytecode_cache_dir: str | None = None
+    """In template_dir mode, where to cache compiled templates across runs
+
+    Defaults to Jinja's choice, under the system's temporary folder.
+    """
+    jinja_args: dict = {}
     """Extra args to give jinja templating"""
+    fingerprint_index: str | None = None
+    """A SQLite file recording each repo's inputs fingerprint, to skip unchanged repos
+
+    Created if missing. Skipping trusts that nothing else changed the rendered
+    files since: delete the index to force a full re-render.
+    """
+
+    _compiled: dict[str, tuple[Environment, Template | None]] = {}
+    """The environment and compiled template, by (serialized) jinja_args"""
+    _path_templates: dict[str, Template] = {}
+    """In template_dir mode, the compiled templates of file paths"""
+    _inputs: dict[str, tuple[str, list[str]]] = {}
+    """Digest of the templates and args, and variables read, by jinja_args"""
+    _index: "FingerprintIndex | None" = None
+    """The loaded fingerprint_index, if any"""
+
+    @root_validator(skip_on_failure=True)
+    def check_single_mode(cls, values):
+        """Ensure either template and target_file, or template_dir, are given"""
+        single_file = values.get("template") is not None
+        if single_file == (values.get("template_dir") is not None):
+            raise ValueError("Exactly one of template or template_dir must be set")
+        if single_file and values.get("target_file") is None:
+            raise ValueError("target_file is required along with template")
+        return values
+
+    @property
+    def environment(self) -> Environment:
+        """Get the Jinja environment for current jinja_args, creating it once"""
+        return self._compile()[0]
+
+    @property
+    def compiled_template(self) -> Template | None:
+        """Get the compiled template for current jinja_args, compiling it once"""
+        return self._compile()[1]
+
+    def _compile(self) -> tuple[Environment, Template | None]:
+        """Build the environment and template, unless cached for these args"""
+        key = self._jinja_key()
+        compiled = self._compiled.get(key)
+        metrics.count("template_hits" if compiled is not None else "template_misses")
+        if compiled is None:
+            from jinja2 import (
+                Environment,
+                FileSystemBytecodeCache,
+                FileSystemLoader,
+                select_autoescape,
+            )
+
+            if self.template is not None:
+                env = Environment(**self.jinja_args, autoescape=True)
+                compiled = (env, env.from_string(self.template))
+            else:
+                assert self.template_dir is not None, "Validated: template or dir"
+                if self.bytecode_cache_dir is not None:
+                    Path(self.bytecode_cache_dir).mkdir(parents=True, exist_ok=True)
+                options: dict[str, Any] = {"keep_trailing_newline": True}
+                env = Environment(
+                    **{**options, **self.jinja_args},
+                    loader=FileSystemLoader(self.template_dir),
+                    bytecode_cache=FileSystemBytecodeCache(self.bytecode_cache_dir),
+                    autoescape=select_autoescape(),
+                    auto_reload=False,  # Templates don't change during a run
+                )
+                compiled = (env, None)
+            self._compiled[key] = compiled
+        return compiled
+
+    def _jinja_key(self) -> str:
+        """Serialize jinja_args, to key the caches depending on them"""
+        return json.dumps(self.jinja_args, sort_keys=True, default=repr)
+
+    def template_inputs(self) -> tuple[str, list[str]]:
+        """Get the digest of the template sources, and the variables they read
+
+        Variables are found by analysing each template's AST, paths included
+        in template_dir mode. Computed once, without rendering anything.
+        """
+        key = self._jinja_key()
+        inputs = self._inputs.get(key)
+        if inputs is None:
+            from jinja2 import meta
+
+            env = self.environment
+            if self.template is not None:
+                assert self.target_file is not None, "Validated: template's target"
+                sources = {self.target_file: self.template}
+            else:
+                assert env.loader is not None, "Built with template_dir's loader"
+                sources = {
+                    name: env.loader.get_source(env, name)[0]
+                    for name in env.list_templates()
+                }
+            variables = set()
+            for name, source in sources.items():
+                variables |= meta.find_undeclared_variables(env.parse(source))
+                if self.template_dir is not None:
+                    variables |= meta.find_undeclared_variables(env.parse(name))
+            static = {
+                "sources": sources,
+                "jinja_args": key,
+                "target_dir": self.target_dir,
+            }
+            inputs = (digest(static), sorted(variables))
+            self._inputs[key] = inputs
+        return inputs
+
+    def fingerprint(self, patch_data: dict) -> str:
+        """Hash the inputs of rendering for given patch data
+
+        Only the patch_data values read by the templates are hashed: changing
+        any other value keeps the same fingerprint.
+        """
+        static_digest, variables = self.template_inputs()
+        used = {name: patch_data[name] for name in variables if name in patch_data}
+        return digest({"templates": static_digest, "patch_data": used})
+
+    def path_template(self, template_name: str) -> Template:
+        """Get the compiled template of a template's file path, compiling it once
 
+        Paths are never HTML-escaped: `&` in patch data stays `&` in file names.
+        """
+        template = self._path_templates.get(template_name)
+        if template is None:
+            unescaped = f"{{% autoescape false %}}{template_name}{{% endautoescape %}}"
+            template = self.environment.from_string(unescaped)
+            self._path_templates[template_name] = template
+        return template
+
+    @instrumented
     def run(self, repo: ClonedRepo) -> PatchResult:
-        """Process the template file"""
-        env = Environment(**self.jinja_args, autoescape=True)
-        template = env.from_string(self.template)
-        rendered = template.render(repo.patch_data)
-        with open(Path(repo.cloned_path) / self.target_file, "w") as fd:
-            fd.write(rendered)
+        """Process the template file(s), unless their inputs are unchanged"""
+        if self.fingerprint_index is None:
+            return self.render(repo)
+        with INDEX_LOADING:
+            if self._index is None:
+                self._index = FingerprintIndex(Path(self.fingerprint_index))
+        with metrics.phase("fingerprint"):
+            fingerprint = self.fingerprint(repo.patch_data)
+        if self._index.get(repo.repo_id) == fingerprint:
+            return PatchResult(
+                outcome=PatchOutcome.ALREADY_PATCHED,
+                details="Template inputs unchanged since last run",
+            )
+        result = self.render(repo)
+        if result.outcome in (PatchOutcome.PATCHED_OK, PatchOutcome.ALREADY_PATCHED):
+            # In a pipeline, only once the rendered files are actually written
+            index = self._index
+            overlay.after_flush(lambda: index.record(repo.repo_id, fingerprint))
+        return result
+
+    def render(self, repo: ClonedRepo) -> PatchResult:
+        """Render the template(s) into the repo, writing only changed files"""
+        if self.template_dir is not None:
+            with metrics.phase("render"):
+                return self.run_dir(repo)
+        template = self.compiled_template
+        assert template is not None and self.target_file is not None, "Validated"
+        with metrics.phase("render"):
+            rendered = template.render(repo.patch_data).encode("utf-8")
+        target_fullpath = Path(repo.cloned_path) / self.target_file
+        if overlay.is_file(target_fullpath):
+            if metrics.read_bytes(target_fullpath) == rendered:
+                return PatchResult(outcome=PatchOutcome.ALREADY_PATCHED)
+        metrics.write_bytes(target_fullpath, rendered)
         return PatchResult(outcome=PatchOutcome.PATCHED_OK)
+
+    def run_dir(self, repo: ClonedRepo) -> PatchResult:
+        """Render every template of template_dir into the repo
+
+        All file paths are rendered and checked before writing any file, so a
+        bad path leaves the repo untouched.
+        """
+        assert self.template_dir is not None, "Only called in template_dir mode"
+        env = self.environment
+        target_root = (Path(repo.cloned_path) / self.target_dir).resolve()
+        targets = []
+        for template_name in env.list_templates():
+            target_name = self.path_template(template_name).render(repo.patch_data)
+            if not target_name.strip() or target_name.endswith("/"):
+                continue  # Path rendered empty: file not wanted for this repo
+            target_fullpath = (target_root / target_name).resolve()
+            if not target_fullpath.is_relative_to(target_root):
+                return PatchResult(
+                    outcome=PatchOutcome.PATCH_ERROR,
+                    details=f"Template {template_name} renders outside of target",
+                )
+            targets.append((template_name, target_name, target_fullpath))
+        changed = []
+        for template_name, target_name, target_fullpath in targets:
+            template = env.get_template(template_name)
+            chunks = template.generate(repo.patch_data)
+            source = Path(self.template_dir) / template_name
+            layer = overlay.CURRENT.get()
+            if layer is not None:
+                # Chained drivers: the file is held in memory, not streamed
+                rendered = "".join(chunks).encode("utf-8")
+                if layer.is_file(target_fullpath):
+                    if layer.read_bytes(target_fullpath) == rendered:
+                        continue
+                layer.write_bytes(target_fullpath, rendered, mode_from=source)
+                changed.append(target_name)
+            elif write_if_changed(target_fullpath, chunks):
+                shutil.copymode(source, target_fullpath)
+                changed.append(target_name)
+        if not changed:
+            return PatchResult(outcome=PatchOutcome.ALREADY_PATCHED)
+        self.logger.info(f"Rendered {len(changed)} changed files")
+        return PatchResult(
+            outcome=PatchOutcome.PATCHED_OK,
+            details="\n".join(f"{name}: PATCHED_OK" for name in changed),
+        )
+
+
+INDEX_LOADING = threading.Lock()
+"""Guard loading a driver's fingerprint index only once, across threads"""
+
+
+class FingerprintIndex:
+    """On-disk record of the last fingerprint rendered into each repo
+
+    Stored in SQLite, one row per repo: each update is a small atomic
+    transaction rather than a rewrite of the whole index, so an interrupted run
+    keeps the repos recorded so far. Safe to share across threads, and across
+    the processes of a parallel run.
+    """
+
+    def __init__(self, path: Path):
+        """Open the index, creating it if missing"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints "
+                "(repo_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)"
+            )
+
+    def get(self, repo_id: str) -> str | None:
+        """Get the last fingerprint recorded for a repo, if any"""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT fingerprint FROM fingerprints WHERE repo_id = ?", (repo_id,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def record(self, repo_id: str, fingerprint: str):
+        """Save a repo's fingerprint, replacing any previous one"""
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?)",
+                (repo_id, fingerprint),
+            )
+
+
+def digest(data) -> str:
+    """Hash JSON-able data, independently of key order
+
+    >>> digest({"a": 1, "b": [2]}) == digest({"b": [2], "a": 1})
+    True
+    """
+    serialized = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def write_if_changed(target: Path, chunks: Iterable[str]) -> bool:
+    """Stream rendered chunks to target, only if they differ from its content
+
+    Chunks are compared to the existing file as they come. Nothing is written
+    until the first difference: from there, the identical prefix is copied
+    over to a temporary file, followed by the remaining chunks, and the
+    temporary file replaces the target. Returns whether the target changed.
+    """
+    existing = open(target, "rb") if target.is_file() else None
+    out: IO[bytes] | None = None
+    matched = 0
+
+    def start_output() -> IO[bytes]:
+        """Open the temporary file, holding the prefix matched so far"""
+        target.parent.mkdir(parents=True, exist_ok=True)
+        output = tempfile.NamedTemporaryFile(dir=target.parent, delete=False)
+        if existing is not None:
+            existing.seek(0)
+            metrics.count("bytes_written", matched)
+            remaining = matched
+            while remaining:
+                block = existing.read(min(remaining, COPY_BLOCK_SIZE))
+                output.write(block)
+                remaining -= len(block)
+        return output
+
+    try:
+        for chunk in chunks:
+            data = chunk.encode("utf-8")
+            if out is None and existing is not None:
+                same = existing.read(len(data)) == data
+                metrics.count("bytes_read", len(data))
+                if same:
+                    matched += len(data)
+                    continue
+            if out is None:
+                out = start_output()
+            out.write(data)
+            metrics.count("bytes_written", len(data))
+        if out is None:
+            if existing is not None and not existing.read(1):
+                return False  # Same bytes, same length: up to date
+            out = start_output()  # Rendered only a prefix of what's on disk
+        out.close()
+        os.replace(out.name, target)
+        return True
+    except BaseException:
+        if out is not None:
+            out.close()
+            os.unlink(out.name)
+        raise
+    finally:
+        if existing is not None:
+            existing.close()
+
+
+COPY_BLOCK_SIZE = 64 * 1024
+"""How much of an unchanged prefix to copy at once"""
@@ -0,0 +1,299 @@
+"""Process-wide cache of tree-sitter languages, parsers and compiled queries
+
+Surgical drivers run over thousands of repositories within the same process,
+always with the same grammar and query. Loading the grammar and compiling the
+S-expression query is done once here, then reused by every repository.
+
+Parsed files are held as {py:class}`ParsedDocument`, which keeps the tree in
+sync with each edit via tree-sitter's incremental re-parsing, rather than
+parsing the whole file again.
+
+The tree-sitter libraries themselves are only imported on first use of a
+grammar, keeping drivers cheap to import (say to list or validate them).
+"""
+
+from __future__ import annotations
+
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from hashlib import sha256
+from typing import TYPE_CHECKING, Any, Iterable
+
+from mass_driver_plugins import metrics
+from mass_driver_plugins.splice import Edit, apply_edits, sorted_edits
+
+if TYPE_CHECKING:
+    from tree_sitter import Language, Node, Parser, Query, Tree
+
+Point = tuple[int, int]
+"""A tree-sitter (row, column) position, column counted in bytes"""
+
+
+class TreeSitterRegistry:
+    """Thread-safe cache of tree-sitter objects, keyed by (language, query text)
+
+    Languages and compiled queries are read-only once built, so one instance of
+    each is shared across all threads. Parsers hold state during a parse, so
+    each thread gets its own parser per language.
+
+    The trees of recently edited files are also kept, keyed by their content
+    hash, so that the next driver over the same file skips parsing entirely.
+
+    Hits and misses are counted in {py:attr}`counters`, to confirm the reuse is
+    happening over a whole activity.
+    """
+
+    def __init__(self, max_trees: int = 64):
+        """Start with empty caches"""
+        self._lock = threading.Lock()
+        self._languages: dict[str, Language] = {}
+        self._queries: dict[tuple[str, str], Query] = {}
+        self._trees: OrderedDict[tuple[str, bytes], Tree] = OrderedDict()
+        self._max_trees = max_trees
+        self._local = threading.local()
+        self.counters: Counter[str] = Counter()
+        """Hit/miss counts for languages, queries and parsers"""
+
+    def _count(self, kind: str, hit: bool):
+        """Record a cache hit or miss for given kind of object
+
+        Also counted in the current repo's metrics, if instrumented.
+        """
+        name = f"{kind}_{'hits' if hit else 'misses'}"
+        with self._lock:
+            self.counters[name] += 1
+        metrics.count(name)
+
+    def language(self, name: str) -> Language:
+        """Get the tree-sitter grammar of given name, loading it once"""
+        language = self._languages.get(name)
+        if language is not None:
+            self._count("language", hit=True)
+            return language
+        with self._lock:
+            # Double-checked: another thread may have loaded it while we waited
+            language = self._languages.get(name)
+            if language is None:
+                from tree_sitter_languages import get_language
+
+                language = get_language(name)
+                self._languages[name] = language
+        self._count("language", hit=False)
+        return language
+
+    def query(self, language_name: str, query_text: str) -> Query:
+        """Get the compiled query for given language, compiling it once"""
+        key = (language_name, query_text)
+        query = self._queries.get(key)
+        if query is not None:
+            self._count("query", hit=True)
+            return query
+        language = self.language(language_name)
+        with self._lock:
+            query = self._queries.get(key)
+            if query is None:
+                query = language.query(query_text)
+                self._queries[key] = query
+        self._count("query", hit=False)
+        return query
+
+    def parser(self, language_name: str) -> Parser:
+        """Get this thread's parser for given language, creating it once"""
+        parsers = getattr(self._local, "parsers", None)
+        if parsers is None:
+            parsers = self._local.parsers = {}
+        parser = parsers.get(language_name)
+        if parser is not None:
+            self._count("parser", hit=True)
+            return parser
+        from tree_sitter import Parser
+
+        parser = Parser()
+        parser.set_language(self.language(language_name))
+        parsers[language_name] = parser
+        self._count("parser", hit=False)
+        return parser
+
+    def parse(
+        self, language_name: str, content: bytes, old_tree: Tree | None = None
+    ) -> Tree:
+        """Parse content with this thread's parser for given language
+
+        Given the previous tree, already edited via {py:meth}`Tree.edit`,
+        only the changed parts of the content are re-parsed.
+        """
+        parser = self.parser(language_name)
+        with metrics.phase("parse"):
+            if old_tree is None:
+                return parser.parse(content)
+            return parser.parse(content, old_tree)
+
+    def document(self, language_name: str, content: bytes) -> "ParsedDocument":
+        """Parse content as a document, reusing a remembered tree if any"""
+        key = (language_name, sha256(content).digest())
+        with self._lock:
+            # Trees are mutable via edit(): hand over ownership, don't share
+            tree = self._trees.pop(key, None)
+        self._count("tree", hit=tree is not None)
+        if tree is None:
+            tree = self.parse(language_name, content)
+        return ParsedDocument(language_name, content, tree, registry=self)
+
+    def remember(self, document: "ParsedDocument"):
+        """Keep a document's tree, for the next parse of identical content
+
+        The document must not be edited further after this.
+        """
+        key = (document.language_name, sha256(document.content).digest())
+        with self._lock:
+            self._trees[key] = document.tree
+            self._trees.move_to_end(key)
+            while len(self._trees) > self._max_trees:
+                self._trees.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        """Get a snapshot of the hit/miss counters"""
+        with self._lock:
+            return dict(self.counters)
+
+    def clear(self):
+        """Forget all cached objects and reset counters"""
+        with self._lock:
+            self._languages.clear()
+            self._queries.clear()
+            self._trees.clear()
+            self._local = threading.local()
+            self.counters.clear()
+
+
+class ParsedDocument:
+    """A file's content along with its tree-sitter tree, kept in sync on edits
+
+    Each call to {py:meth}`apply` records the edits on the tree via
+    {py:meth}`Tree.edit`, then re-parses incrementally with the old tree. This
+    allows several rounds of query, refine and edit on the same file, each
+    costing only the re-parse of what changed.
+    """
+
+    def __init__(
+        self,
+        language_name: str,
+        content: bytes,
+        tree: Tree,
+        registry: TreeSitterRegistry,
+    ):
+        """Wrap an already parsed content"""
+        self.language_name = language_name
+        """The tree-sitter grammar name the content was parsed with"""
+        self.content = content
+        """The current bytes of the file"""
+        self.tree = tree
+        """The tree of the current content"""
+        self.registry = registry
+        """The registry to get queries and parsers from"""
+
+    @property
+    def root_node(self) -> Node:
+        """Get the root node of the current tree"""
+        return self.tree.root_node
+
+    def captures(self, query_text: str) -> list[tuple[Node, str]]:
+        """Run the (cached) query over the current tree"""
+        query = self.registry.query(self.language_name, query_text)
+        with metrics.phase("query"):
+            captures = query.captures(self.tree.root_node)
+        metrics.count("captures", len(captures))
+        return captures
+
+    def matches(self, query_text: str) -> list[tuple[int, dict[str, Any]]]:
+        """Run the (cached) query over the current tree, grouped by match
+
+        Each match maps capture names to nodes, or to lists of nodes for
+        quantified captures (like `@item+`).
+        """
+        query = self.registry.query(self.language_name, query_text)
+        with metrics.phase("query"):
+            matches = query.matches(self.tree.root_node)
+        metrics.count("matches", len(matches))
+        return matches
+
+    def apply(self, edits: Iterable[Edit]):
+        """Splice the edits into the content, re-parsing incrementally
+
+        Nodes from before the edit are stale afterwards: query again.
+        """
+        ordered = sorted_edits(edits, len(self.content))
+        if not ordered:
+            return
+        metrics.count("edits", len(ordered))
+        with metrics.phase("edit"):
+            newlines = newline_offsets(self.content)
+            # From last to first, so earlier edits' offsets remain valid
+            for start, end, replacement in reversed(ordered):
+                start_point = point_at(self.content, start, newlines)
+                self.tree.edit(
+                    start_byte=start,
+                    old_end_byte=end,
+                    new_end_byte=start + len(replacement),
+                    start_point=start_point,
+                    old_end_point=point_at(self.content, end, newlines),
+                    new_end_point=point_after(start_point, replacement),
+                )
+            self.content = apply_edits(self.content, ordered)
+        self.tree = self.registry.parse(self.language_name, self.content, self.tree)
+
+    def replace(self, content: bytes):
+        """Replace the whole content, re-parsing from scratch"""
+        self.content = content
+        self.tree = self.registry.parse(self.language_name, content)
+
+
+def point_at(content: bytes, offset: int, newlines: list[int] | None = None) -> Point:
+    r"""Get the (row, byte column) of given byte offset in content
+
+    Given the {py:func}`newline_offsets` of content, the row is found by
+    bisection, rather than counting newlines: use this for many offsets.
+
+    >>> point_at(b"ab\ncd", 4)
+    (1, 1)
+    >>> point_at(b"ab\ncd", 4, newline_offsets(b"ab\ncd"))
+    (1, 1)
+    """
+    if newlines is None:
+        row = content.count(b"\n", 0, offset)
+        line_start = content.rfind(b"\n", 0, offset) + 1
+        return (row, offset - line_start)
+    row = bisect_left(newlines, offset)
+    line_start = newlines[row - 1] + 1 if row else 0
+    return (row, offset - line_start)
+
+
+def newline_offsets(content: bytes) -> list[int]:
+    r"""List the byte offsets of all newlines in content
+
+    >>> newline_offsets(b"a\nb\n")
+    [1, 3]
+    """
+    return [match.start() for match in NEWLINE.finditer(content)]
+
+
+NEWLINE = re.compile(b"\n")
+"""A newline, whatever the line ending (CRLF ends with it too)"""
+
+
+def point_after(start: Point, inserted: bytes) -> Point:
+    r"""Get the (row, byte column) reached after inserting bytes at start
+
+    >>> point_after((3, 4), b"x\nyz")
+    (4, 2)
+    """
+    newlines = inserted.count(b"\n")
+    if not newlines:
+        return (start[0], start[1] + len(inserted))
+    return (start[0] + newlines, len(inserted) - inserted.rfind(b"\n") - 1)
+
+
+REGISTRY = TreeSitterRegistry()
+"""The registry shared by all drivers of this process"""
@@ -0,0 +1,63 @@
+"""Per-thread pool of configured ruamel YAML instances
+
+Building a `ruamel.yaml.YAML` object (and its configuration) is not free, and
+the instance holds state while loading or dumping, so it can't be shared across
+threads. Each thread instead gets its own instance, built once, then reused for
+every file that thread processes. ruamel.yaml is only imported when the first
+instance is built.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from ruamel import yaml
+
+
+class YamlPool:
+    """Thread-local cache of YAML instances, all built by the same factory"""
+
+    def __init__(self, factory: Callable[[], yaml.YAML]):
+        """Start empty: each thread builds its instance on first use"""
+        self._factory = factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.created = 0
+        """How many instances were built, across all threads"""
+
+    def get(self) -> yaml.YAML:
+        """Get this thread's YAML instance, building it on first use"""
+        instance = getattr(self._local, "instance", None)
+        if instance is None:
+            instance = self._local.instance = self._factory()
+            with self._lock:
+                self.created += 1
+        return instance
+
+    def discard(self):
+        """Drop this thread's instance, say after it failed mid-way"""
+        self._local.instance = None
+
+
+def round_trip_yaml() -> yaml.YAML:
+    """Create a YAML instance keeping comments, with the repo's indentation"""
+    from ruamel import yaml
+
+    instance = yaml.YAML(typ="rt")
+    instance.indent(mapping=2, sequence=4, offset=2)
+    return instance
+
+
+def safe_yaml() -> yaml.YAML:
+    """Create a YAML instance decoding plain data, for snippets"""
+    from ruamel import yaml
+
+    return yaml.YAML(typ="safe", pure=True)
+
+
+ROUND_TRIP = YamlPool(round_trip_yaml)
+"""Round-trip instances, for patching whole files"""
+SAFE = YamlPool(safe_yaml)
+"""Safe instances, for decoding scalars"""
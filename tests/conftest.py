@@ -0,0 +1,54 @@
+"""Fixtures shared by the driver tests"""
+
+import logging
+from pathlib import Path
+
+import pytest
+from mass_driver.models.repository import ClonedRepo
+
+
+def cloned_repo(path: Path) -> ClonedRepo:
+    """Describe a folder as a repo cloned by mass-driver"""
+    return ClonedRepo(
+        clone_url=str(path),
+        repo_id="test_repo",
+        cloned_path=path,
+        current_branch="main",
+    )
+
+
+@pytest.fixture
+def repo_at():
+    """Get a function describing any folder as a cloned repo"""
+    return cloned_repo
+
+
+@pytest.fixture
+def repo(tmp_path) -> ClonedRepo:
+    """Describe the test's temporary folder as a cloned repo"""
+    return cloned_repo(tmp_path)
+
+
+@pytest.fixture
+def with_logger():
+    """Get a function giving a driver its logger, as mass-driver would"""
+
+    def attach(driver):
+        driver._logger = logging.getLogger("test")
+        return driver
+
+    return attach
+
+
+@pytest.fixture
+def record_timing(record_testsuite_property, request):
+    """Get a function reporting a benchmark value in the junit XML report
+
+    Values go to the test suite's properties, prefixed by the test's name, as
+    per-test properties aren't supported by the xunit2 junit format.
+    """
+
+    def record(name: str, value):
+        record_testsuite_property(f"{request.node.name}.{name}", value)
+
+    return record
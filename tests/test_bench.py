@@ -0,0 +1,59 @@
+"""Validate the benchmark suite, on tiny inputs"""
+
+import json
+
+import pytest
+
+from mass_driver_plugins import bench
+from mass_driver_plugins.cli import cli
+
+
+@pytest.mark.parametrize("name", list(bench.CASES))
+def test_bench_case(name):
+    """Check each benchmark's driver patches its generated input"""
+    result = bench.run_case(name, bench.CASES[name], scale=0.02, repeat=1)
+    assert result["outcome"] == "PATCHED_OK"
+    assert result["best_seconds"] > 0
+    assert result["throughput_mb_s"] > 0
+    assert result["peak_memory_mb"] > 0
+    assert result["max_rss_mb"] > result["peak_memory_mb"]
+
+
+def test_bench_scale():
+    """Check the scale factor sizes the generated inputs"""
+    small = bench.large_json(0.01).files["data.json"]
+    large = bench.large_json(0.1).files["data.json"]
+    assert 9 < len(large) / len(small) < 11
+    # And the description of the inputs follows
+    assert bench.large_json(0.1).size == "2000 items"
+
+
+def test_cli_bench(tmp_path, capsys):
+    """Scenario: Run benchmarks from the command line, saving results"""
+    output = tmp_path / "bench.json"
+    cli(
+        [
+            "bench",
+            "--case",
+            "template",
+            "--case",
+            "json",
+            "--scale",
+            "0.01",
+            "--repeat",
+            "1",
+            "-o",
+            str(output),
+        ]
+    )
+    report = json.loads(output.read_text())
+    assert [r["case"] for r in report["results"]] == ["template", "json"]
+    assert report["scale"] == 0.01
+    assert "jsonpatch" in capsys.readouterr().out
+
+
+def test_cli_bench_rejects_no_repeat(capsys):
+    """Check benchmarks need at least one timed run"""
+    with pytest.raises(SystemExit):
+        cli(["bench", "--repeat", "0"])
+    assert "must be at least 1" in capsys.readouterr().err
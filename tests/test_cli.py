@@ -0,0 +1,180 @@
+"""Validate the command line, in particular the parallel dry-run"""
+
+import json
+from pathlib import Path
+
+import pytest
+
+from mass_driver_plugins import dryrun
+from mass_driver_plugins.cli import cli
+
+TEMPLATE_CONFIG = """\
+target_file = "README.md"
+template = "# {{ title.capitalize() }}"
+"""
+
+
+def make_mirror(path: Path) -> Path:
+    """Create a directory of (empty) repos, and a hidden non-repo folder"""
+    for name in ["alpha", "beta", "gamma"]:
+        (path / name).mkdir(parents=True)
+    (path / ".cache").mkdir()
+    return path
+
+
+def test_cli_lists_drivers(capsys):
+    """Scenario: List drivers when given no command"""
+    cli([])
+    assert "jsonpatch" in capsys.readouterr().out.splitlines()
+
+
+def test_cli_run(tmp_path, capsys):
+    """Scenario: Dry-run a driver over a directory of repos"""
+    # Given a directory of cloned repos, and patch data for some of them
+    mirror = make_mirror(tmp_path / "mirror")
+    config = tmp_path / "templater.toml"
+    config.write_text(TEMPLATE_CONFIG)
+    patch_data = tmp_path / "patch_data.json"
+    patch_data.write_text(json.dumps({"alpha": {"title": "a"}, "beta": {"title": "b"}}))
+    # When I run the driver over it
+    cli(
+        [
+            "run",
+            "templater",
+            str(config),
+            str(mirror),
+            "-j2",
+            "--patch-data",
+            str(patch_data),
+        ]
+    )
+    captured = capsys.readouterr()
+    # Then each repo's result is printed as a JSON line
+    results = {
+        line["repo"]: line for line in map(json.loads, captured.out.splitlines())
+    }
+    assert sorted(results) == ["alpha", "beta", "gamma"]
+    assert results["alpha"]["outcome"] == "PATCHED_OK"
+    assert results["beta"]["seconds"] >= 0
+    # And driver errors are reported per repo, not crashing the run
+    assert results["gamma"]["outcome"] == "PATCH_ERROR"
+    assert "3 repos" in captured.err
+    # And the repos themselves are left untouched
+    assert not (mirror / "alpha" / "README.md").exists()
+
+
+def test_cli_run_in_place(tmp_path, capsys):
+    """Scenario: Run a driver over the repos themselves, from an activity file"""
+    # Given a directory of repos, and an activity file
+    mirror = tmp_path / "mirror"
+    (mirror / "alpha").mkdir(parents=True)
+    activity = tmp_path / "activity.toml"
+    activity.write_text(
+        "[mass-driver.migration]\n"
+        'driver_name = "templater"\n'
+        "[mass-driver.migration.driver_config]\n" + TEMPLATE_CONFIG
+    )
+    (tmp_path / "data.json").write_text(json.dumps({"alpha": {"title": "alpha"}}))
+    # When I run it in place
+    cli(
+        [
+            "run",
+            "templater",
+            str(activity),
+            str(mirror),
+            "--in-place",
+            "--patch-data",
+            str(tmp_path / "data.json"),
+        ]
+    )
+    # Then the repo itself is patched
+    assert (mirror / "alpha" / "README.md").read_text() == "# Alpha"
+    assert json.loads(capsys.readouterr().out)["outcome"] == "PATCHED_OK"
+
+
+def test_cli_run_keeps_state_off_disk(tmp_path, capsys):
+    """Scenario: Dry-runs over copies don't record fingerprints or memos"""
+    # Given repos, and a config with a fingerprint index and memo folder
+    mirror = make_mirror(tmp_path / "mirror")
+    index = tmp_path / "index.db"
+    config = tmp_path / "templater.toml"
+    config.write_text(f'fingerprint_index = "{index}"\n' + TEMPLATE_CONFIG)
+    (tmp_path / "data.json").write_text(json.dumps({"alpha": {"title": "a"}}))
+    # When I run the driver over copies of them
+    cli(
+        [
+            "run",
+            "templater",
+            str(config),
+            str(mirror),
+            "--patch-data",
+            str(tmp_path / "data.json"),
+        ]
+    )
+    # Then the repo was patched, without creating the real index
+    results = {
+        line["repo"]: line["outcome"]
+        for line in map(json.loads, capsys.readouterr().out.splitlines())
+    }
+    assert results["alpha"] == "PATCHED_OK"
+    assert not index.exists()
+    # And a pipeline's step configs are redirected the same way
+    memo = str(tmp_path / "memo")
+    config = {"steps": [{"driver": "x", "driver_config": {"memo_dir": memo}}]}
+    scratch = dryrun.scratch_config(config, tmp_path / "scratch", {})
+    assert scratch["steps"][0]["driver_config"]["memo_dir"].startswith(
+        str(tmp_path / "scratch")
+    )
+
+
+def test_cli_run_repo_relative_paths(tmp_path, capsys):
+    """Scenario: Driver configs with file paths are validated within the repos"""
+    # Given repos with a JSON file, and a config pointing at it, relative to repo
+    mirror = make_mirror(tmp_path / "mirror")
+    for name in ["alpha", "beta"]:
+        (mirror / name / "x.json").write_text('{"a": 1}')
+    config = tmp_path / "jsonpatch.toml"
+    config.write_text(
+        'target_file = "x.json"\n'
+        'patch = [{op = "replace", path = "/a", value = 2}]\n'
+    )
+    # When I run the driver over them, from elsewhere
+    cli(["run", "jsonpatch", str(config), str(mirror), "-j2"])
+    # Then repos having the file are patched, the others not
+    results = {
+        line["repo"]: line["outcome"]
+        for line in map(json.loads, capsys.readouterr().out.splitlines())
+    }
+    assert results == {
+        "alpha": "PATCHED_OK",
+        "beta": "PATCHED_OK",
+        "gamma": "PATCH_DOES_NOT_APPLY",
+    }
+    # And a config valid in no repo is reported cleanly
+    config.write_text('target_file = "y.json"\npatch = []\n')
+    with pytest.raises(SystemExit, match="Invalid config for jsonpatch"):
+        cli(["run", "jsonpatch", str(config), str(mirror)])
+
+
+def test_cli_describe_validate(tmp_path, capsys):
+    """Scenario: Describe a driver, then validate configs against it"""
+    cli(["describe", "templater"])
+    schema = json.loads(capsys.readouterr().out)
+    assert "template_dir" in schema["properties"]
+    config = tmp_path / "templater.toml"
+    config.write_text(TEMPLATE_CONFIG)
+    cli(["validate", "templater", str(config)])
+    assert "Valid config" in capsys.readouterr().out
+    # Templates and template folders are mutually exclusive
+    config.write_text(TEMPLATE_CONFIG + 'template_dir = "templates"\n')
+    with pytest.raises(SystemExit, match="Invalid config for templater"):
+        cli(["validate", "templater", str(config)])
+
+
+def test_cli_run_rejects_no_workers(tmp_path, capsys):
+    """Check running needs at least one worker"""
+    config = tmp_path / "templater.toml"
+    config.write_text(TEMPLATE_CONFIG)
+    with pytest.raises(SystemExit):
+        cli(["run", "templater", str(config), str(tmp_path), "-j", "0"])
+    assert "must be at least 1" in capsys.readouterr().err
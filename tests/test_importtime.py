@@ -0,0 +1,106 @@
+"""Check the CLI and drivers stay fast to import
+
+Each check runs in a fresh interpreter, as this test session has already
+imported everything.
+"""
+
+import json
+import re
+import subprocess  # noqa: S404 # Fresh interpreters, running our own code
+import sys
+
+CLI_IMPORT_BUDGET_US = 100_000
+"""Cumulative import time allowed for the CLI module, in microseconds"""
+
+HEAVY_MODULES = [
+    "jinja2",
+    "ruamel.yaml",
+    "jsonpatch",
+    "tree_sitter",
+    "tree_sitter_languages",
+    "poetry.core.packages",
+]
+"""Libraries that only running a driver should import"""
+
+DRIVERS = [
+    "jsonpatch",
+    "yamlpatch",
+    "templater",
+    "surgical-base",
+    "surgical-ghactionparamswitch",
+    "surgical-query",
+    "poetry-surgical",
+    "pipeline",
+]
+"""The packaged drivers, by entry point name"""
+
+
+def run_python(code: str, *flags: str) -> subprocess.CompletedProcess:
+    """Run Python code in a new interpreter, capturing its output"""
+    return subprocess.run(  # noqa: S603 # Our own interpreter and code
+        [sys.executable, *flags, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_cli_import_budget():
+    """Check importing the CLI stays within its time budget"""
+    process = run_python("import mass_driver_plugins.cli", "-X", "importtime")
+    match = re.search(
+        r"^import time:\s+\d+ \|\s+(\d+) \| mass_driver_plugins\.cli$",
+        process.stderr,
+        re.MULTILINE,
+    )
+    assert match is not None, process.stderr
+    assert int(match.group(1)) < CLI_IMPORT_BUDGET_US, process.stderr
+
+
+def test_cli_listing_imports_no_driver():
+    """Check listing drivers reads entry points without importing drivers"""
+    process = run_python(
+        "import sys\n"
+        "from mass_driver_plugins.cli import cli\n"
+        "cli([])\n"
+        "print(sorted(m for m in sys.modules if m.startswith(('mass_driver', 'pydantic'))))"
+    )
+    *drivers, imported = process.stdout.splitlines()
+    assert set(DRIVERS) <= set(drivers)
+    assert imported == "['mass_driver_plugins', 'mass_driver_plugins.cli']"
+
+
+def test_driver_config_imports_no_heavy_library(tmp_path):
+    """Check describing and validating drivers leaves heavy libraries unloaded"""
+    config = tmp_path / "templater.toml"
+    config.write_text('target_file = "README.md"\ntemplate = "# {{ title }}"\n')
+    code = f"""
+import contextlib, io, json, sys
+from mass_driver_plugins.cli import cli
+with contextlib.redirect_stdout(io.StringIO()):
+    for driver in {DRIVERS!r}:
+        cli(["describe", driver])
+    cli(["validate", "templater", {str(config)!r}])
+print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))
+"""
+    process = run_python(code)
+    assert json.loads(process.stdout) == []
+
+
+def test_driver_run_imports_library(tmp_path):
+    """Check the heavy libraries are loaded on first run, as needed"""
+    code = f"""
+import json, logging, sys
+from mass_driver.models.repository import ClonedRepo
+from mass_driver_plugins.template import TemplatedFile
+driver = TemplatedFile(target_file="README.md", template="# {{{{ title }}}}")
+driver._logger = logging.getLogger("test")
+repo = ClonedRepo(
+    clone_url="", repo_id="r", cloned_path={str(tmp_path)!r}, current_branch="main"
+)
+before = "jinja2" in sys.modules
+driver.run(repo)
+print(json.dumps([before, "jinja2" in sys.modules]))
+"""
+    process = run_python(code)
+    assert json.loads(process.stdout) == [False, True]
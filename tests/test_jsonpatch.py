@@ -1,13 +1,26 @@
 """Validate the template"""
 
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import jsonpatch
 import pytest
 
 # from mass_driver.migration import Migration
 from mass_driver.models.patchdriver import PatchOutcome
 from mass_driver.tests.fixtures import copy_folder, massdrive
 
+from mass_driver_plugins import jsonformat
+from mass_driver_plugins.jsonpatch import (
+    JsonPatch,
+    JsonPatchBase,
+    YamlPatch,
+    apply_in_place,
+)
+from mass_driver_plugins.yamlpool import ROUND_TRIP
+
 
 @pytest.mark.parametrize(
     "config_filename",
@@ -39,3 +52,361 @@ def test_template_expansion(tmp_path, datadir, config_filename, monkeypatch):
     # assert (
     #     int(counter_text_post) == migration.driver.target_count
     # ), "Counter not updated properly"
+
+
+@pytest.mark.parametrize(
+    "driver_class,filename",
+    [
+        (JsonPatch, "sample.json"),
+        (YamlPatch, "sample.yaml"),
+    ],
+)
+def test_rerun_already_patched(datadir, driver_class, filename, repo_at, with_logger):
+    """Scenario: Re-running a patch over its own output changes nothing"""
+    # Given a sample repo, and a driver patching its file
+    repo_path = datadir / "sample_repo"
+    repo = repo_at(repo_path)
+    patch = [{"op": "replace", "path": "/foo", "value": "qux"}]
+    driver = driver_class(target_file=repo_path / filename, patch=patch)
+    with_logger(driver)
+    # When I patch the file twice
+    first = driver.run(repo)
+    patched_mtime = (repo_path / filename).stat().st_mtime_ns
+    second = driver.run(repo)
+    # Then the second run detects the no-op, and doesn't write the file
+    assert first.outcome == PatchOutcome.PATCHED_OK
+    assert second.outcome == PatchOutcome.ALREADY_PATCHED
+    assert (repo_path / filename).stat().st_mtime_ns == patched_mtime
+
+
+def test_in_place_rollback():
+    """Scenario: A failing test op in place leaves the document as loaded"""
+    # Given a document and a patch failing half-way through
+    document = {"foo": "bar", "numbers": [1, 3, 4, 8]}
+    patch = jsonpatch.JsonPatch(
+        [
+            {"op": "remove", "path": "/numbers/0"},
+            {"op": "add", "path": "/foo", "value": "baz"},
+            {"op": "test", "path": "/foo", "value": "nope"},
+        ]
+    )
+    # When I apply it in place
+    with pytest.raises(jsonpatch.JsonPatchTestFailed):
+        apply_in_place(document, patch)
+    # Then the document is rolled back
+    assert document == {"foo": "bar", "numbers": [1, 3, 4, 8]}
+
+
+@pytest.mark.parametrize("in_place", [True, False])
+@pytest.mark.parametrize(
+    "patch,outcome",
+    [
+        ([{"op": "replace", "path": "/numbers/0", "value": 2}], "PATCHED_OK"),
+        ([{"op": "replace", "path": "/foo", "value": "bar"}], "ALREADY_PATCHED"),
+        ([{"op": "test", "path": "/foo", "value": "nope"}], "PATCH_ERROR"),
+    ],
+)
+def test_in_place_outcomes(datadir, in_place, patch, outcome, repo_at, with_logger):
+    """Scenario: In-place and copying modes agree on outcomes"""
+    repo_path = datadir / "sample_repo"
+    repo = repo_at(repo_path)
+    original = (repo_path / "sample.json").read_text()
+    driver = JsonPatch(target_file=repo_path / "sample.json", patch=patch)
+    driver.in_place = in_place
+    with_logger(driver)
+    # When I apply the patch
+    result = driver.run(repo)
+    # Then the outcome is the same either way, file untouched unless patched
+    assert result.outcome == PatchOutcome(outcome), result.details
+    if outcome != "PATCHED_OK":
+        assert (repo_path / "sample.json").read_text() == original
+
+
+@pytest.mark.parametrize(
+    "original",
+    [
+        '{\n  "foo": "bar",\n  "zeta": [\n    1,\n    {}\n  ],\n  "alpha": 2\n}\n',
+        '{\r\n\t"foo": "bar",\r\n\t"na\u00efve": "caf\u00e9"\r\n}',
+        '{"foo":"bar","big":123456789012345678901234567890}',
+        '{"foo": "bar", "text": "a, b: c", "ascii": "\\u00e9"}\n',
+    ],
+    ids=["indent2", "tab-crlf-unicode", "compact-bigint", "escaped"],
+)
+def test_json_format_preserved(tmp_path, original, repo, with_logger):
+    """Scenario: Patched JSON keeps its original formatting"""
+    # Given a JSON file in some particular style
+    target = tmp_path / "sample.json"
+    target.write_bytes(original.encode())
+    patch = [{"op": "replace", "path": "/foo", "value": "qüx"}]
+    driver = JsonPatch(target_file=target, patch=patch)
+    with_logger(driver)
+    # When I patch a value
+    result = driver.run(repo)
+    # Then only that value changed in the file
+    assert result.outcome == PatchOutcome.PATCHED_OK, result.details
+    patched = target.read_bytes().decode()
+    _, style = jsonformat.load(original.encode())
+    new_value = json.dumps("qüx", ensure_ascii=style.ensure_ascii)
+    assert patched == original.replace('"bar"', new_value)
+
+
+def best_time(func, repeat: int = 3) -> float:
+    """Time the fastest of a few calls of func, in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def test_json_backend_large_file(record_timing):
+    """Benchmark: format-preserving backend vs stdlib json on a large file"""
+    # Given a large indented JSON document
+    document = {
+        f"key{i}": {"name": f"item {i}", "tags": ["a", "b"], "value": i}
+        for i in range(20_000)
+    }
+    raw = json.dumps(document, indent=2).encode() + b"\n"
+    # When I round-trip it: plain stdlib, stdlib keeping indent, and backend
+    stdlib_output = json.dumps(json.loads(raw)).encode()
+    data, style = jsonformat.load(raw)
+    backend_output = jsonformat.dump(data, style)
+    record_timing("stdlib_seconds", best_time(lambda: json.dumps(json.loads(raw))))
+    record_timing(
+        "stdlib_indent_seconds",
+        best_time(lambda: json.dumps(json.loads(raw), indent=2)),
+    )
+    record_timing(
+        "backend_seconds",
+        best_time(lambda: jsonformat.dump(*jsonformat.load(raw))),
+    )
+    record_timing("orjson", jsonformat.orjson is not None)
+    # Then the backend gives back the file as it was, unlike plain json.dump
+    assert backend_output == raw
+    assert stdlib_output != raw
+
+
+SURGICAL_YAML = """# Deployment settings
+name: 'app'   # quoted on purpose
+image:
+  repository: example/app
+  tag: "1.0"
+ports: [80, 443]
+env:
+  - name: DEBUG
+    value: "false"
+"""
+
+
+@pytest.mark.parametrize(
+    "operation,expected",
+    [
+        (
+            {"op": "replace", "path": "/image/tag", "value": "2.0"},
+            SURGICAL_YAML.replace('tag: "1.0"', 'tag: "2.0"'),
+        ),
+        (
+            {"op": "replace", "path": "/name", "value": "it's"},
+            SURGICAL_YAML.replace("'app'", "'it''s'"),
+        ),
+        (
+            {"op": "add", "path": "/image/pullPolicy", "value": "Always"},
+            SURGICAL_YAML.replace('tag: "1.0"\n', 'tag: "1.0"\n  pullPolicy: Always\n'),
+        ),
+        (
+            {"op": "remove", "path": "/ports/0"},
+            SURGICAL_YAML.replace("[80, 443]", "[443]"),
+        ),
+        (
+            {"op": "remove", "path": "/image/repository"},
+            SURGICAL_YAML.replace("  repository: example/app\n", ""),
+        ),
+        (
+            {"op": "replace", "path": "/env/0/value", "value": True},
+            SURGICAL_YAML.replace('value: "false"', "value: true"),
+        ),
+    ],
+    ids=[
+        "double-quoted",
+        "single-quoted",
+        "add-key",
+        "flow-remove",
+        "block-remove",
+        "bool",
+    ],
+)
+def test_surgical_yaml(tmp_path, operation, expected, repo, with_logger):
+    """Scenario: Surgical mode only rewrites the patched values"""
+    # Given a commented YAML file
+    target = tmp_path / "values.yaml"
+    target.write_text(SURGICAL_YAML)
+    driver = YamlPatch(target_file=target, patch=[operation], surgical=True)
+    with_logger(driver)
+    # When I patch it surgically
+    result = driver.run(repo)
+    # Then only the patched value changed, comments and quoting kept
+    assert result.outcome == PatchOutcome.PATCHED_OK, result.details
+    assert target.read_text() == expected
+
+
+@pytest.mark.parametrize(
+    "driver_class,original",
+    [(JsonPatch, '{"a": true, "b": 1}\n'), (YamlPatch, "a: true\nb: 1\n")],
+    ids=["json", "yaml"],
+)
+def test_surgical_test_type_strict(tmp_path, driver_class, original, repo, with_logger):
+    """Scenario: A surgical test op is as strict as the full patch's"""
+    # Given a file holding a boolean, and a patch testing it against a number
+    target = tmp_path / "sample"
+    target.write_text(original)
+    patch = [
+        {"op": "test", "path": "/a", "value": 1},
+        {"op": "replace", "path": "/b", "value": 2},
+    ]
+    driver = driver_class(target_file=target, patch=patch, surgical=True)
+    with_logger(driver)
+    # When I patch it surgically
+    result = driver.run(repo)
+    # Then the test fails, as `true` isn't `1`, and the file is left untouched
+    assert result.outcome == PatchOutcome.PATCH_ERROR, result.details
+    assert target.read_text() == original
+
+
+@pytest.mark.parametrize(
+    "driver_class,filename", [(JsonPatch, "sample.json"), (YamlPatch, "sample.yaml")]
+)
+def test_surgical_matches_full_patch(
+    tmp_path, datadir, driver_class, filename, repo_at, with_logger
+):
+    """Scenario: Surgical and full patching give the same data"""
+    # Given the sample files, and a patch mixing surgical and fallback ops
+    patch = [
+        {"op": "test", "path": "/foo", "value": "bar"},
+        {"op": "replace", "path": "/foo", "value": "baz"},
+        {"op": "add", "path": "/extra", "value": {"nested": [1, "two"]}},
+        {"op": "remove", "path": "/numbers/1"},
+    ]
+    original = (datadir / "sample_repo" / filename).read_bytes()
+    results = []
+    for surgical in (True, False):
+        target = tmp_path / str(surgical) / filename
+        target.parent.mkdir()
+        target.write_bytes(original)
+        driver = driver_class(target_file=target, patch=patch, surgical=surgical)
+        with_logger(driver)
+        repo = repo_at(target.parent)
+        # When I patch the file both ways
+        assert driver.run(repo).outcome == PatchOutcome.PATCHED_OK
+        results.append(driver.load(target.read_bytes())[0])
+    # Then the data is the same either way
+    assert results[0] == results[1]
+
+
+def test_surgical_yaml_large_file(tmp_path, repo, with_logger, record_timing):
+    """Benchmark: surgical vs full YAML patching on a large file"""
+    # Given a large YAML file
+    items = "".join(
+        f"  - name: item{i}  # comment {i}\n    value: '{i}'\n" for i in range(300)
+    )
+    content = f"version: '1'\nitems:\n{items}"
+    target = tmp_path / "big.yaml"
+    patch = [{"op": "replace", "path": "/items/299/value", "value": "last"}]
+    outputs = {}
+    for surgical in (True, False):
+        target.write_text(content)
+        driver = YamlPatch(target_file=target, patch=patch, surgical=surgical)
+        with_logger(driver)
+        # When I patch a single value, surgically or not
+        start = time.perf_counter()
+        assert driver.run(repo).outcome == PatchOutcome.PATCHED_OK
+        record_timing(f"surgical_{surgical}_seconds", time.perf_counter() - start)
+        outputs[surgical] = target.read_text()
+    # Then surgical mode only touches the patched value, keeping its quotes
+    expected = content.replace("value: '299'", "value: 'last'")
+    assert outputs[True] == expected
+    # Whereas the full round-trip reflows the quoting of that value
+    assert outputs[False] != expected
+    assert outputs[False] == content.replace("value: '299'", "value: last")
+
+
+@pytest.mark.parametrize("in_place", [True, False])
+def test_reorder_only_patch_is_written(tmp_path, in_place, repo, with_logger):
+    """Scenario: A patch only reordering keys still changes the file"""
+    # Given a JSON file, and a patch moving a key to the end, by round-trip
+    target = tmp_path / "sample.json"
+    target.write_text('{"a": 1, "b": 2}\n')
+    patch = [
+        {"op": "move", "from": "/a", "path": "/a2"},
+        {"op": "move", "from": "/a2", "path": "/a"},
+    ]
+    driver = JsonPatch(target_file=target, patch=patch, in_place=in_place)
+    with_logger(driver)
+    # When I apply it
+    result = driver.run(repo)
+    # Then the new key order is written, in both modes
+    assert result.outcome == PatchOutcome.PATCHED_OK
+    assert target.read_text() == '{"b": 2, "a": 1}\n'
+
+
+def test_json_non_finite_floats_kept():
+    """Scenario: NaN and Infinity survive a round-trip, even via orjson"""
+    # Given compact JSON holding non-finite floats, as stdlib json reads them
+    raw = b'{"a":NaN,"b":[Infinity,1.5]}'
+    # When I load and dump it back
+    data, style = jsonformat.load(raw)
+    # Then they're not turned to null
+    assert jsonformat.dump(data, style) == raw
+
+
+class LegacyJsonPatch(JsonPatchBase):
+    """Downstream-style subclass, implementing the file-object methods only"""
+
+    def deserialize(self, fd) -> dict:
+        """Load a data-tree particular file language of the day"""
+        return json.load(fd)
+
+    def serialize(self, file_dict: dict, fd):
+        """Dump a data-tree back to string in the particular file language of the day"""
+        json.dump(file_dict, fd)
+
+
+def test_legacy_serialize_signatures(tmp_path, repo, with_logger):
+    """Scenario: Subclasses using deserialize(fd)/serialize(dict, fd) still work"""
+    target = tmp_path / "sample.json"
+    target.write_text('{"foo": "bar"}')
+    patch = [{"op": "replace", "path": "/foo", "value": "qux"}]
+    driver = LegacyJsonPatch(target_file=target, patch=patch)
+    with_logger(driver)
+    # When I patch via the subclass
+    result = driver.run(repo)
+    # Then it is written through its own serialize
+    assert result.outcome == PatchOutcome.PATCHED_OK
+    assert target.read_text() == '{"foo": "qux"}'
+
+
+def test_yaml_patch_shared_across_threads(tmp_path, monkeypatch, repo_at, with_logger):
+    """Scenario: One YamlPatch driver patches many repos concurrently"""
+    # Given many repos, each with its own distinct YAML file
+    repos = []
+    for i in range(48):
+        repo_path = tmp_path / f"repo{i}"
+        repo_path.mkdir()
+        (repo_path / "values.yaml").write_text(f"# repo {i}\nid: {i}\nfoo: bar\n")
+        repos.append(repo_at(repo_path))
+    patch = [{"op": "replace", "path": "/foo", "value": "qux"}]
+    # Target file is validated from the current directory, as by mass-driver
+    monkeypatch.chdir(repos[0].cloned_path)
+    driver = YamlPatch(target_file="values.yaml", patch=patch)
+    with_logger(driver)
+    created_before = ROUND_TRIP.created
+    # When I run the same driver over all of them, in parallel
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(driver.run, repos))
+    # Then each file got its own content back, patched
+    assert all(r.outcome == PatchOutcome.PATCHED_OK for r in results)
+    for i, repo in enumerate(repos):
+        patched = (Path(repo.cloned_path) / "values.yaml").read_text()
+        assert patched == f"# repo {i}\nid: {i}\nfoo: qux\n"
+    # And YAML instances were built at most once per thread, not per file
+    assert ROUND_TRIP.created - created_before <= 8
@@ -0,0 +1,110 @@
+"""Validate the memoization of results across repos"""
+
+from pathlib import Path
+
+from mass_driver.models.patchdriver import PatchOutcome
+
+from mass_driver_plugins.jsonpatch import JsonPatch
+from mass_driver_plugins.memo import DiskStore, Memoized, ResultMemo
+from mass_driver_plugins.poetry_surgical import PoetrySurgical
+from mass_driver_plugins.surgical import GithubActionParameterReplacer
+
+WORKFLOW = """steps:
+  - uses: actions-rs/toolchain@v1
+    with:
+      profile: minimal
+"""
+
+PYPROJECT = """[tool.poetry.dependencies]
+python = "^3.11"
+pytest = "7.*"
+"""
+
+
+def make_repos(tmp_path: Path, repo_at, filename: str, contents: list[str]):
+    """Create one repo per content, each with a file of given name"""
+    repos = []
+    for i, content in enumerate(contents):
+        repo_path = tmp_path / f"repo{i}"
+        repo_path.mkdir()
+        (repo_path / filename).write_text(content)
+        repos.append(repo_at(repo_path))
+    return repos
+
+
+def test_surgical_memo_reuses_identical_files(tmp_path, repo_at, with_logger, mocker):
+    """Scenario: Identical workflows across repos are edited only once"""
+    # Given three repos, two of which have the same workflow
+    other = WORKFLOW.replace("minimal", "minimal  # other")
+    repos = make_repos(tmp_path, repo_at, "ci.yml", [WORKFLOW, WORKFLOW, other])
+    driver = GithubActionParameterReplacer(target_file="ci.yml", memoize=True)
+    with_logger(driver)
+    process_file = mocker.spy(GithubActionParameterReplacer, "process_file")
+    # When I run the memoizing driver over all of them
+    results = [driver.run(repo) for repo in repos]
+    # Then all are patched, but the duplicate file wasn't processed again
+    assert all(r.outcome == PatchOutcome.PATCHED_OK for r in results)
+    assert process_file.call_count == 2
+    for repo in repos:
+        assert "default" in (Path(repo.cloned_path) / "ci.yml").read_text()
+
+
+def test_memo_key_includes_config(tmp_path, repo_at, with_logger):
+    """Scenario: Drivers with different configs don't share results"""
+    repos = make_repos(tmp_path, repo_at, "ci.yml", [WORKFLOW, WORKFLOW])
+    memo_dir = str(tmp_path / "memo")
+    first = GithubActionParameterReplacer(target_file="ci.yml", memo_dir=memo_dir)
+    second = GithubActionParameterReplacer(
+        target_file="ci.yml", replacement_value="stable", memo_dir=memo_dir
+    )
+    for driver, repo in zip([first, second], repos):
+        with_logger(driver)
+        driver.run(repo)
+    assert "profile: default" in (Path(repos[0].cloned_path) / "ci.yml").read_text()
+    assert "profile: stable" in (Path(repos[1].cloned_path) / "ci.yml").read_text()
+
+
+def test_poetry_memo_on_disk(tmp_path, repo_at, with_logger, mocker):
+    """Scenario: Bump outcomes are reused from disk, by a new driver instance"""
+    # Given two repos with the same pyproject.toml
+    repos = make_repos(tmp_path, repo_at, "pyproject.toml", [PYPROJECT, PYPROJECT])
+    memo_dir = str(tmp_path / "memo")
+    config = {"packages": {"pytest": "8.*", "absent": "1.*"}, "memo_dir": memo_dir}
+    # When a driver bumps the first, and another driver the second
+    first = with_logger(PoetrySurgical(**config))
+    first_result = first.run(repos[0])
+    second = with_logger(PoetrySurgical(**config))
+    bump_packages = mocker.spy(PoetrySurgical, "bump_packages")
+    second_result = second.run(repos[1])
+    # Then the second is patched the same, from the first's stored result
+    bump_packages.assert_not_called()
+    assert second_result == first_result
+    assert "absent: not found" in second_result.details
+    bumped = (Path(repos[1].cloned_path) / "pyproject.toml").read_text()
+    assert bumped == PYPROJECT.replace('"7.*"', '"8.*"')
+
+
+def test_jsonpatch_memo_outcomes(tmp_path, monkeypatch, repo_at, with_logger):
+    """Scenario: Memoized JSON patching keeps each repo's outcome"""
+    contents = ['{"a": 1}\n', '{"a": 2}\n', '{"a": 1}\n']
+    repos = make_repos(tmp_path, repo_at, "data.json", contents)
+    # Target file is validated from the current directory, as by mass-driver
+    monkeypatch.chdir(repos[0].cloned_path)
+    patch = [{"op": "replace", "path": "/a", "value": 2}]
+    driver = with_logger(JsonPatch(target_file="data.json", patch=patch, memoize=True))
+    outcomes = [driver.run(repo).outcome for repo in repos]
+    assert outcomes == [
+        PatchOutcome.PATCHED_OK,
+        PatchOutcome.ALREADY_PATCHED,
+        PatchOutcome.PATCHED_OK,
+    ]
+    for repo in repos:
+        assert (Path(repo.cloned_path) / "data.json").read_text() == '{"a": 2}\n'
+
+
+def test_result_memo_backed_by_disk(tmp_path):
+    """Check results evicted from memory are still found on disk"""
+    memo = ResultMemo(max_entries=1, store=DiskStore(tmp_path))
+    memo.put("a" * 64, Memoized(b"first\ncontent", {"outcome": "x"}))
+    memo.put("b" * 64, Memoized(b"second", None))
+    assert memo.get("a" * 64) == Memoized(b"first\ncontent", {"outcome": "x"})
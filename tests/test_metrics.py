@@ -0,0 +1,137 @@
+"""Validate the drivers' instrumentation"""
+
+import json
+
+import pytest
+from mass_driver.models.patchdriver import PatchOutcome
+
+from mass_driver_plugins.jsonpatch import JsonPatch
+from mass_driver_plugins.metrics import METRICS, Histogram
+from mass_driver_plugins.surgical import GithubActionParameterReplacer
+from mass_driver_plugins.template import TemplatedFile
+
+WORKFLOW = """steps:
+  - uses: actions-rs/toolchain@v1
+    with:
+      profile: minimal
+"""
+
+
+@pytest.fixture
+def collected():
+    """Get the reports collected during the test, starting from empty histograms"""
+    reports = []
+    METRICS.clear()
+    METRICS.add_sink(reports.append)
+    yield reports
+    METRICS.remove_sink(reports.append)
+    METRICS.clear()
+
+
+def test_surgical_metrics(tmp_path, repo, with_logger, collected):
+    """Scenario: An instrumented surgical run reports its phases and counters"""
+    # Given a workflow to fix, and an instrumented driver
+    (tmp_path / "ci.yml").write_text(WORKFLOW)
+    driver = GithubActionParameterReplacer(target_file="ci.yml", instrument=True)
+    with_logger(driver)
+    # When I run it
+    result = driver.run(repo)
+    # Then the result's details hold the repo's metrics
+    assert result.outcome == PatchOutcome.PATCHED_OK
+    metrics_line = result.details.splitlines()[-1]
+    assert metrics_line.startswith("metrics: ")
+    report = json.loads(metrics_line.removeprefix("metrics: "))
+    assert report == collected[0]
+    assert {"read", "parse", "query", "refine", "edit", "write"} <= set(
+        report["phases"]
+    )
+    assert report["counters"]["bytes_read"] == len(WORKFLOW)
+    assert report["counters"]["matches"] > 0
+    # Query cache misses or hits, depending on whether earlier tests warmed it
+    counters = report["counters"]
+    assert counters.get("query_misses", 0) + counters.get("query_hits", 0) > 0
+    # Rounded to the microsecond each
+    assert sum(report["phases"].values()) <= report["seconds"] + 1e-5
+
+
+def test_uninstrumented_run_has_no_metrics(tmp_path, repo, with_logger, collected):
+    """Scenario: Drivers record nothing unless instrumented"""
+    (tmp_path / "ci.yml").write_text(WORKFLOW)
+    driver = GithubActionParameterReplacer(target_file="ci.yml")
+    with_logger(driver)
+    result = driver.run(repo)
+    assert "metrics:" not in (result.details or "")
+    assert not collected
+    assert METRICS.histograms() == {}
+
+
+def test_glob_metrics_across_threads(tmp_path, repo, with_logger, collected):
+    """Scenario: Files edited in worker threads count towards the repo"""
+    for name in ["a.yml", "b.yml", "c.yml"]:
+        (tmp_path / name).write_text(WORKFLOW)
+    driver = GithubActionParameterReplacer(target_glob="*.yml", instrument=True)
+    with_logger(driver)
+    driver.run(repo)
+    (report,) = collected
+    assert report["counters"]["bytes_read"] == 3 * len(WORKFLOW)
+
+
+def test_metrics_file_and_histograms(
+    tmp_path, monkeypatch, repo_at, with_logger, collected
+):
+    """Scenario: Reports of many repos go to a JSON lines file and histograms"""
+    # Given two repos with a JSON file
+    repos = []
+    for name in ["one", "two"]:
+        repo_path = tmp_path / name
+        repo_path.mkdir()
+        (repo_path / "data.json").write_text('{"a": 1}\n')
+        repos.append(repo_at(repo_path))
+    # And a JSON patch driver writing its metrics to file
+    metrics_file = tmp_path / "metrics.jsonl"
+    # Target file is validated from the current directory, as by mass-driver
+    monkeypatch.chdir(repos[0].cloned_path)
+    driver = JsonPatch(
+        target_file="data.json",
+        patch=[{"op": "replace", "path": "/a", "value": 2}],
+        metrics_file=str(metrics_file),
+    )
+    with_logger(driver)
+    # When I run it over both repos
+    for repo in repos:
+        driver.run(repo)
+    # Then each repo's report is a line of the file
+    lines = metrics_file.read_text().splitlines()
+    assert [json.loads(line) for line in lines] == collected
+    assert {"parse", "patch", "serialize"} <= set(collected[0]["phases"])
+    # And histograms aggregate both repos
+    histograms = METRICS.histograms()["JsonPatch"]
+    assert histograms["seconds"]["count"] == 2
+    assert histograms["bytes_read"]["total"] == 2 * len('{"a": 1}\n')
+
+
+def test_template_metrics(repo, with_logger, collected):
+    """Scenario: Template rendering is timed, and compiled templates counted"""
+    driver = TemplatedFile(
+        target_file="out.txt", template="Hello {{ name }}", instrument=True
+    )
+    with_logger(driver)
+    repo.patch_data = {"name": "world"}
+    driver.run(repo)
+    driver.run(repo)
+    first, second = collected
+    assert "render" in first["phases"]
+    assert first["counters"]["bytes_written"] == len("Hello world")
+    assert "write" not in second["phases"]
+    assert second["counters"]["template_hits"] > 0
+
+
+def test_histogram_summary():
+    """Check histograms summarize their values"""
+    histogram = Histogram()
+    for value in [1, 2, 3]:
+        histogram.add(value)
+    summary = histogram.summary()
+    assert (summary["count"], summary["min"], summary["max"]) == (3, 1, 3)
+    assert summary["mean"] == 2
+    assert summary["buckets"] == {"1": 1, "2": 1, "4": 1}
@@ -0,0 +1,184 @@
+"""Validate chaining drivers in a pipeline"""
+
+import pytest
+from mass_driver.models.patchdriver import PatchOutcome
+from pydantic import ValidationError
+
+from mass_driver_plugins import overlay, pipeline
+from mass_driver_plugins.pipeline import Pipeline
+
+VALUES = """# Deployment values
+image: app:1.0
+replicas: 1
+"""
+
+
+@pytest.fixture
+def values_repo(tmp_path, repo, monkeypatch):
+    """Create a repo with a YAML file, as current directory for config validation"""
+    (tmp_path / "values.yaml").write_text(VALUES)
+    # Target file is validated from the current directory, as by mass-driver
+    monkeypatch.chdir(tmp_path)
+    return repo
+
+
+def yamlpatch_step(path: str, value) -> dict:
+    """Describe a yamlpatch step, replacing a value of values.yaml"""
+    return {
+        "driver": "yamlpatch",
+        "driver_config": {
+            "target_file": "values.yaml",
+            "patch": [{"op": "replace", "path": path, "value": value}],
+        },
+    }
+
+
+def test_pipeline_chains_drivers(tmp_path, values_repo, with_logger):
+    """Scenario: Each step sees the previous steps' changes, written once"""
+    # Given a pipeline patching a YAML file twice, then templating from it
+    template_step = {
+        "driver": "templater",
+        "driver_config": {"target_file": "VERSION", "template": "{{ version }}"},
+    }
+    driver = Pipeline(
+        steps=[
+            yamlpatch_step("/image", "app:2.0"),
+            yamlpatch_step("/replicas", 3),
+            template_step,
+        ]
+    )
+    with_logger(driver)
+    values_repo.patch_data = {"version": "2.0"}
+    # When I run it
+    result = driver.run(values_repo)
+    # Then both patches landed in the file, and the template was rendered
+    assert result.outcome == PatchOutcome.PATCHED_OK, result.details
+    patched = VALUES.replace("app:1.0", "app:2.0").replace("replicas: 1", "replicas: 3")
+    assert (tmp_path / "values.yaml").read_text() == patched
+    assert (tmp_path / "VERSION").read_text() == "2.0"
+    assert "1. yamlpatch: PATCHED_OK" in result.details
+    assert result.details.endswith("Changed files:\nVERSION\nvalues.yaml")
+
+
+def test_pipeline_net_change_empty(tmp_path, values_repo, with_logger):
+    """Scenario: Steps undoing each other make for an already patched repo"""
+    driver = Pipeline(
+        steps=[yamlpatch_step("/replicas", 3), yamlpatch_step("/replicas", 1)]
+    )
+    with_logger(driver)
+    written_mtime = (tmp_path / "values.yaml").stat().st_mtime_ns
+    result = driver.run(values_repo)
+    assert result.outcome == PatchOutcome.ALREADY_PATCHED, result.details
+    assert (tmp_path / "values.yaml").stat().st_mtime_ns == written_mtime
+
+
+def test_pipeline_error_writes_nothing(tmp_path, values_repo, with_logger):
+    """Scenario: A failing step stops the pipeline, leaving files untouched"""
+    failing_step = {
+        "driver": "yamlpatch",
+        "driver_config": {
+            "target_file": "values.yaml",
+            "patch": [{"op": "test", "path": "/replicas", "value": 42}],
+        },
+    }
+    driver = Pipeline(steps=[yamlpatch_step("/replicas", 3), failing_step])
+    with_logger(driver)
+    result = driver.run(values_repo)
+    assert result.outcome == PatchOutcome.PATCH_ERROR
+    assert "Step 2. yamlpatch failed" in result.details
+    assert (tmp_path / "values.yaml").read_text() == VALUES
+
+
+def test_pipeline_error_records_no_fingerprint(tmp_path, values_repo, with_logger):
+    """Scenario: A failed pipeline doesn't mark its templates as rendered"""
+    # Given a pipeline templating with a fingerprint index, then failing a test
+    template_step = {
+        "driver": "templater",
+        "driver_config": {
+            "target_file": "VERSION",
+            "template": "{{ version }}",
+            "fingerprint_index": str(tmp_path / "fingerprints.db"),
+        },
+    }
+
+    def guarded_pipeline(replicas: int) -> Pipeline:
+        """Build the pipeline, testing the replicas value after templating"""
+        guard = {
+            "driver": "yamlpatch",
+            "driver_config": {
+                "target_file": "values.yaml",
+                "patch": [{"op": "test", "path": "/replicas", "value": replicas}],
+            },
+        }
+        return with_logger(Pipeline(steps=[template_step, guard]))
+
+    values_repo.patch_data = {"version": "2.0"}
+    result = guarded_pipeline(42).run(values_repo)
+    assert result.outcome == PatchOutcome.PATCH_ERROR
+    # When I fix the failing step, and run again
+    result = guarded_pipeline(1).run(values_repo)
+    # Then the template is rendered, not skipped as already done
+    assert result.outcome == PatchOutcome.PATCHED_OK, result.details
+    assert (tmp_path / "VERSION").read_text() == "2.0"
+
+
+def test_pipeline_builds_drivers_once(values_repo, with_logger, mocker):
+    """Check each step's driver built on validation is the one that runs"""
+    build = mocker.spy(pipeline, "step_driver")
+    driver = Pipeline(steps=[yamlpatch_step("/replicas", 3)])
+    with_logger(driver)
+    assert driver.drivers[0] is driver.steps[0].build()
+    assert build.call_count == 1
+
+
+def test_pipeline_validates_steps(values_repo):
+    """Check bad step configs are refused upfront"""
+    with pytest.raises(ValidationError, match="not found"):
+        Pipeline(steps=[{"driver": "no-such-driver"}])
+    with pytest.raises(ValidationError):
+        Pipeline(steps=[{"driver": "yamlpatch", "driver_config": {}}])
+    # Drivers writing straight to disk would be overwritten
+    with pytest.raises(ValidationError, match="can't be a pipeline step"):
+        Pipeline(steps=[{"driver": "pipeline", "driver_config": {"steps": []}}])
+
+
+def test_pipeline_glob_sees_earlier_steps(tmp_path, values_repo, with_logger):
+    """Scenario: Glob-mode steps edit the files created by earlier steps"""
+    # Given a pipeline templating a workflow, then fixing all workflows
+    workflow = "steps:\n  - uses: actions-rs/toolchain@v1\n    with:\n"
+    driver = Pipeline(
+        steps=[
+            {
+                "driver": "templater",
+                "driver_config": {
+                    "target_file": ".github/workflows/ci.yml",
+                    "template": workflow + "      profile: minimal\n",
+                },
+            },
+            {
+                "driver": "surgical-ghactionparamswitch",
+                "driver_config": {"target_glob": ".github/workflows/*.yml"},
+            },
+        ]
+    )
+    with_logger(driver)
+    # When I run it
+    result = driver.run(values_repo)
+    # Then the new workflow is found by the glob, and edited before writing
+    assert result.outcome == PatchOutcome.PATCHED_OK, result.details
+    written = (tmp_path / ".github" / "workflows" / "ci.yml").read_text()
+    assert written == workflow + "      profile: default"
+    assert len(driver.drivers) == 2
+
+
+def test_overlay_reads_own_writes(tmp_path):
+    """Check the overlay serves written content, and flushes only changes"""
+    (tmp_path / "same.txt").write_bytes(b"same")
+    layer = overlay.FileOverlay()
+    layer.write_bytes(tmp_path / "same.txt", b"same")
+    layer.write_bytes(tmp_path / "sub" / "new.txt", b"new")
+    assert layer.is_file(tmp_path / "sub" / ".." / "sub" / "new.txt")
+    assert layer.read_bytes(tmp_path / "sub" / "new.txt") == b"new"
+    assert not (tmp_path / "sub").exists()
+    assert layer.flush() == [(tmp_path / "sub" / "new.txt").resolve()]
+    assert (tmp_path / "sub" / "new.txt").read_bytes() == b"new"
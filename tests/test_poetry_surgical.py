@@ -0,0 +1,228 @@
+"""Validate the poetry surgical bumper beyond the sample pyproject"""
+
+import time
+
+import pytest
+from mass_driver.models.patchdriver import PatchOutcome
+
+from mass_driver_plugins.poetry_surgical import PoetrySurgical, table_index
+from mass_driver_plugins.treesitter import REGISTRY
+
+
+def synthetic_pyproject(num_tables: int) -> bytes:
+    """Generate a pyproject.toml with many [tool.*] tables around dependencies"""
+    tables = [
+        f'[tool.generated{i}.settings]\nalpha = "{i}"\nbeta = "x"\ngamma = "y"\n'
+        for i in range(num_tables)
+    ]
+    dependencies = '[tool.poetry.dependencies]\npython = "^3.11"\npytest = "7.*"\n'
+    tables.append(dependencies)
+    return "\n".join(tables).encode()
+
+
+def scoped_table_lookup(query, tree, key: bytes):
+    """Look up by re-querying each table's range (previous approach)"""
+    captures = query.captures(tree.root_node)
+    table_ranges = {(n.start_point, n.end_point) for n, name in captures if name == "t"}
+    for tbl_start, tbl_end in sorted(table_ranges):
+        scoped = query.captures(
+            tree.root_node, start_point=tbl_start, end_point=tbl_end
+        )
+        if {n.text for n, v in scoped if v == "k"}.pop() == key:
+            return [n for n, v in scoped if v == "p"]
+    return []
+
+
+def test_table_index_many_tables(with_logger, record_timing):
+    """Benchmark: single-pass table index vs per-table scoped queries"""
+    # Given a pyproject with hundreds of tables
+    content = synthetic_pyproject(500)
+    driver = PoetrySurgical(package="pytest", target="8.*")
+    with_logger(driver)
+    query = REGISTRY.query(driver.language, driver.query)
+    tree = REGISTRY.parse(driver.language, content)
+    # When I look up the dependencies table both ways
+    start = time.perf_counter()
+    indexed_pairs = table_index(query.matches(tree.root_node))[driver.dependency_key]
+    indexed_time = time.perf_counter() - start
+    start = time.perf_counter()
+    scoped_pairs = scoped_table_lookup(query, tree, b"tool.poetry.dependencies")
+    scoped_time = time.perf_counter() - start
+    record_timing("indexed_seconds", indexed_time)
+    record_timing("scoped_seconds", scoped_time)
+    # Then both find the same pairs (timings reported in junit properties)
+    assert [n.text for n in indexed_pairs] == [n.text for n in scoped_pairs]
+    # And the driver bumps the package in that big file
+    bumped = driver.process_bytes(content)
+    assert bumped == content.replace(b'pytest = "7.*"', b'pytest = "8.*"')
+
+
+def test_batch_bump_outcomes(tmp_path, repo, with_logger):
+    """Scenario: Bump many packages across groups from a single parse"""
+    # Given a pyproject with main and test dependencies
+    pyproject = tmp_path / "pyproject.toml"
+    pyproject.write_bytes(
+        b'[tool.poetry.dependencies]\r\npython = "^3.11"\r\njsonpatch = "*"\r\n'
+        b'\r\n[tool.poetry.group.test.dependencies]\r\npytest = "7.*"\r\n'
+    )
+    driver = PoetrySurgical(
+        packages={"python": "^3.12", "jsonpatch": "*", "missing": "1.*"},
+        group_packages={"test": {"pytest": "8.*"}},
+    )
+    with_logger(driver)
+    # When I bump them all in one run
+    result = driver.run(repo)
+    # Then both outdated packages are bumped in the same write
+    assert result.outcome == PatchOutcome.PATCHED_OK
+    assert pyproject.read_bytes() == (
+        b'[tool.poetry.dependencies]\r\npython = "^3.12"\r\njsonpatch = "*"\r\n'
+        b'\r\n[tool.poetry.group.test.dependencies]\r\npytest = "8.*"\r\n'
+    )
+    # And each package's outcome is reported
+    assert result.details.splitlines() == [
+        "python: patched",
+        "jsonpatch: already at target",
+        "missing: not found",
+        "test:pytest: patched",
+    ]
+
+
+def test_pep621_and_inline_table_forms(with_logger):
+    """Scenario: Bump packages written in all supported forms"""
+    # Given a pyproject mixing PEP 621 and Poetry dependency forms
+    content = b"""[project]
+name = "sample"
+dependencies = [
+    "Jinja2 >=3.1 ; python_version >= '3.11'",
+    'ruamel.yaml[jinja2]>=0.17',
+    "mylib @ https://example.com/mylib.whl",
+]
+
+[project.optional-dependencies]
+test = ["pytest==7.4.0"]
+
+[tool.poetry.dependencies]
+Ruamel_YAML = {version = "^0.17", extras = ["jinja2"]}
+
+[tool.poetry.dependencies."tree-sitter"]
+version = "<0.22.0"
+"""
+    driver = PoetrySurgical(
+        packages={
+            "jinja2": "^3.2",
+            "ruamel-yaml": "^0.18",
+            "tree_sitter": "^0.22",
+            "mylib": "2.*",
+        },
+        group_packages={"test": {"pytest": "8.*"}},
+    )
+    with_logger(driver)
+    # When I bump them
+    bumped = driver.process_bytes(content)
+    # Then each form is edited surgically, names matched per PEP 503
+    expected = b"""[project]
+name = "sample"
+dependencies = [
+    "Jinja2 >=3.2,<4.0 ; python_version >= '3.11'",
+    'ruamel.yaml[jinja2]>=0.18,<0.19',
+    "mylib @ https://example.com/mylib.whl",
+]
+
+[project.optional-dependencies]
+test = ["pytest==8.*"]
+
+[tool.poetry.dependencies]
+Ruamel_YAML = {version = "^0.18", extras = ["jinja2"]}
+
+[tool.poetry.dependencies."tree-sitter"]
+version = "^0.22"
+"""
+    assert bumped == expected
+
+
+SAMPLE_LOCKED_PYPROJECT = """[tool.poetry]
+name = "x"
+version = "1"
+description = ""
+authors = []
+
+[tool.poetry.dependencies]
+python = "^3.11"
+pytest = "^7.4"
+
+[tool.poetry.group.test.dependencies]
+black = "*"
+"""
+
+SAMPLE_LOCK = """[[package]]
+name = "pytest"
+version = "7.4.4"
+description = "pytest: simple powerful testing with Python"
+optional = false
+python-versions = ">=3.7"
+
+[metadata]
+lock-version = "2.0"
+python-versions = "^3.11"
+content-hash = "3e597508f7f06637dc5f3289731b96e7447d0cf741b8160f5d87f8f14810439c"
+"""
+
+
+@pytest.mark.parametrize(
+    "target,expected_hash,expected_detail",
+    [
+        (
+            "7.*",
+            "190430dc77e4daf51ac76203a5d7940b876321707335258626d4b57c33cae7ce",
+            "poetry.lock: content-hash updated",
+        ),
+        (
+            "8.*",
+            "3e597508f7f06637dc5f3289731b96e7447d0cf741b8160f5d87f8f14810439c",
+            "poetry.lock: re-lock needed: pytest locked at 7.4.4, outside 8.*",
+        ),
+    ],
+)
+def test_lock_content_hash(
+    tmp_path, target, expected_hash, expected_detail, repo, with_logger
+):
+    """Scenario: Refresh poetry.lock's content-hash only if lock still fits"""
+    # Given a pyproject and its lock file, up to date
+    (tmp_path / "pyproject.toml").write_text(SAMPLE_LOCKED_PYPROJECT)
+    (tmp_path / "poetry.lock").write_text(SAMPLE_LOCK)
+    driver = PoetrySurgical(package="pytest", target=target, update_lock=True)
+    with_logger(driver)
+    # When I bump pytest, with lock updating enabled
+    result = driver.run(repo)
+    # Then the hash is recomputed (same as Poetry would) only if lock is valid
+    assert result.outcome == PatchOutcome.PATCHED_OK
+    assert expected_detail in result.details
+    expected_lock = SAMPLE_LOCK.replace(
+        "3e597508f7f06637dc5f3289731b96e7447d0cf741b8160f5d87f8f14810439c",
+        expected_hash,
+    )
+    assert (tmp_path / "poetry.lock").read_text() == expected_lock
+
+
+@pytest.mark.parametrize(
+    "lock_content",
+    [
+        SAMPLE_LOCK.replace('content-hash = "', 'other-hash = "'),
+        "[[package]\nname = ",
+        SAMPLE_LOCK.replace('version = "7.4.4"', 'version = "not-a-version"'),
+    ],
+    ids=["no-content-hash", "malformed-toml", "bad-version"],
+)
+def test_lock_refresh_errors(tmp_path, lock_content, repo, with_logger):
+    """Scenario: A lock that can't be refreshed is flagged, not raised"""
+    # Given a pyproject and a broken lock file
+    (tmp_path / "pyproject.toml").write_text(SAMPLE_LOCKED_PYPROJECT)
+    (tmp_path / "poetry.lock").write_text(lock_content)
+    driver = PoetrySurgical(package="pytest", target="7.*", update_lock=True)
+    with_logger(driver)
+    # When I bump pytest, with lock updating enabled
+    result = driver.run(repo)
+    # Then the bump is kept, and the lock reported as needing a re-lock
+    assert result.outcome == PatchOutcome.PATCHED_OK
+    assert "poetry.lock: re-lock needed: failed to refresh" in result.details
+    assert (tmp_path / "poetry.lock").read_text() == lock_content
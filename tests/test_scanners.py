@@ -0,0 +1,153 @@
+"""Validate the dependency and GitHub Actions scanners, and their index"""
+
+import json
+from pathlib import Path
+
+import pytest
+
+from mass_driver_plugins.cli import cli
+from mass_driver_plugins.scanners import (
+    InventoryIndex,
+    github_actions,
+    poetry_dependencies,
+    pyproject_pins,
+    scan_repos,
+    workflow_actions,
+)
+
+PYPROJECT = b"""\
+[tool.poetry.dependencies]
+python = "^3.10"
+Requests = {version = "^2.31"}
+
+[tool.poetry.group.test.dependencies]
+pytest = "^7.4"
+
+[project]
+dependencies = ["httpx>=0.25", "rich"]
+"""
+
+WORKFLOW = b"""\
+jobs:
+  build:
+    steps:
+      - uses: actions/checkout@v4
+      - name: Setup
+        uses: "actions/setup-python@v5"
+        with:
+          python-version: "3.11"
+          cache: poetry
+"""
+
+
+def make_repo(path: Path, pyproject: bytes = PYPROJECT) -> Path:
+    """Create a repo with a pyproject.toml and a workflow"""
+    workflows = path / ".github" / "workflows"
+    workflows.mkdir(parents=True)
+    (workflows / "ci.yml").write_bytes(WORKFLOW)
+    (path / "pyproject.toml").write_bytes(pyproject)
+    return path
+
+
+def test_pyproject_pins():
+    """Scenario: List the pins of Poetry and PEP 621 dependencies"""
+    # Given a pyproject with both kinds of dependencies
+    # When I list its pins
+    pins = {pin["normalized"]: pin for pin in pyproject_pins(PYPROJECT)}
+    # Then each dependency is found, with its spec and line
+    assert sorted(pins) == ["httpx", "pytest", "python", "requests", "rich"]
+    assert pins["requests"]["package"] == "Requests"
+    assert pins["requests"]["spec"] == "^2.31"
+    assert pins["pytest"]["group"] == "test"
+    assert pins["pytest"]["line"] == 6
+    assert pins["httpx"]["spec"] == ">=0.25"
+    assert pins["rich"]["spec"] == ""
+
+
+def test_workflow_actions():
+    """Scenario: List the steps using actions, with and without parameters"""
+    # Given a workflow with two steps
+    # When I list its actions
+    steps = workflow_actions(WORKFLOW)
+    # Then each step is found, in order, with its parameters
+    assert steps == [
+        {"action": "actions/checkout@v4", "line": 4, "with": {}},
+        {
+            "action": "actions/setup-python@v5",
+            "line": 6,
+            "with": {"python-version": '"3.11"', "cache": "poetry"},
+        },
+    ]
+
+
+def test_scanner_entrypoints(tmp_path):
+    """Scenario: Scan a repo as mass-driver scanners do"""
+    # Given a repo
+    repo = make_repo(tmp_path / "repo")
+    # When I scan it
+    dependencies = poetry_dependencies(repo)["dependencies"]
+    actions = github_actions(repo)["github_actions"]
+    # Then findings are tagged with their file
+    assert {pin["file"] for pin in dependencies} == {"pyproject.toml"}
+    assert {step["file"] for step in actions} == {".github/workflows/ci.yml"}
+
+
+def test_scan_repos_index(tmp_path):
+    """Scenario: Scan many repos in parallel, indexing their findings"""
+    # Given repos, one without pytest, one without any file, one not UTF-8
+    alpha = make_repo(tmp_path / "alpha")
+    beta = make_repo(tmp_path / "beta", PYPROJECT.replace(b"pytest", b"nose"))
+    empty = tmp_path / "empty"
+    empty.mkdir()
+    broken = make_repo(
+        tmp_path / "broken", b'[tool.poetry.dependencies]\npython = "\xff"\n'
+    )
+    repos = [alpha, beta, empty, broken]
+    # When I scan them in a process pool, recording into an index
+    index = InventoryIndex(tmp_path / "inventory.db")
+    results = list(scan_repos("poetry-dependencies", repos, workers=2))
+    for repo, findings in results:
+        index.record("poetry-dependencies", repo.name, findings)
+    # Then all repos come back, in order
+    assert [repo for repo, _ in results] == repos
+    assert results[2][1] == []
+    # And unreadable files are reported as errors, not crashing the scan
+    assert "Invalid toml syntax" in results[3][1][0]["error"]
+    # And the index finds the repos pinning a package
+    assert index.repos_with_package("PyTest") == ["alpha"]
+    assert index.repos_with_package("requests") == ["alpha", "beta"]
+    # And re-scanning a repo replaces its findings
+    index.record("poetry-dependencies", "alpha", [])
+    assert index.repos_with_package("pytest") == []
+    index.close()
+
+
+def test_cli_scan(tmp_path, capsys):
+    """Scenario: Scan a directory of repos from the command line"""
+    # Given a directory of repos
+    make_repo(tmp_path / "mirror" / "alpha")
+    (tmp_path / "mirror" / "beta").mkdir()
+    db = tmp_path / "inventory.db"
+    # When I scan their actions into an index
+    cli(["scan", "github-actions", str(tmp_path / "mirror"), "-j2", "--index", str(db)])
+    captured = capsys.readouterr()
+    # Then each repo's findings are printed as a JSON line
+    results = {
+        line["repo"]: line for line in map(json.loads, captured.out.splitlines())
+    }
+    assert results["beta"]["github_actions"] == []
+    assert len(results["alpha"]["github_actions"]) == 2
+    assert "2 repos" in captured.err
+    # And the index finds repos by action and parameter
+    index = InventoryIndex(db)
+    assert index.repos_with_action("actions/checkout@v4") == ["alpha"]
+    assert index.repos_with_action("actions/checkout@v4", "cache") == []
+    assert index.repos_with_action("actions/setup-python@v5", "cache") == ["alpha"]
+    index.close()
+
+
+def test_cli_scan_rejects_no_workers(tmp_path, capsys):
+    """Check scanning needs at least one worker"""
+    with pytest.raises(SystemExit):
+        cli(["scan", "github-actions", str(tmp_path), "-j", "0"])
+    assert "must be at least 1" in capsys.readouterr().err
@@ -1,12 +1,20 @@
 """Validate the template"""
 
 import os
+import time
 from pathlib import Path
 
+import pytest
 from mass_driver.models.activity import load_activity_toml
 from mass_driver.models.patchdriver import PatchOutcome
 from mass_driver.tests.fixtures import copy_folder, massdrive
 
+from mass_driver_plugins.surgical import (
+    GithubActionParameterReplacer,
+    QuerySurgicalEditor,
+    SurgicalFileEditor,
+)
+
 CONFIG_FILENAME = "surgical_migration.toml"
 
 
@@ -31,3 +39,204 @@ def test_surgical(tmp_path, datadir, mocker):
     reference_text = (repo_path / "good.yaml").read_text()
     # Then the changed file is identical to a reference
     assert target_text_post == reference_text, "Post-change file should match reference"
+
+
+def test_surgical_glob(tmp_path, datadir, repo, with_logger):
+    """Scenario: Surgically editing many Github Actions files in one run"""
+    # Given a repo with several workflow files, one of which is already fixed
+    workflows = tmp_path / ".github" / "workflows"
+    workflows.mkdir(parents=True)
+    bad_text = (datadir / "sample_repo" / "bad.yaml").read_text()
+    reference_text = (datadir / "sample_repo" / "good.yaml").read_text()
+    for name in ["ci.yml", "docs.yml", "release.yml"]:
+        (workflows / name).write_text(bad_text)
+    (workflows / "fixed.yml").write_text(reference_text)
+    driver = GithubActionParameterReplacer(target_glob=".github/workflows/*.yml")
+    with_logger(driver)
+    # When I run the driver once over the glob
+    result = driver.run(repo)
+    # Then all files are edited, and the combined result reports each file
+    assert result.outcome == PatchOutcome.PATCHED_OK, result.details
+    for name in ["ci.yml", "docs.yml", "release.yml", "fixed.yml"]:
+        assert (workflows / name).read_text() == reference_text
+    assert ".github/workflows/ci.yml: PATCHED_OK" in result.details
+    assert ".github/workflows/fixed.yml: ALREADY_PATCHED" in result.details
+
+
+def test_surgical_keeps_line_endings(datadir, with_logger):
+    """Scenario: CRLF line endings and missing final newline survive editing"""
+    # Given a workflow file with Windows line endings and no trailing newline
+    bad_text = (datadir / "sample_repo" / "bad.yaml").read_text()
+    reference_text = (datadir / "sample_repo" / "good.yaml").read_text()
+    crlf_bad = bad_text.rstrip("\n").replace("\n", "\r\n").encode()
+    crlf_reference = reference_text.rstrip("\n").replace("\n", "\r\n").encode()
+    driver = GithubActionParameterReplacer(target_file="bad.yaml")
+    with_logger(driver)
+    # When I surgically edit it
+    edited = driver.process_file(crlf_bad)
+    # Then only the targeted values changed, line endings untouched
+    assert edited == crlf_reference
+
+
+class UppercaseProfile(SurgicalFileEditor):
+    """Downstream-style subclass, overriding the str-based editing hook"""
+
+    language: str = "yaml"
+    query: str = "(block_mapping_pair) @p"
+
+    def treesitter_query(self, captures):
+        """Keep all pairs"""
+        return [node for node, _name in captures]
+
+    def refine_search(self, matching_nodes):
+        """Keep all pairs"""
+        return matching_nodes
+
+    def surgical_edit(self, text: str, bad_nodes) -> str:
+        """Replace the targeted values by editing the text directly"""
+        return text.replace("profile: minimal", "profile: MINIMAL")
+
+
+def test_surgical_edit_str_override(datadir, with_logger):
+    """Scenario: Subclasses overriding surgical_edit on str keep working"""
+    bad_text = (datadir / "sample_repo" / "bad.yaml").read_text()
+    driver = UppercaseProfile(target_file="bad.yaml")
+    with_logger(driver)
+    # When I edit a file with the str-based override
+    edited = driver.process_file(bad_text.encode())
+    # Then its edits are applied
+    assert edited == bad_text.replace("profile: minimal", "profile: MINIMAL").encode()
+
+
+ACTION_PROFILE_QUERY = """
+    (block_mapping
+     (block_mapping_pair
+      key: (flow_node) @uses (#eq? @uses "uses")
+      value: (flow_node) @action (#eq? @action "actions-rs/toolchain@v1"))
+     (block_mapping_pair
+      key: (flow_node) @with (#eq? @with "with")
+      value: (block_node
+       (block_mapping
+        (block_mapping_pair
+         key: (flow_node) @key (#eq? @key "profile")
+         value: (flow_node) @value (#match? @value "^minimal$"))))))
+"""
+
+
+def test_query_surgical_editor(datadir, with_logger):
+    """Scenario: Surgically edit a file from a query, without Python code"""
+    bad_text = (datadir / "sample_repo" / "bad.yaml").read_text()
+    reference_text = (datadir / "sample_repo" / "good.yaml").read_text()
+    # Given a query-driven driver, configured like an activity file would
+    driver = QuerySurgicalEditor(
+        target_file="bad.yaml",
+        language="yaml",
+        query=ACTION_PROFILE_QUERY,
+        capture="value",
+        replacement="default",
+    )
+    with_logger(driver)
+    # When I edit the file
+    edited = driver.process_file(bad_text.encode())
+    # Then the predicates selected exactly the targeted values
+    assert edited.decode() == reference_text
+    # And running again changes nothing
+    assert driver.process_file(edited) == edited
+
+
+def test_query_surgical_editor_format(with_logger):
+    """Scenario: Replacement text built from the match's captures"""
+    content = b"a: 1\nb: 2  # keep me\nc: x\n"
+    driver = QuerySurgicalEditor(
+        target_file="any.yaml",
+        language="yaml",
+        query=(
+            "(block_mapping_pair key: (flow_node) @key"
+            ' value: (flow_node) @value (#match? @value "^[0-9]+$"))'
+        ),
+        capture="value",
+        replacement="{{{key}: {value}}}",
+    )
+    with_logger(driver)
+    edited = driver.process_file(content)
+    assert edited == b"a: {a: 1}\nb: {b: 2}  # keep me\nc: x\n"
+
+
+def test_query_surgical_editor_unknown_capture():
+    """Check a capture missing from the query is rejected upfront"""
+    with pytest.raises(ValueError, match="@val"):
+        QuerySurgicalEditor(
+            target_file="any.yaml",
+            language="yaml",
+            query="(flow_node) @value",
+            capture="val",
+            replacement="x",
+        )
+
+
+STEPS_WORKFLOW = """\
+steps:
+  - uses: actions/checkout@v2
+  - name: Setup
+    uses: actions-rs/toolchain@v1
+    with:
+      profile: minimal  # Keep this comment
+  - with:
+      profile: minimal
+      toolchain: nightly
+    uses: "actions-rs/toolchain@v1"
+  - uses: other/toolchain@v2
+    id: second
+    with:
+      toolchain: stable
+      profile: minimal
+  - uses: unrelated/action@v1
+    with:
+      profile: minimal
+  - uses: actions-rs/toolchain@v1
+    with: ""
+  - run: echo "profile: minimal"
+"""
+
+
+def test_action_replacer_step_shapes(with_logger):
+    """Scenario: Replace parameters of several actions, whatever the step shape"""
+    # Given a workflow with steps in various shapes
+    driver = GithubActionParameterReplacer(
+        target_file="ci.yml",
+        action_selectors=["actions-rs/toolchain@v1", "other/toolchain@v2"],
+        replacements={
+            "profile": {"minimal": "default"},
+            "toolchain": {"nightly": "stable", "stable": "beta"},
+        },
+    )
+    with_logger(driver)
+    # When I edit it
+    edited = driver.process_file(STEPS_WORKFLOW.encode()).decode()
+    # Then every selected action's parameters are replaced, and only those
+    assert edited == (
+        STEPS_WORKFLOW.replace("profile: minimal", "profile: default", 3)
+        .replace("toolchain: nightly", "toolchain: stable")
+        .replace("toolchain: stable\n      profile", "toolchain: beta\n      profile")
+    )
+
+
+def test_action_replacer_large_workflow(with_logger, record_timing):
+    """Benchmark: Replacing a parameter in a workflow with thousands of steps"""
+    # Given a workflow with thousands of steps, a third of which to edit
+    steps = []
+    for i in range(3000):
+        action = ["actions-rs/toolchain@v1", "actions/checkout@v2", "x/y@v1"][i % 3]
+        steps.append(
+            f"  - name: Step {i}\n    uses: {action}\n"
+            f"    with:\n      profile: minimal\n      toolchain: stable\n"
+        )
+    content = ("steps:\n" + "".join(steps)).encode()
+    driver = with_logger(GithubActionParameterReplacer(target_file="ci.yml"))
+    # When I edit it
+    start = time.perf_counter()
+    edited = driver.process_file(content)
+    record_timing("seconds", time.perf_counter() - start)
+    # Then exactly the selected action's steps are edited
+    assert edited.count(b"profile: default") == 1000
+    assert edited.count(b"profile: minimal") == 2000
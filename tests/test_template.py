@@ -2,10 +2,18 @@
 
 from pathlib import Path
 
+import pytest
+
 # from mass_driver.migration import Migration
 from mass_driver.models.patchdriver import PatchOutcome
 from mass_driver.tests.fixtures import copy_folder, massdrive_runlocal, repoize
 
+from mass_driver_plugins.template import (
+    FingerprintIndex,
+    TemplatedFile,
+    write_if_changed,
+)
+
 CONFIG_FILENAME = "template_migration.toml"
 
 
@@ -27,3 +35,187 @@ def test_template_expansion(tmp_path, datadir, monkeypatch):
     assert (
         migration_result.outcome == PatchOutcome.PATCHED_OK
     ), f"Wrong outcome from patching: {migration_result.details}"
+
+
+def test_template_rerun_already_patched(tmp_path, repo, with_logger):
+    """Scenario: Re-running a template over its own output writes nothing"""
+    # Given a templating driver, and a repo with patch data
+    driver = TemplatedFile(
+        target_file="templated.txt",
+        template="Hello {{ keyword }}\n",
+        jinja_args={"trim_blocks": True},
+    )
+    with_logger(driver)
+    repo.patch_data = {"keyword": "world"}
+    # When I run it twice
+    first = driver.run(repo)
+    written_mtime = (tmp_path / "templated.txt").stat().st_mtime_ns
+    template_after_first = driver.compiled_template
+    second = driver.run(repo)
+    # Then the second run detects the file is up to date, and doesn't write
+    assert first.outcome == PatchOutcome.PATCHED_OK
+    assert second.outcome == PatchOutcome.ALREADY_PATCHED
+    assert (tmp_path / "templated.txt").read_text() == "Hello world"
+    assert (tmp_path / "templated.txt").stat().st_mtime_ns == written_mtime
+    # And the template was compiled only once
+    assert driver.compiled_template is template_after_first
+
+
+def make_template_dir(path: Path) -> Path:
+    """Create a folder of templates, with templated file paths"""
+    (path / "{{ service }}").mkdir(parents=True)
+    (path / "{{ service }}" / "config.yaml").write_text("name: {{ service }}\n")
+    (path / "README.md").write_text("# {{ service | upper }}\n")
+    (path / "{% if docker %}Dockerfile{% endif %}").write_text("FROM scratch\n")
+    return path
+
+
+def test_template_dir(tmp_path, repo_at, with_logger):
+    """Scenario: Render a folder of templates, then re-render it"""
+    # Given a folder of templates, some with conditional file paths
+    templates = make_template_dir(tmp_path / "templates")
+    driver = with_logger(
+        TemplatedFile(
+            template_dir=str(templates),
+            bytecode_cache_dir=str(tmp_path / "cache"),
+        )
+    )
+    repo_path = tmp_path / "repo"
+    repo_path.mkdir()
+    repo = repo_at(repo_path)
+    repo.patch_data = {"service": "api", "docker": False}
+    # When I render it into a repo
+    first = driver.run(repo)
+    # Then files are rendered at their templated paths
+    assert first.outcome == PatchOutcome.PATCHED_OK, first.details
+    assert (repo_path / "api" / "config.yaml").read_text() == "name: api\n"
+    assert (repo_path / "README.md").read_text() == "# API\n"
+    # And files whose path renders empty are skipped
+    assert not (repo_path / "Dockerfile").exists()
+    assert sorted(first.details.splitlines()) == [
+        "README.md: PATCHED_OK",
+        "api/config.yaml: PATCHED_OK",
+    ]
+    # When I render it again, with one value changed
+    readme_mtime = (repo_path / "README.md").stat().st_mtime_ns
+    second = driver.run(repo)
+    repo.patch_data = {"service": "api", "docker": True}
+    third = driver.run(repo)
+    # Then unchanged files are left alone
+    assert second.outcome == PatchOutcome.ALREADY_PATCHED
+    assert third.outcome == PatchOutcome.PATCHED_OK
+    assert third.details == "Dockerfile: PATCHED_OK"
+    assert (repo_path / "README.md").stat().st_mtime_ns == readme_mtime
+
+
+def test_template_dir_paths_not_escaped(tmp_path, repo_at, with_logger):
+    """Scenario: Templated file paths are not HTML-escaped, unlike contents"""
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "{{ name }}.txt").write_text("{{ name }}")
+    driver = with_logger(TemplatedFile(template_dir=str(templates)))
+    repo_path = tmp_path / "repo"
+    repo_path.mkdir()
+    repo = repo_at(repo_path)
+    repo.patch_data = {"name": "R&D's"}
+    result = driver.run(repo)
+    assert result.outcome == PatchOutcome.PATCHED_OK, result.details
+    assert [path.name for path in repo_path.iterdir()] == ["R&D's.txt"]
+
+
+def test_template_dir_outside_target(tmp_path, repo, with_logger):
+    """Scenario: A templated path escaping the repo is an error, writing nothing"""
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "a.txt").write_text("fine")
+    (templates / "{{ name }}").write_text("oops")
+    driver = with_logger(TemplatedFile(template_dir=str(templates)))
+    repo.patch_data = {"name": "../escaped"}
+    result = driver.run(repo)
+    assert result.outcome == PatchOutcome.PATCH_ERROR
+    assert not (tmp_path.parent / "escaped").exists()
+    # Not even the files listed before the bad one
+    assert not (tmp_path / "a.txt").exists()
+
+
+@pytest.mark.parametrize(
+    "existing,chunks,changed",
+    [
+        pytest.param(None, ["a", "b"], True, id="new_file"),
+        pytest.param(b"ab", ["a", "b"], False, id="identical"),
+        pytest.param(b"abc", ["a", "b"], True, id="shorter"),
+        pytest.param(b"ab", ["a", "b", "c"], True, id="longer"),
+        pytest.param(b"aXc", ["a", "b", "c"], True, id="differs_midway"),
+        pytest.param(b"", [], False, id="both_empty"),
+    ],
+)
+def test_write_if_changed(tmp_path, existing, chunks, changed):
+    """Check streamed writes only happen on content change"""
+    target = tmp_path / "sub" / "file.txt"
+    if existing is not None:
+        target.parent.mkdir()
+        target.write_bytes(existing)
+    assert write_if_changed(target, iter(chunks)) == changed
+    assert target.read_text() == "".join(chunks)
+    # No temporary file is left behind
+    assert [p.name for p in target.parent.iterdir()] == ["file.txt"]
+
+
+def test_write_if_changed_error_keeps_file(tmp_path):
+    """Check a rendering failure midway leaves the original file alone"""
+    target = tmp_path / "file.txt"
+    target.write_text("old")
+
+    def chunks():
+        yield "new"
+        raise RuntimeError("Template failed")
+
+    with pytest.raises(RuntimeError):
+        write_if_changed(target, chunks())
+    assert target.read_text() == "old"
+    assert [p.name for p in tmp_path.iterdir()] == ["file.txt"]
+
+
+def test_template_fingerprint_skips_unchanged(tmp_path, repo, with_logger):
+    """Scenario: Repos whose template inputs didn't change are skipped"""
+    # Given a templating driver with a fingerprint index
+    index = tmp_path / "index" / "fingerprints.db"
+    settings = dict(
+        target_file="templated.txt",
+        template="Hello {{ keyword }}",
+        fingerprint_index=str(index),
+    )
+    driver = with_logger(TemplatedFile(**settings))
+    repo.patch_data = {"keyword": "world", "unused": 1}
+    # When I run it, then run a fresh driver after changing an unused value
+    first = driver.run(repo)
+    (tmp_path / "templated.txt").unlink()
+    repo.patch_data = {"keyword": "world", "unused": 2}
+    second = with_logger(TemplatedFile(**settings)).run(repo)
+    # Then the second run is skipped without touching files, from the index
+    assert first.outcome == PatchOutcome.PATCHED_OK
+    assert second.outcome == PatchOutcome.ALREADY_PATCHED
+    assert not (tmp_path / "templated.txt").exists()
+    assert FingerprintIndex(index).get("test_repo") is not None
+    # When a value the template reads changes
+    repo.patch_data = {"keyword": "there", "unused": 2}
+    third = driver.run(repo)
+    # Then the repo is rendered again
+    assert third.outcome == PatchOutcome.PATCHED_OK
+    assert (tmp_path / "templated.txt").read_text() == "Hello there"
+
+
+def test_template_fingerprint_variables(tmp_path):
+    """Check the variables read by template files and paths are all found"""
+    templates = make_template_dir(tmp_path / "templates")
+    (templates / "loop.txt").write_text(
+        "{% for item in items %}{{ item }}{% set local = 1 %}{% endfor %}"
+    )
+    driver = TemplatedFile(template_dir=str(templates))
+    _, variables = driver.template_inputs()
+    assert variables == ["docker", "items", "service"]
+    # And changing the template changes the fingerprint
+    before = driver.fingerprint({"service": "api"})
+    (templates / "loop.txt").write_text("changed")
+    changed = TemplatedFile(template_dir=str(templates))
+    assert changed.fingerprint({"service": "api"}) != before
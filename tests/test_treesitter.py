@@ -0,0 +1,64 @@
+"""Validate the tree-sitter object cache"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mass_driver_plugins.splice import Edit
+from mass_driver_plugins.surgical import GithubActionParameterReplacer
+from mass_driver_plugins.treesitter import TreeSitterRegistry
+
+
+def test_registry_reuses_compiled_query():
+    """Scenario: Same query requested twice is compiled once"""
+    # Given an empty registry
+    registry = TreeSitterRegistry()
+    query_text = GithubActionParameterReplacer.__fields__["query"].default
+    # When I request the same query twice
+    first = registry.query("yaml", query_text)
+    second = registry.query("yaml", query_text)
+    # Then the very same compiled object is handed back
+    assert first is second, "Query should be compiled only once"
+    stats = registry.stats()
+    assert stats["query_misses"] == 1
+    assert stats["query_hits"] == 1
+    assert stats["language_misses"] == 1
+
+
+def test_registry_parser_per_thread():
+    """Scenario: Each thread gets its own parser, reused within that thread"""
+    registry = TreeSitterRegistry()
+    # When I grab parsers from two different threads
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        other_thread_parser = pool.submit(registry.parser, "toml").result()
+    main_parser = registry.parser("toml")
+    # Then they are distinct, but the same thread reuses its own
+    assert main_parser is not other_thread_parser
+    assert registry.parser("toml") is main_parser
+    assert registry.stats()["parser_hits"] == 1
+
+
+def test_document_incremental_edits_match_fresh_parse():
+    """Scenario: Several rounds of edits keep the tree in sync with content"""
+    # Given a parsed YAML document
+    registry = TreeSitterRegistry()
+    document = registry.document("yaml", "a: één\nb: 2\nc: 3\n".encode())
+    # When I edit it twice, re-querying in between
+    value_query = "(block_mapping_pair value: (_) @v)"
+    first_value = document.captures(value_query)[0][0]
+    document.apply([Edit(first_value.start_byte, first_value.end_byte, b"\n  y: 1")])
+    last_value = document.captures(value_query)[-1][0]
+    document.apply([Edit(last_value.start_byte, last_value.end_byte, b"4")])
+    # Then content and tree are both as if parsed from scratch
+    assert document.content == b"a: \n  y: 1\nb: 2\nc: 4\n"
+    fresh = registry.parse("yaml", document.content)
+    assert document.root_node.sexp() == fresh.root_node.sexp()
+
+
+def test_remembered_tree_reused_by_next_document():
+    """Scenario: A second driver over the same content skips parsing"""
+    registry = TreeSitterRegistry()
+    document = registry.document("toml", b'a = "1"\n')
+    registry.remember(document)
+    # When the same content is parsed again
+    registry.document("toml", b'a = "1"\n')
+    # Then the remembered tree is handed over
+    assert registry.stats()["tree_hits"] == 1